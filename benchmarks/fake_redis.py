@@ -0,0 +1,310 @@
+"""In-memory stand-in for the subset of Redis used by the application.
+
+Lets the benchmarks exercise the caching code paths without a Redis server.
+Implements the redis-py 2.x Redis client signatures that the services call.
+"""
+import fnmatch
+import threading
+import time
+
+try:
+    from tinysubscriptions.services import util
+except:
+    from services import util
+
+
+def get_score_check(bound, compare):
+    """Get a function checking scores against a sorted set range bound.
+
+    @param bound: A score, '-inf', '+inf', or '(' followed by an exclusive
+        score.
+    @type bound: float or str
+    @param compare: The inclusive comparison of a score to the bound.
+    @type compare: function
+    @rtype: function
+    """
+    if isinstance(bound, basestring) and bound.startswith('('):
+        limit = float(bound[1:])
+        return lambda score: score != limit and compare(score, limit)
+    limit = float(bound)
+    return lambda score: compare(score, limit)
+
+
+class FakePipeline:
+    """Queues commands and runs them against a FakeRedis on execute."""
+
+    def __init__(self, fake_redis):
+        self.__redis = fake_redis
+        self.__commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.__redis, name)
+
+        def queue(*args, **kwargs):
+            self.__commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        commands = self.__commands
+        self.__commands = []
+        with self.__redis.lock:
+            try:
+                return [
+                    method(*args, **kwargs)
+                    for method, args, kwargs in commands
+                ]
+            except Exception as e:
+                self.__redis.record_failure(e)
+                raise
+
+
+class FakeRedis:
+    """Thread-safe in-memory imitation of a Redis connection."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.__values = {}
+        self.__expirations = {}
+        self.failures = []
+
+    def __expire_key(self, name):
+        expires_at = self.__expirations.get(name, None)
+        if expires_at is not None and expires_at <= time.time():
+            self.__values.pop(name, None)
+            self.__expirations.pop(name, None)
+
+    def __get_value(self, name, default=None):
+        self.__expire_key(name)
+        return self.__values.get(name, default)
+
+    def __get_set(self, name):
+        self.__expire_key(name)
+        return self.__values.setdefault(name, set())
+
+    def __get_sorted_set(self, name):
+        self.__expire_key(name)
+        return self.__values.setdefault(name, {})
+
+    def __pop_if_empty(self, name):
+        if not self.__values.get(name, None):
+            self.__values.pop(name, None)
+            self.__expirations.pop(name, None)
+
+    def __get_scores_between(self, name, min_score, max_score):
+        min_check = get_score_check(min_score, lambda a, b: a >= b)
+        max_check = get_score_check(max_score, lambda a, b: a <= b)
+        scores = self.__get_value(name, {})
+        return sorted(
+            (score, member) for member, score in scores.items()
+            if min_check(score) and max_check(score)
+        )
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        error = AttributeError(
+            'FakeRedis instance has no attribute %r' % name
+        )
+        self.record_failure(error)
+        raise error
+
+    def record_failure(self, error):
+        """Record a command that failed, to be reported by the benchmarks."""
+        with self.lock:
+            self.failures.append(error)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def flushall(self):
+        with self.lock:
+            self.__values.clear()
+            self.__expirations.clear()
+
+    def get(self, name):
+        with self.lock:
+            return self.__get_value(name)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.lock:
+            exists = self.__get_value(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+
+            self.__values[name] = str(value)
+            self.__expirations.pop(name, None)
+            if ex is not None:
+                self.__expirations[name] = time.time() + ex
+            if px is not None:
+                self.__expirations[name] = time.time() + px / 1000.0
+            return True
+
+    def mget(self, *names):
+        with self.lock:
+            return [self.__get_value(name) for name in names]
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            value = int(self.__get_value(name, 0)) + amount
+            self.__values[name] = str(value)
+            return value
+
+    def setex(self, name, value, time_seconds):
+        return self.set(name, value, ex=time_seconds)
+
+    def setnx(self, name, value):
+        return bool(self.set(name, value, nx=True))
+
+    def delete(self, *names):
+        with self.lock:
+            deleted = 0
+            for name in names:
+                self.__expire_key(name)
+                if self.__values.pop(name, None) is not None:
+                    deleted += 1
+                self.__expirations.pop(name, None)
+            return deleted
+
+    def exists(self, name):
+        with self.lock:
+            return self.__get_value(name) is not None
+
+    def expire(self, name, time_seconds):
+        with self.lock:
+            if self.__get_value(name) is None:
+                return False
+            self.__expirations[name] = time.time() + time_seconds
+            return True
+
+    def ttl(self, name):
+        with self.lock:
+            if self.__get_value(name) is None:
+                return -2
+            expires_at = self.__expirations.get(name, None)
+            if expires_at is None:
+                return -1
+            return int(expires_at - time.time())
+
+    def sadd(self, name, *values):
+        with self.lock:
+            members = self.__get_set(name)
+            added = len(set(values) - members)
+            members.update(values)
+            return added
+
+    def srem(self, name, *values):
+        with self.lock:
+            members = self.__get_set(name)
+            removed = len(members & set(values))
+            members.difference_update(values)
+            if not members:
+                self.__values.pop(name, None)
+            return removed
+
+    def sdiff(self, name, *names):
+        with self.lock:
+            members = set(self.__get_value(name, set()))
+            for other in names:
+                members.difference_update(self.__get_value(other, set()))
+            return members
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self.__get_value(name, set()))
+
+    def sismember(self, name, value):
+        with self.lock:
+            return value in self.__get_value(name, set())
+
+    def sscan_iter(self, name, match=None, count=None):
+        for member in self.smembers(name):
+            if match is None or fnmatch.fnmatchcase(member, match):
+                yield member
+
+    def zadd(self, name, *args, **kwargs):
+        # redis-py 2.x Redis argument order: name1, score1, name2, score2...
+        pairs = dict(zip(args[0::2], args[1::2]))
+        pairs.update(kwargs)
+        with self.lock:
+            scores = self.__get_sorted_set(name)
+            added = len(set(pairs) - set(scores))
+            for member, score in pairs.items():
+                scores[member] = float(score)
+            return added
+
+    def zrem(self, name, *values):
+        with self.lock:
+            scores = self.__get_sorted_set(name)
+            removed = 0
+            for value in values:
+                if scores.pop(value, None) is not None:
+                    removed += 1
+            self.__pop_if_empty(name)
+            return removed
+
+    def zscore(self, name, value):
+        with self.lock:
+            return self.__get_value(name, {}).get(value, None)
+
+    def zrange(self, name, start, end, withscores=False):
+        with self.lock:
+            ordered = sorted(
+                (score, member)
+                for member, score in self.__get_value(name, {}).items()
+            )
+        if end == -1:
+            ordered = ordered[start:]
+        else:
+            ordered = ordered[start:end + 1]
+        if withscores:
+            return [(member, score) for score, member in ordered]
+        return [member for score, member in ordered]
+
+    def zrangebyscore(self, name, min_score, max_score, withscores=False):
+        with self.lock:
+            ordered = self.__get_scores_between(name, min_score, max_score)
+        if withscores:
+            return [(member, score) for score, member in ordered]
+        return [member for score, member in ordered]
+
+    def zremrangebyscore(self, name, min_score, max_score):
+        with self.lock:
+            ordered = self.__get_scores_between(name, min_score, max_score)
+            scores = self.__get_sorted_set(name)
+            for score, member in ordered:
+                del scores[member]
+            self.__pop_if_empty(name)
+            return len(ordered)
+
+    def scan_iter(self, match=None, count=None):
+        with self.lock:
+            names = list(self.__values.keys())
+        for name in names:
+            if match is None or fnmatch.fnmatchcase(name, match):
+                yield name
+
+    def eval(self, script, numkeys, *keys_and_args):
+        if script == util.RELEASE_LOCK_SCRIPT:
+            name, token = keys_and_args
+            with self.lock:
+                if self.__get_value(name) == token:
+                    return self.delete(name)
+                return 0
+
+        if script == util.CACHED_READ_SCRIPT:
+            func_generation_key, args_generation_key, name = keys_and_args
+            with self.lock:
+                func_generation, args_generation = self.mget(
+                    func_generation_key,
+                    args_generation_key
+                )
+                key = util.get_versioned_key(
+                    name,
+                    func_generation,
+                    args_generation
+                )
+                return [key, self.get(key), self.ttl(key)]
+
+        raise NotImplementedError('FakeRedis cannot run this script')
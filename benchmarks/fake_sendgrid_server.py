@@ -0,0 +1,123 @@
+"""Local HTTP server imitating the SendGrid newsletter list endpoints.
+
+Serves the endpoints in subscriptions_service.SENDGRID_ACTION_URLS from
+in-memory lists, optionally sleeping before each response to simulate network
+latency.
+"""
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+URL_TEMPLATE = 'http://127.0.0.1:%d/api%%s.json'
+
+
+class FakeSendGridState:
+    """The lists and members served by a FakeSendGridServer."""
+
+    def __init__(self, members_by_list, latency=0):
+        """Create new server state.
+
+        @param members_by_list: Dict of list name to an iterable of emails.
+        @type members_by_list: dict
+        @param latency: Seconds to wait before answering each request.
+        @type latency: float
+        """
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.requests = 0
+        self.members_by_list = dict(
+            (name, set(emails)) for name, emails in members_by_list.items()
+        )
+
+    def handle(self, path, params):
+        """Answer a SendGrid API request.
+
+        @param path: The request path, such as /api/newsletter/lists/get.json
+        @type path: str
+        @param params: The parsed form parameters.
+        @type params: dict of lists
+        @return: Tuple of (status code, JSON-serializable body)
+        @rtype: tuple
+        """
+        with self.lock:
+            self.requests += 1
+            listname = params.get('list', [None])[0]
+
+            if path.endswith('/newsletter/lists/get.json'):
+                return 200, [{'list': x} for x in sorted(self.members_by_list)]
+
+            members = self.members_by_list.get(listname, None)
+            if members is None:
+                return 401, {'error': 'List does not exist'}
+
+            if path.endswith('/newsletter/lists/email/get.json'):
+                return 200, [{'email': x} for x in members]
+
+            if path.endswith('/newsletter/lists/email/add.json'):
+                emails = [json.loads(x)['email'] for x in params['data']]
+                members.update(emails)
+                return 200, {'inserted': len(emails)}
+
+            if path.endswith('/newsletter/lists/email/delete.json'):
+                emails = params.get('email', [])
+                members.difference_update(emails)
+                return 200, {'removed': len(emails)}
+
+        return 404, {'error': 'Unknown endpoint'}
+
+
+class FakeSendGridHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        state = self.server.state
+        length = int(self.headers.getheader('content-length') or 0)
+        params = urlparse.parse_qs(self.rfile.read(length))
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        status_code, body = state.handle(self.path, params)
+        payload = json.dumps(body)
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSendGridServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """Threaded local HTTP server for a FakeSendGridState."""
+
+    daemon_threads = True
+
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, state):
+        BaseHTTPServer.HTTPServer.__init__(
+            self,
+            ('127.0.0.1', 0),
+            FakeSendGridHandler
+        )
+        self.state = state
+        self.thread = None
+
+    def get_url_template(self):
+        """Get the base url to configure a SendGridClient with."""
+        return URL_TEMPLATE % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
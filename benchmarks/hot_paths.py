@@ -0,0 +1,323 @@
+"""Benchmarks of the subscription hot paths.
+
+Each benchmark environment serves generated lists from a local fake SendGrid
+server (with optional latency) and caches into an in-memory Redis stand-in,
+then times the service functions and both controllers' routes through Flask's
+test client.
+"""
+import json
+import time
+
+try:
+    from tinysubscriptions import tiny_subscriptions
+    from tinysubscriptions import services
+except:
+    import tiny_subscriptions
+    import services
+
+import fake_redis
+import fake_sendgrid_server
+
+BENCH_EMAIL = 'bench@example.com'
+
+MANAGE_LISTS_URL = '/mailing/manage_lists?email=%s' % BENCH_EMAIL
+ADMIN_LISTS_URL = '/mailing/admin_lists'
+
+
+class BenchmarkEnvironment:
+    """Generated lists served by a fake SendGrid and cached in a fake Redis.
+
+    The benchmark email is subscribed to every list with an even index.
+    """
+
+    def __init__(self, list_count, members_per_list, latency):
+        self.list_count = list_count
+        self.members_per_list = members_per_list
+        self.latency = latency
+
+        self.listnames = ['List %d' % i for i in range(list_count)]
+        self.even_lists = self.listnames[0::2]
+        self.odd_lists = self.listnames[1::2]
+        self.descriptions = dict(
+            (name, {'description': 'Description of %s' % name})
+            for name in self.listnames
+        )
+
+        members = ['user%d@example.com' % i for i in range(members_per_list)]
+        members_by_list = {}
+        for name in self.listnames:
+            members_by_list[name] = list(members)
+        for name in self.even_lists:
+            members_by_list[name].append(BENCH_EMAIL)
+
+        self.sendgrid = fake_sendgrid_server.FakeSendGridState(
+            members_by_list,
+            latency
+        )
+        self.server = fake_sendgrid_server.FakeSendGridServer(self.sendgrid)
+        self.redis = fake_redis.FakeRedis()
+        self.client = tiny_subscriptions.get_app().test_client()
+
+    def start(self):
+        """Start the fake SendGrid and point the application at the fakes."""
+        self.server.start()
+
+        config = services.util.get_app_config()
+        config['FAKE_SENDGRID'] = False
+        config['FAKE_MONGO'] = True
+
+        redis_keeper = services.util.AppRedisKeeper.get_instance()
+        redis_keeper.redis_conn = self.redis
+        redis_keeper.redis_read_conn = self.redis
+        services.sendgrid_client.set_client(
+            services.sendgrid_client.SendGridClient(
+                base_url=self.server.get_url_template()
+            )
+        )
+        services.descriptions_service.get_db().subscriptions.save(
+            dict(self.descriptions)
+        )
+        self.reset_cache()
+
+    def stop(self):
+        self.server.stop()
+
+    def reset_cache(self):
+        """Empty the Redis stand-in and every in-process cache."""
+        self.redis.flushall()
+        for local_cache in services.util.LOCAL_CACHES.values():
+            local_cache.clear()
+        services.descriptions_service.LOCAL_DESCRIPTIONS['entry'] = \
+            services.descriptions_service.EMPTY_LOCAL_DESCRIPTIONS
+
+    def get_subscriptions_form(self, subscribed_lists):
+        subscribed_lists = set(subscribed_lists)
+        subscriptions = dict(
+            (name, {'subscribed': name in subscribed_lists})
+            for name in self.listnames
+        )
+        return {'subscriptions': json.dumps(subscriptions)}
+
+
+def check_cache(env):
+    """Fail the run if a Redis command failed.
+
+    The application only logs cache failures, so timings of a failing cache
+    would otherwise look valid.
+    """
+    if env.redis.failures:
+        failures = env.redis.failures
+        env.redis.failures = []
+        raise ValueError('Cache failure: %s' % failures[0])
+
+
+def check_status(env, response):
+    check_cache(env)
+    if response.status_code != 200:
+        raise ValueError('Unexpected status %d: %s' % (
+            response.status_code,
+            response.data
+        ))
+
+
+def check_result(env, result):
+    check_cache(env)
+    if not result.is_success():
+        raise ValueError('Unexpected failure: %s' % result.to_dict())
+
+
+def get_cases(env):
+    """Get the benchmark cases for an environment.
+
+    @param env: The environment to benchmark.
+    @type env: BenchmarkEnvironment
+    @return: List of (name, setup function or None, timed function).
+    @rtype: list of tuples
+    """
+    subscrip_service = services.subscriptions_service
+    util = services.util
+
+    subscriptions = list(env.even_lists)
+    descriptions = dict(env.descriptions)
+    new_subscriptions = util.merge_subscriptions_and_descriptions(
+        env.odd_lists,
+        descriptions
+    )
+    even_form = env.get_subscriptions_form(env.even_lists)
+    odd_form = env.get_subscriptions_form(env.odd_lists)
+    admin_form = {'descriptions': json.dumps(descriptions)}
+
+    return [
+        (
+            'get_user_subscriptions_cold',
+            env.reset_cache,
+            lambda: subscrip_service.get_user_subscriptions(BENCH_EMAIL)
+        ),
+        (
+            'get_user_subscriptions_warm',
+            None,
+            lambda: subscrip_service.get_user_subscriptions(BENCH_EMAIL)
+        ),
+        (
+            'merge_subscriptions_and_descriptions',
+            None,
+            lambda: util.merge_subscriptions_and_descriptions(
+                subscriptions,
+                descriptions
+            )
+        ),
+        (
+            'get_diff',
+            None,
+            lambda: util.get_diff(subscriptions, new_subscriptions)
+        ),
+        (
+            'subscribe',
+            lambda: check_result(
+                env,
+                subscrip_service.unsubscribe(BENCH_EMAIL, env.odd_lists)
+            ),
+            lambda: check_result(
+                env,
+                subscrip_service.subscribe(BENCH_EMAIL, env.odd_lists)
+            )
+        ),
+        (
+            'unsubscribe',
+            lambda: check_result(
+                env,
+                subscrip_service.subscribe(BENCH_EMAIL, env.odd_lists)
+            ),
+            lambda: check_result(
+                env,
+                subscrip_service.unsubscribe(BENCH_EMAIL, env.odd_lists)
+            )
+        ),
+        (
+            'manage_lists_get',
+            None,
+            lambda: check_status(env, env.client.get(MANAGE_LISTS_URL))
+        ),
+        (
+            'manage_lists_post',
+            lambda: check_status(
+                env,
+                env.client.post(MANAGE_LISTS_URL, data=even_form)
+            ),
+            lambda: check_status(
+                env,
+                env.client.post(MANAGE_LISTS_URL, data=odd_form)
+            )
+        ),
+        (
+            'admin_lists_get',
+            None,
+            lambda: check_status(env, env.client.get(ADMIN_LISTS_URL))
+        ),
+        (
+            'admin_lists_post',
+            None,
+            lambda: check_status(
+                env,
+                env.client.post(ADMIN_LISTS_URL, data=admin_form)
+            )
+        )
+    ]
+
+
+def summarize(samples):
+    """Summarize timing samples in milliseconds.
+
+    @param samples: The measured durations in seconds.
+    @type samples: list of float
+    @return: Dict with min_ms, median_ms, mean_ms, and max_ms.
+    @rtype: dict
+    """
+    ordered = sorted(samples)
+    count = len(ordered)
+    if count % 2:
+        median = ordered[count / 2]
+    else:
+        median = (ordered[count / 2 - 1] + ordered[count / 2]) / 2.0
+
+    return {
+        'min_ms': ordered[0] * 1000,
+        'median_ms': median * 1000,
+        'mean_ms': sum(ordered) / count * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def time_case(env, setup, run, repeat):
+    """Time a benchmark case.
+
+    @return: The timing summary plus the number of SendGrid requests made per
+        timed run.
+    @rtype: dict
+    """
+    samples = []
+    requests = 0
+    for i in range(repeat):
+        if setup:
+            setup()
+        requests_before = env.sendgrid.requests
+        start = time.time()
+        run()
+        samples.append(time.time() - start)
+        check_cache(env)
+        requests += env.sendgrid.requests - requests_before
+
+    result = summarize(samples)
+    result['sendgrid_requests'] = requests / float(repeat)
+    return result
+
+
+def run_benchmarks(list_counts, member_counts, latency=0, repeat=5,
+        case_names=None):
+    """Run the benchmark cases for every list count and member count.
+
+    @param list_counts: The numbers of lists to benchmark with.
+    @type list_counts: list of int
+    @param member_counts: The numbers of members per list to benchmark with.
+    @type member_counts: list of int
+    @param latency: Seconds of simulated SendGrid latency per request.
+    @type latency: float
+    @param repeat: The number of timed runs of each case.
+    @type repeat: int
+    @param case_names: The cases to run, or None for all cases.
+    @type case_names: list of str
+    @return: Dict with the run parameters and one result per case.
+    @rtype: dict
+    """
+    results = []
+    for list_count in list_counts:
+        for member_count in member_counts:
+            env = BenchmarkEnvironment(list_count, member_count, latency)
+            env.start()
+            try:
+                services.subscriptions_service.get_user_subscriptions(
+                    BENCH_EMAIL
+                )
+                for name, setup, run in get_cases(env):
+                    if case_names and name not in case_names:
+                        continue
+
+                    result = time_case(env, setup, run, repeat)
+                    result.update({
+                        'case': name,
+                        'lists': list_count,
+                        'members_per_list': member_count
+                    })
+                    results.append(result)
+            finally:
+                env.stop()
+
+    return {
+        'parameters': {
+            'lists': list_counts,
+            'members_per_list': member_counts,
+            'latency': latency,
+            'repeat': repeat
+        },
+        'results': results
+    }
@@ -1,7 +1,9 @@
 """controllers/__init__.py"""
 
 import descriptions_controller as descriptions_internal
+import metrics_controller as metrics_internal
 import subscriptions_controller as subscriptions_internal
 
 descriptions_controller = descriptions_internal
+metrics_controller = metrics_internal
 subscriptions_controller = subscriptions_internal
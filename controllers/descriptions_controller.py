@@ -37,16 +37,20 @@ def require_admin(target_func):
     return inner_func
 
 
-@blueprint.route('/admin_lists', methods=['GET'])
-@require_admin
-def get_lists():
-    """Get the subscription lists information."""
-    descriptions = services.descriptions_service.get_descriptions()
-    subscriptions = services.subscriptions_service.get_lists()
-
-    if not descriptions:
-        descriptions = {}
-
+def get_admin_lists(subscriptions, descriptions):
+    """Build the admin table of every SendGrid list and its description.
+
+    @param subscriptions: The names of every SendGrid list.
+    @type subscriptions: iterable over str
+    @param descriptions: The list descriptions, see get_descriptions.
+    @type descriptions: dict
+    @return: Dicts of the form {
+        'name': 'listname',
+        'description': 'description or empty',
+        'is_managed': True if the list is available for subscription
+    }
+    @rtype: list of dicts
+    """
     lists = []
     for listname in subscriptions:
         description_item = descriptions.get(listname, None)
@@ -59,6 +63,22 @@ def get_lists():
             'description': description,
             'is_managed': description_item != None
         })
+    return lists
+
+
+@blueprint.route('/admin_lists', methods=['GET'])
+@require_admin
+def get_lists():
+    """Get the subscription lists information.
+
+    Responds with 304 if the client's copy is current (see page_cache).
+    """
+    version, descriptions = \
+        services.descriptions_service.get_versioned_descriptions()
+    subscriptions = services.subscriptions_service.get_lists()
+
+    if not descriptions:
+        descriptions = {}
 
     configuration = services.util.get_app_config()
     temp_vals = services.config_layer.get_common_template_vals()
@@ -67,17 +87,28 @@ def get_lists():
         'tinysubscriptions_base.html'
     )
 
-    return flask.render_template(
-        'admin_chrome.html',
-        base_url=configuration['BASE_URL'],
-        app_title='Subscription Admin Center',
-        base_static_url=configuration['BASE_STATIC_URL'],
-        lists=lists,
-        base_static_folder=configuration['BASE_STATIC_URL'],
-        parent_template=parent_template,
-        **temp_vals
+    etag = services.page_cache.compute_etag(
+        ['admin_chrome.html', parent_template],
+        'admin_lists',
+        subscriptions,
+        version or descriptions,
+        temp_vals
     )
 
+    def render():
+        return flask.render_template(
+            'admin_chrome.html',
+            base_url=configuration['BASE_URL'],
+            app_title='Subscription Admin Center',
+            base_static_url=configuration['BASE_STATIC_URL'],
+            lists=get_admin_lists(subscriptions, descriptions),
+            base_static_folder=configuration['BASE_STATIC_URL'],
+            parent_template=parent_template,
+            **temp_vals
+        )
+
+    return services.page_cache.respond(etag, render)
+
 
 @blueprint.route('/admin_lists', methods=['POST'])
 @require_admin
@@ -90,3 +121,53 @@ def update_lists():
     new_descriptions = json.loads(flask.request.form.get('descriptions'))
     services.descriptions_service.update_descriptions(new_descriptions)
     return 'success', 200
+
+
+@blueprint.route('/api/admin_lists', methods=['GET', 'PUT'])
+@require_admin
+def admin_lists_api():
+    """JSON version of admin_lists for API clients.
+
+    GET responds with the admin table, see get_admin_lists. PUT expects a
+    JSON body of the form {"descriptions": {...}} as posted by admin_lists
+    and responds with {"status": "success"}.
+    """
+    json_api = services.json_api
+    if flask.request.method == 'PUT':
+        new_descriptions = json_api.get_json_body().get('descriptions', None)
+        if not isinstance(new_descriptions, dict):
+            return 'Expected {"descriptions": {...}}', 400
+
+        services.descriptions_service.update_descriptions(new_descriptions)
+        return json_api.make_json_response({'status': 'success'})
+
+    descriptions = services.descriptions_service.get_descriptions() or {}
+    subscriptions = services.subscriptions_service.get_lists()
+    return json_api.make_json_response(
+        get_admin_lists(subscriptions, descriptions)
+    )
+
+
+@blueprint.route('/admin_lists/export', methods=['GET'])
+@require_admin
+def export_lists():
+    """Stream the members of one or every list as CSV or NDJSON.
+
+    Query parameters: list (repeatable, defaults to every list) and format
+    ("csv", the default, or "ndjson").
+    """
+    export_service = services.export_service
+    export_format = flask.request.args.get('format', export_service.CSV_FORMAT)
+    if export_format not in export_service.CONTENT_TYPES:
+        return 'Unknown format %s' % export_format, 400
+
+    listnames = flask.request.args.getlist('list') or None
+    chunks = export_service.export_members(listnames, export_format)
+
+    response = flask.Response(
+        flask.stream_with_context(chunks),
+        mimetype=export_service.CONTENT_TYPES[export_format]
+    )
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=members.%s' % export_format
+    return response
@@ -35,14 +35,15 @@ class DescriptionsControllerTests(mox.MoxTestBase):
         app = tiny_subscriptions.get_app()
         app.debug = True
         self.app = app.test_client()
+        self.stubs.Set(services.page_cache, 'get_page_cache', lambda: None)
 
     def test_get_lists(self):
         self.mox.StubOutWithMock(
-            services.descriptions_service, 'get_descriptions')
+            services.descriptions_service, 'get_versioned_descriptions')
         self.mox.StubOutWithMock(services.subscriptions_service, 'get_lists')
 
-        services.descriptions_service.get_descriptions().AndReturn(
-            TEST_DESCRIPTIONS)
+        services.descriptions_service.get_versioned_descriptions().AndReturn(
+            ('version0', TEST_DESCRIPTIONS))
         services.subscriptions_service.get_lists().AndReturn(TEST_SUBSCRIPTIONS)
 
         self.mox.ReplayAll()
@@ -54,6 +55,46 @@ class DescriptionsControllerTests(mox.MoxTestBase):
         self.assertTrue('name3' in result.data)
         self.assertTrue('name2' not in result.data)
 
+    def test_admin_lists_api_get(self):
+        self.mox.StubOutWithMock(
+            services.descriptions_service, 'get_descriptions')
+        self.mox.StubOutWithMock(services.subscriptions_service, 'get_lists')
+
+        services.descriptions_service.get_descriptions().AndReturn(
+            TEST_DESCRIPTIONS)
+        services.subscriptions_service.get_lists().AndReturn(TEST_SUBSCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        result = self.app.get(
+            '/mailing/api/admin_lists',
+            headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(200, result.status_code)
+        self.assertTrue('Accept-Encoding' in result.headers.get('Vary'))
+        lists = json.loads(result.data)
+        self.assertEqual(
+            ['name0', 'name1', 'name3'],
+            [x['name'] for x in lists]
+        )
+        self.assertFalse(lists[2]['is_managed'])
+
+    def test_admin_lists_api_put(self):
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'update_descriptions'
+        )
+        services.descriptions_service.update_descriptions(TEST_DESCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        result = self.app.put(
+            '/mailing/api/admin_lists',
+            data=json.dumps({'descriptions': TEST_DESCRIPTIONS}),
+            content_type='application/json'
+        )
+        self.assertEqual(200, result.status_code)
+
     def test_update_lists(self):
         self.mox.StubOutWithMock(
             services.descriptions_service,
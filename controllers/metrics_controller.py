@@ -0,0 +1,68 @@
+"""Controller exposing the application metrics for scraping.
+
+@license: GNU GPLv3
+"""
+import time
+
+import flask
+
+# Optimally, it would be nice to have "is_module" controlled by the configs, but
+# they may not be available when this module is imported.
+is_module = True
+
+try:
+    from tinysubscriptions import services
+except:
+    from .. import services
+    is_module = False
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+blueprint = flask.Blueprint(
+    'metrics',
+    __name__,
+    **services.util.get_template_folders(is_module)
+)
+
+
+def start_request_timer():
+    flask.g.metrics_request_start = time.time()
+
+
+def observe_request(response):
+    start = getattr(flask.g, 'metrics_request_start', None)
+    if start is not None:
+        services.metrics.HTTP_REQUEST_SECONDS.observe(
+            time.time() - start,
+            endpoint=flask.request.endpoint,
+            method=flask.request.method,
+            status=response.status_code
+        )
+    return response
+
+
+def track_blueprint(target_blueprint):
+    """Record the latency of every request served by a blueprint.
+
+    Must be called before the blueprint is registered with the app.
+
+    @param target_blueprint: The blueprint to track.
+    @type target_blueprint: flask.Blueprint
+    """
+    target_blueprint.before_request(start_request_timer)
+    target_blueprint.after_request(observe_request)
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Render the metrics in the Prometheus text exposition format.
+
+    Only available if the METRICS_ENABLED config is True.
+    """
+    if not services.util.get_app_config().get('METRICS_ENABLED', False):
+        flask.abort(404)
+
+    return flask.Response(
+        services.metrics.render_all(),
+        mimetype=CONTENT_TYPE
+    )
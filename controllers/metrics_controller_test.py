@@ -0,0 +1,41 @@
+"""Tests for metrics_controller
+
+@license: GNU GPLv3
+"""
+import mox
+
+try:
+    from tinysubscriptions import tiny_subscriptions
+    from tinysubscriptions import services
+except:
+    import tiny_subscriptions
+    import services
+
+
+class MetricsControllerTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        app = tiny_subscriptions.get_app()
+        app.debug = True
+        self.app = app.test_client()
+        self.mox.StubOutWithMock(services.util, 'get_app_config')
+
+    def test_get_metrics(self):
+        services.util.get_app_config().AndReturn({'METRICS_ENABLED': True})
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/mailing/metrics')
+        self.assertEqual(200, result.status_code)
+        self.assertTrue(
+            'tinysubscriptions_sendgrid_request_seconds' in result.data
+        )
+
+    def test_get_metrics_disabled(self):
+        services.util.get_app_config().AndReturn({})
+
+        self.mox.ReplayAll()
+
+        result = self.app.get('/mailing/metrics')
+        self.assertEqual(404, result.status_code)
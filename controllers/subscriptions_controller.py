@@ -23,6 +23,8 @@ NEG_DIFF_KEY = services.util.NEG_DIFF_KEY
 
 APP_TITLE = 'Subscription Center'
 
+DEFAULT_STATUS_BATCH_SIZE = 5000
+
 blueprint = flask.Blueprint(
     'subscriptions',
     __name__,
@@ -30,7 +32,7 @@ blueprint = flask.Blueprint(
 )
 
 
-@blueprint.route('/manage_lists', methods=['GET', 'POST'])
+@blueprint.route('/manage_lists', methods=['GET', 'POST', 'PATCH'])
 def manage_lists():
     email = flask.request.args.get('email', None)
     if not email:
@@ -40,17 +42,23 @@ def manage_lists():
         return get_lists(email)
     elif flask.request.method == 'POST':
         return update_lists(email)
+    elif flask.request.method == 'PATCH':
+        return patch_lists(email)
 
 
 def get_lists(email):
-    """Render controls to change what lists a user is subscribed to."""
-    subscriptions = services.subscriptions_service.get_user_subscriptions(email)
-    descriptions = services.descriptions_service.get_descriptions()
+    """Render controls to change what lists a user is subscribed to.
 
-    subscriptions = services.util.merge_subscriptions_and_descriptions(
-        subscriptions,
-        descriptions
-    )
+    Responds with 304 if the client's copy is current (see page_cache).
+    """
+    try:
+        subscriptions = services.subscriptions_service.get_user_subscriptions(
+            email
+        )
+    except services.sendgrid_client.SendGridUnavailableError:
+        return 'Subscriptions are temporarily unavailable', 503
+    version, descriptions = \
+        services.descriptions_service.get_versioned_descriptions()
 
     configuration = services.util.get_app_config()
     temp_vals = services.config_layer.get_common_template_vals()
@@ -59,35 +67,281 @@ def get_lists(email):
         'tinysubscriptions_base.html'
     )
 
-    return flask.render_template(
-        'mailing_chrome.html',
-        base_url=configuration['BASE_URL'],
-        app_title=APP_TITLE,
-        email=email,
-        lists=subscriptions,
-        base_static_folder=configuration['BASE_STATIC_URL'],
-        parent_template=base_template,
-        **temp_vals
+    etag = services.page_cache.compute_etag(
+        ['mailing_chrome.html', base_template],
+        'manage_lists',
+        email,
+        sorted(subscriptions),
+        version or descriptions,
+        temp_vals
     )
 
+    def render():
+        lists = services.util.merge_subscriptions_and_descriptions(
+            subscriptions,
+            descriptions
+        )
+        return flask.render_template(
+            'mailing_chrome.html',
+            base_url=configuration['BASE_URL'],
+            app_title=APP_TITLE,
+            email=email,
+            lists=lists,
+            base_static_folder=configuration['BASE_STATIC_URL'],
+            parent_template=base_template,
+            **temp_vals
+        )
+
+    return services.page_cache.respond(etag, render)
+
 
 def update_lists(email):
-    """Updates the user list subscriptions."""
-    subscrip_service = services.subscriptions_service
+    """Updates the user list subscriptions.
 
-    old_subscriptions = subscrip_service.get_user_subscriptions(email)
+    On failure, responds with a JSON report of which lists succeeded and
+    failed.
+    """
     new_subscriptions = json.loads(flask.request.form.get('subscriptions'))
 
+    status_code, report = change_subscriptions(email, new_subscriptions)
+    if report:
+        return json.dumps(report), status_code
+    return 'success', status_code
+
+
+def patch_lists(email):
+    """Subscribes to and unsubscribes from only the lists a user toggled.
+
+    Expects a JSON body of the form {"add": [...], "remove": [...]}. Unlike
+    update_lists, the user's current subscriptions are not read or diffed.
+    On failure, responds with a JSON report of which lists succeeded and
+    failed.
+    """
+    changes = read_subscription_changes()
+    if isinstance(changes, basestring):
+        return changes, 400
+
+    status_code, report = apply_subscription_changes(email, *changes)
+    if report:
+        return json.dumps(report), status_code
+    return 'success', status_code
+
+
+def read_subscription_changes():
+    """Read and validate the add / remove sets of a PATCH request body.
+
+    Lists may only be changed if they have a description, as only those are
+    offered to users.
+
+    @return: Tuple of (lists to subscribe to, lists to unsubscribe from) as
+        sets, or an error message if the body is invalid.
+    @rtype: tuple or str
+    """
+    body = services.json_api.get_json_body()
+    changes = []
+    for key in ['add', 'remove']:
+        names = body.get(key, [])
+        if not isinstance(names, list) or \
+                not all(isinstance(x, basestring) for x in names):
+            return 'Expected {"add": [...], "remove": [...]}'
+        changes.append(set(names))
+    added, removed = changes
+
+    if added & removed:
+        return 'Lists both added and removed: %s' % \
+            ', '.join(sorted(added & removed))
+
+    descriptions = services.descriptions_service.get_descriptions() or {}
+    unknown = set(
+        x for x in added | removed if x == '_id' or x not in descriptions
+    )
+    if unknown:
+        return 'Unknown lists: %s' % ', '.join(sorted(unknown))
+
+    return added, removed
+
+
+def change_subscriptions(email, new_subscriptions):
+    """Change a user's subscriptions to a new set of lists.
+
+    The changes are applied with apply_subscription_changes.
+
+    @param email: email address corresponding to a user
+    @type email: str
+    @param new_subscriptions: The lists the user should be subscribed to, as
+        accepted by util.get_diff.
+    @type new_subscriptions: list of str or dict of dicts
+    @return: Tuple of (HTTP status code, None or on failure a report of the
+        form SubscriptionResult.to_dict, or {"error": "..."} with a 503 if the
+        user's current subscriptions could not be read)
+    @rtype: tuple
+    """
+    subscrip_service = services.subscriptions_service
+
+    try:
+        old_subscriptions = subscrip_service.get_user_subscriptions(email)
+    except services.sendgrid_client.SendGridUnavailableError:
+        return 503, {'error': 'Subscriptions are temporarily unavailable'}
+
     diff = services.util.get_diff(old_subscriptions, new_subscriptions)
 
-    if len(diff[POS_DIFF_KEY]) > 0:
-        response = subscrip_service.subscribe(email, diff[POS_DIFF_KEY])
-        if response.status_code != 200:
-            return response.text, response.status_code
+    return apply_subscription_changes(
+        email,
+        diff[POS_DIFF_KEY],
+        diff[NEG_DIFF_KEY]
+    )
+
+
+def apply_subscription_changes(email, added, removed):
+    """Subscribe a user to and unsubscribe them from lists.
 
-    if len(diff[NEG_DIFF_KEY]) > 0:
-        response = subscrip_service.unsubscribe(email, diff[NEG_DIFF_KEY])
-        if response.status_code != 200:
-            return response.text, response.status_code
+    Subscriptions and unsubscriptions are sent to SendGrid concurrently. In
+    write-behind mode the changes are instead queued for SendGrid and applied
+    to the cache right away. Adding a list the user is already subscribed to
+    (or removing one they are not) is harmless.
 
-    return 'success', 200
+    @param email: email address corresponding to a user
+    @type email: str
+    @param added: The lists to subscribe the user to.
+    @type added: iterable over str
+    @param removed: The lists to unsubscribe the user from.
+    @type removed: iterable over str
+    @return: Tuple of (HTTP status code, None or on failure a report of the
+        form SubscriptionResult.to_dict)
+    @rtype: tuple
+    """
+    if len(added) == 0 and len(removed) == 0:
+        return 200, None
+
+    if services.write_behind.is_enabled():
+        services.write_behind.enqueue_changes(email, added, removed)
+        return 202, None
+
+    result = services.subscriptions_service.update_subscriptions(
+        email,
+        added,
+        removed
+    )
+    if not result.is_success():
+        return result.get_status_code(), result.to_dict()
+
+    return 200, None
+
+
+@blueprint.route('/api/subscriptions', methods=['GET', 'PUT', 'PATCH'])
+def subscriptions_api():
+    """JSON version of manage_lists for API clients.
+
+    GET responds with the user's lists merged with their descriptions:
+    {"listname": {"description": "...", "subscribed": true}, ...}.
+
+    PUT expects a JSON body of the form {"subscriptions": [...]} listing
+    every list the user should be subscribed to (or a dict in the GET
+    format) and responds with {"status": "success"}, {"status": "queued"} in
+    write-behind mode, or the failure report of manage_lists.
+
+    PATCH expects a JSON body of the form {"add": [...], "remove": [...]}
+    with only the lists to change and responds as PUT.
+    """
+    email = flask.request.args.get('email', None)
+    if not email:
+        return 'No email provied', 404
+
+    json_api = services.json_api
+    if flask.request.method == 'PUT':
+        new_subscriptions = json_api.get_json_body().get('subscriptions', None)
+        if not isinstance(new_subscriptions, (list, dict)):
+            return 'Expected {"subscriptions": [...]}', 400
+
+        status_code, report = change_subscriptions(email, new_subscriptions)
+        return make_change_response(status_code, report)
+
+    if flask.request.method == 'PATCH':
+        changes = read_subscription_changes()
+        if isinstance(changes, basestring):
+            return changes, 400
+
+        status_code, report = apply_subscription_changes(email, *changes)
+        return make_change_response(status_code, report)
+
+    try:
+        subscriptions = services.subscriptions_service.get_user_subscriptions(
+            email
+        )
+    except services.sendgrid_client.SendGridUnavailableError:
+        return 'Subscriptions are temporarily unavailable', 503
+    descriptions = services.descriptions_service.get_descriptions()
+
+    return json_api.make_json_response(
+        services.util.merge_subscriptions_and_descriptions(
+            subscriptions,
+            descriptions
+        )
+    )
+
+
+def make_change_response(status_code, report):
+    """Respond to a subscription change made through the API.
+
+    @param status_code: The status code of the change.
+    @type status_code: int
+    @param report: None or on failure a report of the form
+        SubscriptionResult.to_dict
+    @type report: dict
+    @return: The JSON response.
+    @rtype: flask.Response
+    """
+    json_api = services.json_api
+    if report:
+        return json_api.make_json_response(report, status_code)
+    if status_code == 202:
+        return json_api.make_json_response({'status': 'queued'}, 202)
+    return json_api.make_json_response({'status': 'success'})
+
+
+@blueprint.route('/subscription_statuses', methods=['POST'])
+def get_subscription_statuses():
+    """Get the subscriptions of many users at once as JSON.
+
+    Only available to admins. Expects a JSON body of the form
+    {"emails": ["email 0", ...]} with at most STATUS_BATCH_SIZE (default 5000)
+    emails and responds with each email's lists merged with their
+    descriptions, as rendered by manage_lists: {
+        "email 0": {
+            "listname": {"description": "...", "subscribed": true},
+            ...
+        },
+        ...
+    }
+    """
+    if not services.config_layer.cur_user_is_admin():
+        flask.abort(403)
+
+    emails = services.json_api.get_json_body().get('emails', None)
+    if not isinstance(emails, list) or \
+            not all(isinstance(x, basestring) for x in emails):
+        return 'Expected {"emails": [...]}', 400
+
+    max_emails = config_layer.get_config().get(
+        'STATUS_BATCH_SIZE',
+        DEFAULT_STATUS_BATCH_SIZE
+    )
+    if len(emails) > max_emails:
+        return 'At most %d emails per request' % max_emails, 400
+
+    try:
+        subscriptions = services.subscriptions_service.get_users_subscriptions(
+            emails
+        )
+    except services.sendgrid_client.SendGridUnavailableError:
+        return 'Subscriptions are temporarily unavailable', 503
+    descriptions = services.descriptions_service.get_descriptions()
+
+    statuses = dict(
+        (email, services.util.merge_subscriptions_and_descriptions(
+            subscriptions[email],
+            descriptions
+        ))
+        for email in emails
+    )
+    return services.json_api.make_json_response(statuses)
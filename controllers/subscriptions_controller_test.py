@@ -63,6 +63,7 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
         app = tiny_subscriptions.get_app()
         app.debug = True
         self.app = app.test_client()
+        self.stubs.Set(services.page_cache, 'get_page_cache', lambda: None)
 
     def test_manage_lists_get(self):
         self.mox.StubOutWithMock(
@@ -71,7 +72,7 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
         )
         self.mox.StubOutWithMock(
             services.descriptions_service,
-            'get_descriptions'
+            'get_versioned_descriptions'
         )
         self.mox.StubOutWithMock(
             services.util,
@@ -80,8 +81,8 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
 
         services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
             .AndReturn(TEST_SUBSCRIPTIONS)
-        services.descriptions_service.get_descriptions() \
-            .AndReturn(TEST_DESCRIPTIONS)
+        services.descriptions_service.get_versioned_descriptions() \
+            .AndReturn(('version0', TEST_DESCRIPTIONS))
         services.util.merge_subscriptions_and_descriptions(
             TEST_SUBSCRIPTIONS,
             TEST_DESCRIPTIONS
@@ -97,20 +98,86 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
         self.assertTrue('description1' in result.data)
         self.assertTrue('name2' in result.data)
         self.assertTrue('description2' in result.data)
+        self.assertTrue(result.headers.get('ETag'))
+
+    def test_manage_lists_get_not_modified(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_versioned_descriptions'
+        )
+
+        for i in range(2):
+            services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+                .AndReturn(TEST_SUBSCRIPTIONS)
+            services.descriptions_service.get_versioned_descriptions() \
+                .AndReturn(('version0', TEST_DESCRIPTIONS))
+
+        self.mox.ReplayAll()
+
+        etag = self.app.get(TEST_MANAGE_LISTS_URL).headers['ETag']
+        result = self.app.get(
+            TEST_MANAGE_LISTS_URL,
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(304, result.status_code)
+        self.assertEqual('', result.data)
 
     def test_manage_lists_post(self):
+        result = services.subscriptions_service.SubscriptionResult()
+        result.add_success('name2')
+        result.add_success('name1')
+
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+        self.mox.StubOutWithMock(services.util, 'get_diff')
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'update_subscriptions'
+        )
 
-        class FakeResponse:
-            status_code = 200
-            text = 'test response'
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndReturn(TEST_SUBSCRIPTIONS)
+        services.util.get_diff(
+            TEST_SUBSCRIPTIONS,
+            TEST_NEW_LISTS
+        ).AndReturn(TEST_DIFF)
+        services.write_behind.is_enabled().AndReturn(False)
+        services.subscriptions_service.update_subscriptions(
+            TEST_EMAIL,
+            TEST_NEW_SUBSCR,
+            TEST_DEL_SUBSCR
+        ).AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        result = self.app.post(
+            TEST_MANAGE_LISTS_URL,
+            data=dict(subscriptions = json.dumps(TEST_NEW_LISTS))
+        )
+        self.assertEqual(200, result.status_code)
+
+    def test_manage_lists_post_failure(self):
+        result = services.subscriptions_service.SubscriptionResult()
+        result.add_success('name2')
+        result.add_failure('name1', 500, 'test failure')
 
         self.mox.StubOutWithMock(
             services.subscriptions_service,
             'get_user_subscriptions'
         )
         self.mox.StubOutWithMock(services.util, 'get_diff')
-        self.mox.StubOutWithMock(services.subscriptions_service, 'subscribe')
-        self.mox.StubOutWithMock(services.subscriptions_service, 'unsubscribe')
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'update_subscriptions'
+        )
 
         services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
             .AndReturn(TEST_SUBSCRIPTIONS)
@@ -118,14 +185,63 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
             TEST_SUBSCRIPTIONS,
             TEST_NEW_LISTS
         ).AndReturn(TEST_DIFF)
-        services.subscriptions_service.subscribe(
+        services.write_behind.is_enabled().AndReturn(False)
+        services.subscriptions_service.update_subscriptions(
             TEST_EMAIL,
-            TEST_NEW_SUBSCR
-        ).AndReturn(FakeResponse())
-        services.subscriptions_service.unsubscribe(
+            TEST_NEW_SUBSCR,
+            TEST_DEL_SUBSCR
+        ).AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        result = self.app.post(
+            TEST_MANAGE_LISTS_URL,
+            data=dict(subscriptions = json.dumps(TEST_NEW_LISTS))
+        )
+        self.assertEqual(500, result.status_code)
+        report = json.loads(result.data)
+        self.assertEqual(['name2'], report['succeeded'])
+        self.assertTrue('name1' in report['failed'])
+
+    def test_manage_lists_post_unavailable(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndRaise(services.sendgrid_client.SendGridUnavailableError())
+
+        self.mox.ReplayAll()
+
+        result = self.app.post(
+            TEST_MANAGE_LISTS_URL,
+            data=dict(subscriptions = json.dumps(TEST_NEW_LISTS))
+        )
+        self.assertEqual(503, result.status_code)
+        self.assertTrue('error' in json.loads(result.data))
+
+    def test_manage_lists_post_write_behind(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+        self.mox.StubOutWithMock(services.util, 'get_diff')
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(services.write_behind, 'enqueue_changes')
+
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndReturn(TEST_SUBSCRIPTIONS)
+        services.util.get_diff(
+            TEST_SUBSCRIPTIONS,
+            TEST_NEW_LISTS
+        ).AndReturn(TEST_DIFF)
+        services.write_behind.is_enabled().AndReturn(True)
+        services.write_behind.enqueue_changes(
             TEST_EMAIL,
+            TEST_NEW_SUBSCR,
             TEST_DEL_SUBSCR
-        ).AndReturn(FakeResponse())
+        )
 
         self.mox.ReplayAll()
 
@@ -133,4 +249,230 @@ class SubscriptionsControllerTests(mox.MoxTestBase):
             TEST_MANAGE_LISTS_URL,
             data=dict(subscriptions = json.dumps(TEST_NEW_LISTS))
         )
+        self.assertEqual(202, result.status_code)
+
+    def test_subscription_statuses(self):
+        self.mox.StubOutWithMock(services.config_layer, 'cur_user_is_admin')
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_users_subscriptions'
+        )
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_descriptions'
+        )
+
+        services.config_layer.cur_user_is_admin().AndReturn(True)
+        services.subscriptions_service.get_users_subscriptions(
+            [TEST_EMAIL, 'other@example.com']
+        ).AndReturn({
+            TEST_EMAIL: TEST_SUBSCRIPTIONS,
+            'other@example.com': []
+        })
+        services.descriptions_service.get_descriptions().AndReturn(
+            TEST_DESCRIPTIONS
+        )
+
+        self.mox.ReplayAll()
+
+        result = self.app.post(
+            'mailing/subscription_statuses',
+            data=json.dumps({'emails': [TEST_EMAIL, 'other@example.com']}),
+            content_type='application/json'
+        )
         self.assertEqual(200, result.status_code)
+        statuses = json.loads(result.data)
+        self.assertEqual(TEST_LISTS, statuses[TEST_EMAIL])
+        self.assertFalse(statuses['other@example.com']['name0']['subscribed'])
+
+    def test_subscription_statuses_requires_admin(self):
+        self.mox.StubOutWithMock(services.config_layer, 'cur_user_is_admin')
+        services.config_layer.cur_user_is_admin().AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        result = self.app.post(
+            'mailing/subscription_statuses',
+            data=json.dumps({'emails': [TEST_EMAIL]}),
+            content_type='application/json'
+        )
+        self.assertEqual(403, result.status_code)
+
+    def test_subscriptions_api_get(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_descriptions'
+        )
+
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndReturn(TEST_SUBSCRIPTIONS)
+        services.descriptions_service.get_descriptions() \
+            .AndReturn(TEST_DESCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        result = self.app.get(
+            'mailing/api/subscriptions?email=%s' % TEST_EMAIL
+        )
+        self.assertEqual(200, result.status_code)
+        self.assertEqual('application/json', result.mimetype)
+        self.assertEqual(TEST_LISTS, json.loads(result.data))
+        self.assertTrue(result.headers.get('ETag'))
+
+    def test_subscriptions_api_put(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'update_subscriptions'
+        )
+        result = services.subscriptions_service.SubscriptionResult()
+        result.add_success('name2')
+        result.add_success('name1')
+
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndReturn(TEST_SUBSCRIPTIONS)
+        services.write_behind.is_enabled().AndReturn(False)
+        services.subscriptions_service.update_subscriptions(
+            TEST_EMAIL,
+            set(['name2']),
+            set(['name1', 'name3'])
+        ).AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        response = self.app.put(
+            'mailing/api/subscriptions?email=%s' % TEST_EMAIL,
+            data=json.dumps({'subscriptions': ['name0', 'name2']}),
+            content_type='application/json'
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'status': 'success'}, json.loads(response.data))
+
+    def test_subscriptions_api_put_unavailable(self):
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'get_user_subscriptions'
+        )
+
+        services.subscriptions_service.get_user_subscriptions(TEST_EMAIL) \
+            .AndRaise(services.sendgrid_client.SendGridUnavailableError())
+
+        self.mox.ReplayAll()
+
+        response = self.app.put(
+            'mailing/api/subscriptions?email=%s' % TEST_EMAIL,
+            data=json.dumps({'subscriptions': ['name0', 'name2']}),
+            content_type='application/json'
+        )
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(
+            {'error': 'Subscriptions are temporarily unavailable'},
+            json.loads(response.data)
+        )
+
+    def test_subscriptions_api_put_invalid(self):
+        self.mox.ReplayAll()
+
+        response = self.app.put(
+            'mailing/api/subscriptions?email=%s' % TEST_EMAIL,
+            data=json.dumps({'subscriptions': 'name0'}),
+            content_type='application/json'
+        )
+        self.assertEqual(400, response.status_code)
+
+    def test_manage_lists_patch(self):
+        result = services.subscriptions_service.SubscriptionResult()
+        result.add_success('name2')
+        result.add_success('name1')
+
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_descriptions'
+        )
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(
+            services.subscriptions_service,
+            'update_subscriptions'
+        )
+
+        services.descriptions_service.get_descriptions() \
+            .AndReturn(TEST_DESCRIPTIONS)
+        services.write_behind.is_enabled().AndReturn(False)
+        services.subscriptions_service.update_subscriptions(
+            TEST_EMAIL,
+            set(TEST_NEW_SUBSCR),
+            set(TEST_DEL_SUBSCR)
+        ).AndReturn(result)
+
+        self.mox.ReplayAll()
+
+        response = self.app.patch(
+            TEST_MANAGE_LISTS_URL,
+            data=json.dumps({'add': TEST_NEW_SUBSCR, 'remove': TEST_DEL_SUBSCR}),
+            content_type='application/json'
+        )
+        self.assertEqual(200, response.status_code)
+
+    def test_manage_lists_patch_unknown_list(self):
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_descriptions'
+        )
+
+        services.descriptions_service.get_descriptions() \
+            .AndReturn(TEST_DESCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        response = self.app.patch(
+            TEST_MANAGE_LISTS_URL,
+            data=json.dumps({'add': ['name3'], 'remove': []}),
+            content_type='application/json'
+        )
+        self.assertEqual(400, response.status_code)
+        self.assertTrue('name3' in response.data)
+
+    def test_manage_lists_patch_add_and_remove(self):
+        self.mox.ReplayAll()
+
+        response = self.app.patch(
+            TEST_MANAGE_LISTS_URL,
+            data=json.dumps({'add': ['name0'], 'remove': ['name0']}),
+            content_type='application/json'
+        )
+        self.assertEqual(400, response.status_code)
+
+    def test_subscriptions_api_patch_write_behind(self):
+        self.mox.StubOutWithMock(
+            services.descriptions_service,
+            'get_descriptions'
+        )
+        self.mox.StubOutWithMock(services.write_behind, 'is_enabled')
+        self.mox.StubOutWithMock(services.write_behind, 'enqueue_changes')
+
+        services.descriptions_service.get_descriptions() \
+            .AndReturn(TEST_DESCRIPTIONS)
+        services.write_behind.is_enabled().AndReturn(True)
+        services.write_behind.enqueue_changes(
+            TEST_EMAIL,
+            set(TEST_NEW_SUBSCR),
+            set()
+        )
+
+        self.mox.ReplayAll()
+
+        response = self.app.patch(
+            'mailing/api/subscriptions?email=%s' % TEST_EMAIL,
+            data=json.dumps({'add': TEST_NEW_SUBSCR}),
+            content_type='application/json'
+        )
+        self.assertEqual(202, response.status_code)
+        self.assertEqual({'status': 'queued'}, json.loads(response.data))
@@ -0,0 +1,54 @@
+"""Command line job that exports the members of mailing lists.
+
+Streams the members of one or every list as CSV or NDJSON, reading the
+membership cache incrementally so memory use does not grow with list size.
+
+@license: GNU GPLv3
+"""
+import argparse
+import sys
+
+import tiny_subscriptions
+import services
+
+
+def main():
+    export_service = services.export_service
+    parser = argparse.ArgumentParser(
+        description='Export the members of mailing lists.'
+    )
+    parser.add_argument(
+        '--list',
+        action='append',
+        dest='lists',
+        default=None,
+        help='List to export; repeat for several (default: every list).'
+    )
+    parser.add_argument(
+        '--format',
+        choices=sorted(export_service.CONTENT_TYPES.keys()),
+        default=export_service.CSV_FORMAT,
+        help='Output format (default: %(default)s).'
+    )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='File to write to (default: standard output).'
+    )
+    args = parser.parse_args()
+
+    tiny_subscriptions.initialize_standalone()
+    chunks = export_service.export_members(args.lists, args.format)
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    else:
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Benchmarks of the subscription hot paths.
+
+Runs every benchmark case against a local fake SendGrid server and an
+in-memory Redis stand-in for each combination of list count and members per
+list, writing the timings as JSON.
+
+@license: GNU GPLv3
+"""
+import argparse
+import json
+
+import tiny_subscriptions
+
+from benchmarks import hot_paths
+
+
+def parse_int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the subscription hot paths.'
+    )
+    parser.add_argument(
+        '--lists',
+        type=parse_int_list,
+        default=[10, 100],
+        help='Comma separated numbers of lists (default: 10,100).'
+    )
+    parser.add_argument(
+        '--members',
+        type=parse_int_list,
+        default=[100, 1000],
+        help='Comma separated numbers of members per list (default: 100,1000).'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='Seconds of simulated SendGrid latency per request (default: 0).'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Timed runs of each case (default: 5).'
+    )
+    parser.add_argument(
+        '--cases',
+        default=None,
+        help='Comma separated names of the cases to run (default: all).'
+    )
+    parser.add_argument(
+        '--output',
+        default='bench_output.txt',
+        help='File to write the JSON results to (default: bench_output.txt).'
+    )
+    args = parser.parse_args()
+
+    tiny_subscriptions.initialize_standalone()
+
+    case_names = None
+    if args.cases:
+        case_names = args.cases.split(',')
+
+    results = hot_paths.run_benchmarks(
+        args.lists,
+        args.members,
+        latency=args.latency,
+        repeat=args.repeat,
+        case_names=case_names
+    )
+
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
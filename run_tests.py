@@ -1,8 +1,20 @@
 import unittest
 
+from services.cache_serializer_test import *
+from services.concurrent_sendgrid_test import *
+from services.descriptions_service_test import *
+from services.export_service_test import *
+from services.json_api_test import *
+from services.membership_cache_test import *
+from services.metrics_test import *
+from services.sendgrid_client_test import *
+from services.subscriptions_service_test import *
+from services.sync_service_test import *
 from services.util_test import *
+from services.write_behind_test import *
 
 from controllers.descriptions_controller_test import *
+from controllers.metrics_controller_test import *
 from controllers.subscriptions_controller_test import *
 
 def setup_tests():
@@ -1,9 +1,29 @@
 """services/__init__.py"""
 
+import cache_serializer as cache_serializer_int
+import concurrent_sendgrid as concurrent_sendgrid_int
 import descriptions_service as descriptions_service_int
+import export_service as export_service_int
+import json_api as json_api_int
+import membership_cache as membership_cache_int
+import metrics as metrics_int
+import page_cache as page_cache_int
+import sendgrid_client as sendgrid_client_int
 import subscriptions_service as subscriptions_service_int
+import sync_service as sync_service_int
 import util as util_int
+import write_behind as write_behind_int
 
+cache_serializer = cache_serializer_int
+concurrent_sendgrid = concurrent_sendgrid_int
 descriptions_service = descriptions_service_int
+export_service = export_service_int
+json_api = json_api_int
+membership_cache = membership_cache_int
+metrics = metrics_int
+page_cache = page_cache_int
+sendgrid_client = sendgrid_client_int
 subscriptions_service = subscriptions_service_int
+sync_service = sync_service_int
 util = util_int
+write_behind = write_behind_int
@@ -0,0 +1,136 @@
+"""Serialization of values stored by redis_cached.
+
+Values are written with the serializer named by the CACHE_SERIALIZER config
+and compressed with zlib when larger than CACHE_COMPRESS_THRESHOLD bytes.
+Encoded values carry a tag naming their format so that entries written in
+another format, including untagged JSON from before tags were introduced, stay
+readable while the configs are rolled out.
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import config_layer
+
+# Starts every tagged value. JSON text never starts with a NUL byte.
+TAG_MARKER = '\x00'
+COMPRESSED_FLAG = 'z'
+PLAIN_FLAG = '.'
+
+DEFAULT_SERIALIZER = 'json'
+
+# Serializers by name, see register_serializer.
+SERIALIZERS = {}
+
+# Serializers by tag.
+SERIALIZERS_BY_TAG = {}
+
+
+class Serializer:
+    """A named format for cached values."""
+
+    def __init__(self, name, tag, dumps, loads):
+        """Create a new serializer.
+
+        @param name: The name used by the CACHE_SERIALIZER config.
+        @type name: str
+        @param tag: A single character identifying the format in stored values.
+        @type tag: str
+        @param dumps: Function encoding a value to a str.
+        @type dumps: function
+        @param loads: Function decoding a str produced by dumps.
+        @type loads: function
+        """
+        self.name = name
+        self.tag = tag
+        self.dumps = dumps
+        self.loads = loads
+
+
+def register_serializer(serializer):
+    """Make a serializer available for writing and reading cached values.
+
+    @param serializer: The serializer. Its tag must not be reused by another
+        serializer.
+    @type serializer: Serializer
+    """
+    SERIALIZERS[serializer.name] = serializer
+    SERIALIZERS_BY_TAG[serializer.tag] = serializer
+
+
+def get_serializer():
+    """Get the serializer used to write cached values.
+
+    @return: The serializer named by the CACHE_SERIALIZER config, or the JSON
+        serializer if it is not available.
+    @rtype: Serializer
+    """
+    name = config_layer.get_config().get('CACHE_SERIALIZER', DEFAULT_SERIALIZER)
+    serializer = SERIALIZERS.get(name, None)
+    if serializer is None:
+        print 'cache serializer unavailable -', name
+        return SERIALIZERS[DEFAULT_SERIALIZER]
+    return serializer
+
+
+def get_compress_threshold():
+    return config_layer.get_config().get('CACHE_COMPRESS_THRESHOLD', None)
+
+
+def dumps(value):
+    """Encode a value for the cache.
+
+    Uncompressed JSON is written untagged, as before serializers were
+    configurable, so that older processes can still read it.
+
+    @param value: The value to encode.
+    @return: The encoded value.
+    @rtype: str
+    """
+    serializer = get_serializer()
+    data = serializer.dumps(value)
+
+    threshold = get_compress_threshold()
+    if threshold is not None and len(data) > threshold:
+        return TAG_MARKER + serializer.tag + COMPRESSED_FLAG + \
+            zlib.compress(data)
+
+    if serializer.name == DEFAULT_SERIALIZER:
+        return data
+    return TAG_MARKER + serializer.tag + PLAIN_FLAG + data
+
+
+def loads(data):
+    """Decode a value read from the cache.
+
+    @param data: A value encoded by dumps, or untagged JSON.
+    @type data: str
+    @return: The decoded value.
+    @raise ValueError: If the value's format is unknown.
+    """
+    if not data.startswith(TAG_MARKER):
+        return json.loads(data)
+
+    serializer = SERIALIZERS_BY_TAG.get(data[1:2], None)
+    if serializer is None:
+        raise ValueError('Unknown cached value format %r' % data[1:2])
+
+    payload = data[3:]
+    if data[2:3] == COMPRESSED_FLAG:
+        payload = zlib.decompress(payload)
+    return serializer.loads(payload)
+
+
+register_serializer(Serializer('json', 'j', json.dumps, json.loads))
+
+if msgpack:
+    register_serializer(Serializer(
+        'msgpack',
+        'm',
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False)
+    ))
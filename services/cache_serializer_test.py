@@ -0,0 +1,78 @@
+"""Tests for cache_serializer
+
+@license: GNU GPLv3
+"""
+import json
+
+import mox
+
+import cache_serializer
+import config_layer
+
+TEST_VALUE = {'lists': ['name0', 'name1'], 'count': 2}
+
+
+class CacheSerializerTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(config_layer, 'get_config')
+        self.test_serializer = cache_serializer.Serializer(
+            'test',
+            't',
+            lambda value: json.dumps(value)[::-1],
+            lambda data: json.loads(data[::-1])
+        )
+        cache_serializer.register_serializer(self.test_serializer)
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        del cache_serializer.SERIALIZERS['test']
+        del cache_serializer.SERIALIZERS_BY_TAG['t']
+
+    def test_json_untagged(self):
+        config_layer.get_config().AndReturn({})
+        config_layer.get_config().AndReturn({})
+
+        self.mox.ReplayAll()
+
+        data = cache_serializer.dumps(TEST_VALUE)
+        self.assertEqual(json.dumps(TEST_VALUE), data)
+        self.assertEqual(TEST_VALUE, cache_serializer.loads(data))
+
+    def test_tagged(self):
+        config = {'CACHE_SERIALIZER': 'test'}
+        config_layer.get_config().AndReturn(config)
+        config_layer.get_config().AndReturn(config)
+
+        self.mox.ReplayAll()
+
+        data = cache_serializer.dumps(TEST_VALUE)
+        self.assertEqual('\x00t.', data[:3])
+        self.assertEqual(TEST_VALUE, cache_serializer.loads(data))
+
+    def test_compressed(self):
+        config = {'CACHE_COMPRESS_THRESHOLD': 10}
+        config_layer.get_config().AndReturn(config)
+        config_layer.get_config().AndReturn(config)
+
+        self.mox.ReplayAll()
+
+        data = cache_serializer.dumps(TEST_VALUE)
+        self.assertEqual('\x00jz', data[:3])
+        self.assertEqual(TEST_VALUE, cache_serializer.loads(data))
+
+    def test_unavailable_serializer_falls_back_to_json(self):
+        config = {'CACHE_SERIALIZER': 'missing'}
+        config_layer.get_config().AndReturn(config)
+        config_layer.get_config().AndReturn(config)
+
+        self.mox.ReplayAll()
+
+        data = cache_serializer.dumps(TEST_VALUE)
+        self.assertEqual(json.dumps(TEST_VALUE), data)
+
+    def test_loads_unknown_tag(self):
+        self.mox.ReplayAll()
+
+        self.assertRaises(ValueError, cache_serializer.loads, '\x00?.data')
@@ -0,0 +1,168 @@
+"""Concurrent SendGrid operations for bulk and background jobs.
+
+Keeps many SendGrid requests in flight from a single process using a bounded
+pool of worker threads, optionally limited to a number of requests per second.
+"""
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import subscriptions_service
+import util
+
+DEFAULT_CONCURRENCY = 20
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the rate of operations."""
+
+    def __init__(self, rate, burst=None):
+        """Create a new token bucket.
+
+        @param rate: The number of operations allowed per second.
+        @type rate: float
+        @param burst: The number of operations allowed at once after a quiet
+            period. Defaults to one second's worth.
+        @type burst: int
+        """
+        self.rate = float(rate)
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Block until an operation is allowed."""
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class ConcurrentSendGridClient:
+    """Runs SendGrid operations concurrently with bounded concurrency.
+
+    Operations return multiprocessing.pool.AsyncResult objects whose get()
+    method waits for and returns the operation's result. Use as a context
+    manager, or call close(), to wait for outstanding operations.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate_limit=None):
+        """Create a new client.
+
+        @param concurrency: The maximum number of requests in flight.
+        @type concurrency: int
+        @param rate_limit: The maximum number of requests started per second,
+            or None for no limit.
+        @type rate_limit: float
+        """
+        self.concurrency = concurrency
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = TokenBucket(rate_limit)
+        self.pool = ThreadPool(processes=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def call(self, func, *args):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        return func(*args)
+
+    def submit(self, func, *args):
+        """Run a function making a SendGrid request on a worker thread.
+
+        @param func: The function to run.
+        @type func: function
+        @return: The pending result.
+        @rtype: multiprocessing.pool.AsyncResult
+        """
+        return self.pool.apply_async(self.call, (func,) + args)
+
+    def get_lists(self):
+        return self.submit(subscriptions_service.fetch_lists)
+
+    def get_list_members(self, listname):
+        return self.submit(subscriptions_service.fetch_list_emails, listname)
+
+    def add_user(self, listname, email):
+        return self.submit(
+            subscriptions_service.add_user_to_list,
+            listname,
+            email
+        )
+
+    def add_users(self, listname, emails):
+        return self.submit(
+            subscriptions_service.add_users_to_list,
+            listname,
+            emails
+        )
+
+    def delete_user(self, listname, email):
+        return self.submit(
+            subscriptions_service.delete_user_from_list,
+            listname,
+            email
+        )
+
+    def timed_call(self, func, item):
+        start = time.time()
+        try:
+            result = self.call(func, item)
+        except Exception as e:
+            return item, None, e, time.time() - start
+        return item, result, None, time.time() - start
+
+    def map_unordered(self, func, items):
+        """Run a function over many items concurrently.
+
+        @param func: The function making a SendGrid request for one item.
+        @type func: function
+        @param items: The items to run the function for.
+        @type items: iterable
+        @return: Tuples of (item, result or None, error or None, seconds taken)
+            in completion order.
+        @rtype: iterable over tuples
+        """
+        return self.pool.imap_unordered(
+            lambda item: self.timed_call(func, item),
+            items
+        )
+
+
+def create_client(concurrency=None):
+    """Create a concurrent client from the application configs.
+
+    @param concurrency: The maximum number of requests in flight. Defaults to
+        the SENDGRID_CONCURRENCY config.
+    @type concurrency: int
+    @return: The new client.
+    @rtype: ConcurrentSendGridClient
+    """
+    config = util.get_app_config()
+    if concurrency is None:
+        concurrency = config.get('SENDGRID_CONCURRENCY', DEFAULT_CONCURRENCY)
+
+    return ConcurrentSendGridClient(
+        concurrency=concurrency,
+        rate_limit=config.get('SENDGRID_RATE_LIMIT', None)
+    )
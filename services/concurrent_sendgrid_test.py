@@ -0,0 +1,53 @@
+"""Tests for concurrent_sendgrid
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+
+import concurrent_sendgrid
+
+
+class ConcurrentSendGridTests(mox.MoxTestBase):
+
+    def test_token_bucket_waits_when_empty(self):
+        self.mox.StubOutWithMock(time, 'time')
+        self.mox.StubOutWithMock(time, 'sleep')
+
+        time.time().AndReturn(100)
+        time.time().AndReturn(100)
+        time.time().AndReturn(100)
+        time.sleep(0.5)
+        time.time().AndReturn(100.5)
+
+        self.mox.ReplayAll()
+
+        bucket = concurrent_sendgrid.TokenBucket(2, burst=1)
+        bucket.acquire()
+        bucket.acquire()
+
+    def test_map_unordered(self):
+        def double(item):
+            if item == 3:
+                raise ValueError('bad item')
+            return item * 2
+
+        with concurrent_sendgrid.ConcurrentSendGridClient(concurrency=2) \
+                as client:
+            results = dict(
+                (item, (result, error))
+                for item, result, error, seconds
+                in client.map_unordered(double, [1, 2, 3])
+            )
+
+        self.assertEqual((2, None), results[1])
+        self.assertEqual((4, None), results[2])
+        self.assertEqual(None, results[3][0])
+        self.assertTrue(isinstance(results[3][1], ValueError))
+
+    def test_submit(self):
+        with concurrent_sendgrid.ConcurrentSendGridClient(concurrency=1) \
+                as client:
+            result = client.submit(lambda x, y: x + y, 1, 2)
+            self.assertEqual(3, result.get())
@@ -2,15 +2,36 @@
 
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 """
+import time
+import uuid
+
 from flask.ext.pymongo import PyMongo
 
+import metrics
 import subscriptions_service
 import util
 
+DESCRIPTIONS_VERSION_KEY_PREFIX = 'descriptions_version'
+
+DEFAULT_CHECK_INTERVAL = 1
+
+# Process-local copy of the descriptions as (version, descriptions, checked at).
+EMPTY_LOCAL_DESCRIPTIONS = (None, None, 0)
+LOCAL_DESCRIPTIONS = {'entry': EMPTY_LOCAL_DESCRIPTIONS}
+
+# Cached entries refreshed when the descriptions are saved. List membership is
+# not affected by the descriptions and stays cached.
+INVALIDATED_CACHES = ['get_lists']
+
 
 def get_descriptions():
     """Get the list descriptions for the application.
 
+    Answered from a process-local copy of the descriptions document. The copy
+    is reloaded from Mongo when the version stamp in Redis no longer matches,
+    which is checked at most every DESCRIPTIONS_CHECK_INTERVAL seconds. The
+    returned dict is shared and must not be modified.
+
     @return: Dict of the form: {
         'listname 0': {'description': 'description text 0 ...'},
         'listname 1': {'description': 'description text 1 ...'},
@@ -18,7 +39,90 @@ def get_descriptions():
     }
     @rtype: iterable over str
     """
-    return get_db().subscriptions.find_one()
+    return get_versioned_descriptions()[1]
+
+
+def get_versioned_descriptions():
+    """Get the list descriptions along with their version stamp.
+
+    @return: Tuple of (version or None if Redis is unavailable, descriptions as
+        returned by get_descriptions).
+    @rtype: tuple
+    """
+    cached_version, descriptions, checked_at = LOCAL_DESCRIPTIONS['entry']
+    now = time.time()
+    if cached_version != None and now - checked_at < get_check_interval():
+        return cached_version, descriptions
+
+    try:
+        version = get_descriptions_version()
+    except Exception as e:
+        print 'cache fail -', e
+        return None, load_descriptions()
+
+    if version == None or version != cached_version:
+        descriptions = load_descriptions()
+
+    if version == None:
+        try:
+            version = init_descriptions_version()
+        except Exception as e:
+            print 'cache fail -', e
+            return None, descriptions
+
+    LOCAL_DESCRIPTIONS['entry'] = (version, descriptions, now)
+    return version, descriptions
+
+
+def load_descriptions():
+    """Load the list descriptions document from the database.
+
+    @return: The descriptions document, see get_descriptions.
+    @rtype: dict
+    """
+    with metrics.MONGO_REQUEST_SECONDS.time(operation='find_one'):
+        return get_db().subscriptions.find_one()
+
+
+def get_check_interval():
+    return util.get_app_config().get(
+        'DESCRIPTIONS_CHECK_INTERVAL',
+        DEFAULT_CHECK_INTERVAL
+    )
+
+
+def get_descriptions_version_key():
+    return util.get_redis_key(DESCRIPTIONS_VERSION_KEY_PREFIX)
+
+
+def get_descriptions_version():
+    """Get the version stamp of the stored descriptions from Redis.
+
+    @return: The version, or None if no version has been recorded.
+    @rtype: str
+    """
+    return util.get_redis_connection().get(get_descriptions_version_key())
+
+
+def init_descriptions_version():
+    """Record a version stamp for the descriptions if none exists yet.
+
+    @return: The recorded version, which another process may have set first.
+    @rtype: str
+    """
+    redis_conn = util.get_redis_connection()
+    key = get_descriptions_version_key()
+    redis_conn.setnx(key, uuid.uuid4().hex)
+    return redis_conn.get(key)
+
+
+def bump_descriptions_version():
+    """Record a new version stamp, invalidating every process's local copy."""
+    LOCAL_DESCRIPTIONS['entry'] = EMPTY_LOCAL_DESCRIPTIONS
+    util.get_redis_connection().set(
+        get_descriptions_version_key(),
+        uuid.uuid4().hex
+    )
 
 
 def update_descriptions(new_descriptions):
@@ -30,6 +134,9 @@ def update_descriptions(new_descriptions):
         ...
     }
     @type new_descriptions: iterable over list descriptions.
+
+    Every process's local copy of the descriptions is invalidated along with
+    the cached entries in INVALIDATED_CACHES; membership data stays cached.
     """
     old_record = get_descriptions()
     if old_record:
@@ -45,12 +152,18 @@ def update_descriptions(new_descriptions):
             new_descriptions.items()
         )
     )
-    get_db().subscriptions.save(descriptions)
-
-    util.get_redis_connection().flushall()
-
-    # get_user_subscriptions updates the cache
-    subscriptions_service.get_user_subscriptions('test@example.com')
+    with metrics.MONGO_REQUEST_SECONDS.time(operation='save'):
+        get_db().subscriptions.save(descriptions)
+
+    try:
+        bump_descriptions_version()
+        for func in INVALIDATED_CACHES:
+            util.invalidate_cached(func)
+    except Exception as e:
+        print 'cache fail -', e
+
+    # get_lists updates the cache
+    subscriptions_service.get_lists()
 
 
 class AppMongoKeeper:
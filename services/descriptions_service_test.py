@@ -0,0 +1,118 @@
+"""Tests for descriptions_service
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+
+import descriptions_service
+
+TEST_DESCRIPTIONS = {
+    'name0': {'description': 'description0'},
+    'name1': {'description': 'description1'}
+}
+
+TEST_NEW_DESCRIPTIONS = {
+    'name0': {'description': 'new description0'}
+}
+
+
+class DescriptionsServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        descriptions_service.LOCAL_DESCRIPTIONS['entry'] = \
+            descriptions_service.EMPTY_LOCAL_DESCRIPTIONS
+        self.mox.StubOutWithMock(time, 'time')
+        self.mox.StubOutWithMock(descriptions_service, 'get_check_interval')
+        self.mox.StubOutWithMock(descriptions_service, 'load_descriptions')
+        self.mox.StubOutWithMock(
+            descriptions_service,
+            'get_descriptions_version'
+        )
+        self.mox.StubOutWithMock(
+            descriptions_service,
+            'init_descriptions_version'
+        )
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        descriptions_service.LOCAL_DESCRIPTIONS['entry'] = \
+            descriptions_service.EMPTY_LOCAL_DESCRIPTIONS
+
+    def test_get_descriptions_cached(self):
+        descriptions_service.LOCAL_DESCRIPTIONS['entry'] = (
+            'v1',
+            TEST_DESCRIPTIONS,
+            100
+        )
+        time.time().AndReturn(100.5)
+        descriptions_service.get_check_interval().AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        result = descriptions_service.get_descriptions()
+        self.assertEqual(TEST_DESCRIPTIONS, result)
+
+    def test_get_descriptions_same_version(self):
+        descriptions_service.LOCAL_DESCRIPTIONS['entry'] = (
+            'v1',
+            TEST_DESCRIPTIONS,
+            100
+        )
+        time.time().AndReturn(102)
+        descriptions_service.get_check_interval().AndReturn(1)
+        descriptions_service.get_descriptions_version().AndReturn('v1')
+
+        self.mox.ReplayAll()
+
+        result = descriptions_service.get_descriptions()
+        self.assertEqual(TEST_DESCRIPTIONS, result)
+        self.assertEqual(
+            ('v1', TEST_DESCRIPTIONS, 102),
+            descriptions_service.LOCAL_DESCRIPTIONS['entry']
+        )
+
+    def test_get_descriptions_new_version(self):
+        descriptions_service.LOCAL_DESCRIPTIONS['entry'] = (
+            'v1',
+            TEST_DESCRIPTIONS,
+            100
+        )
+        time.time().AndReturn(102)
+        descriptions_service.get_check_interval().AndReturn(1)
+        descriptions_service.get_descriptions_version().AndReturn('v2')
+        descriptions_service.load_descriptions() \
+            .AndReturn(TEST_NEW_DESCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        result = descriptions_service.get_descriptions()
+        self.assertEqual(TEST_NEW_DESCRIPTIONS, result)
+
+    def test_get_descriptions_no_version(self):
+        time.time().AndReturn(100)
+        descriptions_service.get_descriptions_version().AndReturn(None)
+        descriptions_service.load_descriptions().AndReturn(TEST_DESCRIPTIONS)
+        descriptions_service.init_descriptions_version().AndReturn('v1')
+
+        self.mox.ReplayAll()
+
+        result = descriptions_service.get_descriptions()
+        self.assertEqual(TEST_DESCRIPTIONS, result)
+        self.assertEqual(
+            ('v1', TEST_DESCRIPTIONS, 100),
+            descriptions_service.LOCAL_DESCRIPTIONS['entry']
+        )
+
+    def test_get_descriptions_redis_failure(self):
+        time.time().AndReturn(100)
+        descriptions_service.get_descriptions_version() \
+            .AndRaise(IOError('redis unavailable'))
+        descriptions_service.load_descriptions().AndReturn(TEST_DESCRIPTIONS)
+
+        self.mox.ReplayAll()
+
+        result = descriptions_service.get_descriptions()
+        self.assertEqual(TEST_DESCRIPTIONS, result)
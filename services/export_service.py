@@ -0,0 +1,102 @@
+"""Streaming export of list membership.
+
+Members are read from the membership cache with SSCAN and formatted as they
+are read, so memory use stays constant regardless of list size. Lists whose
+membership is not cached are fetched from SendGrid and cached first.
+"""
+import cStringIO
+import csv
+import json
+
+import membership_cache
+import subscriptions_service
+
+CSV_FORMAT = 'csv'
+NDJSON_FORMAT = 'ndjson'
+
+CONTENT_TYPES = {
+    CSV_FORMAT: 'text/csv',
+    NDJSON_FORMAT: 'application/x-ndjson'
+}
+
+# Number of rows formatted into each chunk of output.
+CHUNK_ROWS = 500
+
+
+def iter_members(listnames=None):
+    """Iterate over the members of lists.
+
+    @param listnames: The lists to export, or None for every list.
+    @type listnames: iterable over str
+    @return: Tuples of (listname, email).
+    @rtype: iterable over tuples
+    """
+    if listnames is None:
+        listnames = subscriptions_service.get_lists()
+
+    for listname in listnames:
+        if not membership_cache.is_list_cached(listname):
+            # SendGrid only returns whole lists, so this is read once to cache
+            subscriptions_service.list_emails_subscribed_to_list(listname)
+
+        for email in membership_cache.iter_list_members(listname):
+            yield listname, email
+
+
+def format_csv(rows):
+    """Format (listname, email) rows as CSV with a header, in chunks.
+
+    @return: Chunks of CSV text.
+    @rtype: iterable over str
+    """
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['list', 'email'])
+    pending = 0
+    for row in rows:
+        writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ])
+        pending += 1
+        if pending >= CHUNK_ROWS:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    yield buf.getvalue()
+
+
+def format_ndjson(rows):
+    """Format (listname, email) rows as newline delimited JSON, in chunks.
+
+    @return: Chunks of JSON objects of the form {"list": ..., "email": ...},
+        one per line.
+    @rtype: iterable over str
+    """
+    lines = []
+    for listname, email in rows:
+        lines.append(json.dumps({'list': listname, 'email': email}) + '\n')
+        if len(lines) >= CHUNK_ROWS:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def export_members(listnames=None, export_format=CSV_FORMAT):
+    """Stream the members of lists in an export format.
+
+    @param listnames: The lists to export, or None for every list.
+    @type listnames: iterable over str
+    @param export_format: CSV_FORMAT or NDJSON_FORMAT
+    @type export_format: str
+    @return: Chunks of the export.
+    @rtype: iterable over str
+    @raise ValueError: If the export format is unknown.
+    """
+    if export_format == CSV_FORMAT:
+        return format_csv(iter_members(listnames))
+    if export_format == NDJSON_FORMAT:
+        return format_ndjson(iter_members(listnames))
+    raise ValueError('Unknown export format %s' % export_format)
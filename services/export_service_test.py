@@ -0,0 +1,91 @@
+"""Tests for export_service
+
+@license: GNU GPLv3
+"""
+import json
+
+import mox
+
+import export_service
+import membership_cache
+import subscriptions_service
+
+
+class ExportServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(subscriptions_service, 'get_lists')
+        self.mox.StubOutWithMock(
+            subscriptions_service,
+            'list_emails_subscribed_to_list'
+        )
+        self.mox.StubOutWithMock(membership_cache, 'is_list_cached')
+        self.mox.StubOutWithMock(membership_cache, 'iter_list_members')
+
+    def test_iter_members_every_list(self):
+        subscriptions_service.get_lists().AndReturn(['name0', 'name1'])
+        membership_cache.is_list_cached('name0').AndReturn(True)
+        membership_cache.iter_list_members('name0').AndReturn(
+            iter(['a@example.com', 'b@example.com'])
+        )
+        membership_cache.is_list_cached('name1').AndReturn(False)
+        subscriptions_service.list_emails_subscribed_to_list('name1')
+        membership_cache.iter_list_members('name1').AndReturn(
+            iter(['c@example.com'])
+        )
+
+        self.mox.ReplayAll()
+
+        rows = list(export_service.iter_members())
+        self.assertEqual(
+            [
+                ('name0', 'a@example.com'),
+                ('name0', 'b@example.com'),
+                ('name1', 'c@example.com')
+            ],
+            rows
+        )
+
+    def test_format_csv_chunks(self):
+        self.stubs.Set(export_service, 'CHUNK_ROWS', 1)
+
+        self.mox.ReplayAll()
+
+        chunks = list(export_service.format_csv([
+            (u'name0', 'a@example.com'),
+            ('name0', 'b@example.com')
+        ]))
+        self.assertEqual(
+            [
+                'list,email\r\nname0,a@example.com\r\n',
+                'name0,b@example.com\r\n',
+                ''
+            ],
+            chunks
+        )
+
+    def test_format_ndjson(self):
+        self.mox.ReplayAll()
+
+        text = ''.join(export_service.format_ndjson([
+            ('name0', 'a@example.com'),
+            ('name1', 'b@example.com')
+        ]))
+        self.assertEqual(
+            [
+                {'list': 'name0', 'email': 'a@example.com'},
+                {'list': 'name1', 'email': 'b@example.com'}
+            ],
+            [json.loads(line) for line in text.splitlines()]
+        )
+
+    def test_export_members_unknown_format(self):
+        self.mox.ReplayAll()
+
+        self.assertRaises(
+            ValueError,
+            export_service.export_members,
+            None,
+            'xml'
+        )
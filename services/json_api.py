@@ -0,0 +1,69 @@
+"""Compact, compressed JSON responses for the API endpoints."""
+import cStringIO
+import gzip
+import json
+
+import flask
+
+# Bodies smaller than this are not worth compressing.
+GZIP_MIN_SIZE = 512
+GZIP_LEVEL = 6
+
+
+def gzip_response(response):
+    """Compress a response with gzip if the client accepts it.
+
+    @param response: The uncompressed response.
+    @type response: flask.Response
+    @return: The response, compressed if the client accepts gzip and it is
+        large enough to benefit.
+    @rtype: flask.Response
+    """
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or \
+            'gzip' not in flask.request.accept_encodings or \
+            len(response.data) < GZIP_MIN_SIZE:
+        return response
+
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=GZIP_LEVEL) as f:
+        f.write(response.data)
+    response.data = buf.getvalue()
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def make_json_response(value, status=200):
+    """Respond with a value as compact JSON.
+
+    Successful GET responses carry an ETag of their content and are answered
+    with 304 if the client's copy is current.
+
+    @param value: The JSON-serializable value.
+    @param status: The HTTP status code.
+    @type status: int
+    @return: The response, gzipped if the client accepts it.
+    @rtype: flask.Response
+    """
+    response = flask.Response(
+        json.dumps(value, separators=(',', ':')),
+        status=status,
+        mimetype='application/json'
+    )
+    if status == 200 and flask.request.method == 'GET':
+        # Weak since the same ETag is used for the gzipped representation
+        response.add_etag(weak=True)
+        response.make_conditional(flask.request)
+    return gzip_response(response)
+
+
+def get_json_body():
+    """Get the JSON object sent as the request body.
+
+    @return: The decoded object, or {} if the body is not a JSON object.
+    @rtype: dict
+    """
+    body = flask.request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return {}
+    return body
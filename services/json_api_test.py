@@ -0,0 +1,47 @@
+"""Tests for json_api
+
+@license: GNU GPLv3
+"""
+import cStringIO
+import gzip
+import json
+
+import flask
+import mox
+
+import json_api
+
+TEST_VALUE = {'lists': ['name%d' % i for i in range(200)]}
+
+
+class JsonApiTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+
+    def test_make_json_response_gzip(self):
+        with self.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = json_api.make_json_response(TEST_VALUE)
+
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        data = gzip.GzipFile(fileobj=cStringIO.StringIO(response.data)).read()
+        self.assertEqual(TEST_VALUE, json.loads(data))
+        self.assertFalse(' ' in data)
+
+    def test_make_json_response_identity(self):
+        with self.app.test_request_context():
+            response = json_api.make_json_response(TEST_VALUE)
+
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(TEST_VALUE, json.loads(response.data))
+
+    def test_make_json_response_not_modified(self):
+        with self.app.test_request_context():
+            etag = json_api.make_json_response(TEST_VALUE).headers['ETag']
+
+        with self.app.test_request_context(headers={'If-None-Match': etag}):
+            response = json_api.make_json_response(TEST_VALUE)
+
+        self.assertEqual(304, response.status_code)
@@ -0,0 +1,663 @@
+"""Redis-backed cache of mailing list membership.
+
+List membership is kept as native Redis sets in two directions: each list maps
+to the set of emails subscribed to it and each email maps to the set of lists
+it is subscribed to (the membership index). Subscription changes are applied
+with SADD / SREM rather than rewriting whole member arrays, and every change a
+user makes at once is sent to Redis as a single pipelined batch. The time of
+each change is recorded per list so that refreshing the cache from SendGrid
+does not undo changes newer than the SendGrid data.
+"""
+import time
+
+import config_layer
+import util
+
+INDEX_READY_KEY_PREFIX = 'membership_index_ready'
+INDEX_KEY_PREFIX = 'membership_index'
+LIST_KEY_PREFIX = 'membership_list'
+LIST_READY_KEY_PREFIX = 'membership_list_ready'
+RECONCILE_KEY_PREFIX = 'membership_reconcile'
+CHANGED_KEY_PREFIX = 'membership_changed'
+
+# Number of emails written per pipelined round trip while building the index.
+BUILD_BATCH_SIZE = 1000
+
+# Number of emails read per round trip while scanning a list.
+SCAN_COUNT = 1000
+
+
+def get_expiration():
+    return config_layer.get_config()['REDIS_EXPIRATION']
+
+
+def use_transactions():
+    """Check if membership changes should be applied with MULTI / EXEC.
+
+    @return: The MEMBERSHIP_CACHE_TRANSACTIONS config, True by default.
+    @rtype: bool
+    """
+    return config_layer.get_config().get('MEMBERSHIP_CACHE_TRANSACTIONS', True)
+
+
+def get_index_ready_key():
+    return util.get_redis_key(INDEX_READY_KEY_PREFIX)
+
+
+def get_user_index_key(email):
+    """Get the Redis key of the set of lists an email is subscribed to.
+
+    @param email: The user email.
+    @type email: str
+    @return: The Redis key.
+    @rtype: str
+    """
+    return util.get_redis_key(INDEX_KEY_PREFIX, (email,))
+
+
+def get_user_index_pattern():
+    """Get the SCAN pattern matching every email's index key."""
+    return '%s:%s:*' % (util.get_redis_namespace(), INDEX_KEY_PREFIX)
+
+
+def get_list_key(listname):
+    """Get the Redis key of the set of emails subscribed to a list.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @return: The Redis key.
+    @rtype: str
+    """
+    return util.get_redis_key(LIST_KEY_PREFIX, (listname,))
+
+
+def get_list_ready_key(listname):
+    return util.get_redis_key(LIST_READY_KEY_PREFIX, (listname,))
+
+
+def get_reconcile_key(listname):
+    return util.get_redis_key(RECONCILE_KEY_PREFIX, (listname,))
+
+
+def get_changed_key(listname):
+    """Get the Redis key of the times a list's members last changed.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @return: The Redis key of a sorted set of emails scored by change time.
+    @rtype: str
+    """
+    return util.get_redis_key(CHANGED_KEY_PREFIX, (listname,))
+
+
+def store_list_members(listname, emails, since=None, get_pending=None):
+    """Replace the cached membership of a list.
+
+    If since is given, emails whose cached membership of the list is newer
+    than the SendGrid data (see find_newer_emails) keep their cached
+    membership instead of being overwritten.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param emails: All emails subscribed to the list.
+    @type emails: iterable over str
+    @param since: The time the fetch from SendGrid started.
+    @type since: float
+    @param get_pending: Function taking a list name and emails, returning the
+        set of those emails with changes to the list not yet sent to SendGrid.
+    @type get_pending: function
+    """
+    key = get_list_key(listname)
+    emails = list(emails)
+    pending = set()
+    if since is not None:
+        added, removed = diff_list_members(listname, emails)
+        changed, pending = find_newer_emails(
+            listname,
+            added | removed,
+            since,
+            get_pending
+        )
+        newer = changed | pending
+        if newer:
+            emails = sorted(
+                (set(emails) - (added & newer)) | (removed & newer)
+            )
+
+    expiration = get_expiration()
+    pipe = util.get_redis_connection().pipeline(transaction=True)
+    pipe.delete(key)
+
+    for start in range(0, len(emails), BUILD_BATCH_SIZE):
+        pipe.sadd(key, *emails[start:start + BUILD_BATCH_SIZE])
+
+    pipe.expire(key, expiration)
+    pipe.set(get_list_ready_key(listname), 1, ex=expiration)
+    if since is not None:
+        trim_changes(listname, since, pending, pipe)
+    pipe.execute()
+
+
+def diff_list_members(listname, emails):
+    """Diff the emails fetched from SendGrid against the cached list members.
+
+    The emails are written to a scratch set and compared to the cached set
+    with SDIFF.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param emails: All emails subscribed to the list, as fetched from SendGrid.
+    @type emails: list of str
+    @return: Tuple of (emails missing from the cache, emails only in the
+        cache).
+    @rtype: tuple of sets
+    """
+    key = get_list_key(listname)
+    scratch_key = get_reconcile_key(listname)
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    pipe.delete(scratch_key)
+    for start in range(0, len(emails), BUILD_BATCH_SIZE):
+        pipe.sadd(scratch_key, *emails[start:start + BUILD_BATCH_SIZE])
+    # Left behind only if this process dies mid-diff
+    pipe.expire(scratch_key, get_expiration())
+    pipe.sdiff(scratch_key, key)
+    pipe.sdiff(key, scratch_key)
+    pipe.delete(scratch_key)
+    added, removed = pipe.execute()[-3:-1]
+    return set(added), set(removed)
+
+
+def find_newer_emails(listname, candidates, since, get_pending=None):
+    """Find the emails whose cached membership of a list is newer than SendGrid.
+
+    These are the emails whose membership of the list changed in the cache
+    since the SendGrid data was fetched, and those get_pending reports as
+    having changes not yet sent to SendGrid.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param candidates: The emails to check.
+    @type candidates: iterable over str
+    @param since: The time the fetch from SendGrid started.
+    @type since: float
+    @param get_pending: Function taking a list name and emails, returning the
+        set of those emails with changes to the list not yet sent to SendGrid.
+    @type get_pending: function
+    @return: Tuple of (emails changed since, emails with pending changes).
+    @rtype: tuple of sets
+    """
+    candidates = set(candidates)
+    if not candidates:
+        return set(), set()
+
+    changed = candidates & set(util.get_redis_connection().zrangebyscore(
+        get_changed_key(listname),
+        since,
+        '+inf'
+    ))
+    pending = set()
+    rest = sorted(candidates - changed)
+    if get_pending and rest:
+        pending = set(get_pending(listname, rest))
+    return changed, pending
+
+
+def trim_changes(listname, since, pending, pipe):
+    """Forget the changes to a list older than the SendGrid data.
+
+    Emails with pending changes are kept, scored at since, so that later
+    comparisons still check them.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param since: The time the fetch from SendGrid started.
+    @type since: float
+    @param pending: Emails with changes to the list not yet sent to SendGrid.
+    @type pending: iterable over str
+    @param pipe: The pipeline to queue the commands on.
+    @type pipe: redis.client.Pipeline
+    """
+    key = get_changed_key(listname)
+    pipe.zremrangebyscore(key, 0, since)
+    for email in sorted(pending):
+        pipe.zadd(key, **{email: since})
+
+
+def reconcile_list_members(listname, emails, since, get_pending=None):
+    """Bring the cached membership of a list in line with SendGrid.
+
+    Unlike store_list_members, only the difference is applied: the emails
+    missing from or extra in the cached set (see diff_list_members) are
+    added / removed along with their membership index entries. Emails whose
+    cached membership is newer than the SendGrid data (see find_newer_emails)
+    are left alone. Members that did not change stay cached, and the
+    expiration of the list and of every member's index entry is extended.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param emails: All emails subscribed to the list, as fetched from SendGrid.
+    @type emails: iterable over str
+    @param since: The time the fetch from SendGrid started.
+    @type since: float
+    @param get_pending: Function taking a list name and emails, returning the
+        set of those emails with changes to the list not yet sent to SendGrid.
+    @type get_pending: function
+    @return: Tuple of (emails added to the cache, emails removed from the
+        cache, emails skipped), each sorted.
+    @rtype: tuple
+    """
+    key = get_list_key(listname)
+    expiration = get_expiration()
+    emails = list(emails)
+
+    added, removed = diff_list_members(listname, emails)
+    changed, pending = find_newer_emails(
+        listname,
+        added | removed,
+        since,
+        get_pending
+    )
+    skipped = changed | pending
+    added = sorted(added - skipped)
+    removed = sorted(removed - skipped)
+
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    pending_commands = 0
+    for email in added:
+        update_memberships(email, [listname], [], pipe)
+        pending_commands += 1
+        if pending_commands >= BUILD_BATCH_SIZE:
+            pipe.execute()
+            pending_commands = 0
+    for email in removed:
+        update_memberships(email, [], [listname], pipe)
+        pending_commands += 1
+        if pending_commands >= BUILD_BATCH_SIZE:
+            pipe.execute()
+            pending_commands = 0
+    for email in emails:
+        pipe.expire(get_user_index_key(email), expiration)
+        pending_commands += 1
+        if pending_commands >= BUILD_BATCH_SIZE:
+            pipe.execute()
+            pending_commands = 0
+
+    pipe.expire(key, expiration)
+    pipe.set(get_list_ready_key(listname), 1, ex=expiration)
+    # Older changes are reflected in the SendGrid data
+    trim_changes(listname, since, pending, pipe)
+    pipe.execute()
+
+    return added, removed, sorted(skipped)
+
+
+def extend_index(expiration=None):
+    """Extend the expiration of the membership index if it has been built.
+
+    @param expiration: Seconds until the index expires. Defaults to
+        REDIS_EXPIRATION.
+    @type expiration: int
+    """
+    if expiration is None:
+        expiration = get_expiration()
+    util.get_redis_connection().expire(get_index_ready_key(), expiration)
+
+
+def get_list_members(listname):
+    """Get the cached emails subscribed to a list.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @return: The emails, or None if the list membership is not cached.
+    @rtype: list of str
+    """
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    pipe.exists(get_list_ready_key(listname))
+    pipe.smembers(get_list_key(listname))
+    is_ready, emails = pipe.execute()
+
+    if not is_ready:
+        return None
+    return list(emails)
+
+
+def is_list_cached(listname):
+    """Check if the membership of a list is cached.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @rtype: bool
+    """
+    return bool(util.get_redis_connection().exists(
+        get_list_ready_key(listname)
+    ))
+
+
+def invalidate_list(listname):
+    """Mark the cached membership of a list as stale in O(1).
+
+    Only the list's ready key is deleted. The list is fetched from SendGrid
+    again on its next read, and store_list_members replaces the stale set.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    """
+    util.get_redis_connection().delete(get_list_ready_key(listname))
+
+
+def iter_list_members(listname, count=SCAN_COUNT):
+    """Iterate over the cached emails subscribed to a list.
+
+    The set is read incrementally with SSCAN so that memory use does not grow
+    with the size of the list. Emails added or removed during the scan may or
+    may not be included, and an email may be returned more than once.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param count: The number of emails requested per round trip.
+    @type count: int
+    @return: The emails.
+    @rtype: iterable over str
+    """
+    return util.get_redis_connection().sscan_iter(
+        get_list_key(listname),
+        count=count
+    )
+
+
+def get_list_memberships(listnames, email):
+    """Check the cache for whether an email is subscribed to each of many lists.
+
+    Every list is checked with SISMEMBER in a single pipelined round trip.
+
+    @param listnames: The mailing list names.
+    @type listnames: iterable over str
+    @param email: The user email.
+    @type email: str
+    @return: Dict of listname to True / False, or None if the list membership
+        is not cached.
+    @rtype: dict
+    """
+    listnames = list(listnames)
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    for listname in listnames:
+        pipe.exists(get_list_ready_key(listname))
+        pipe.sismember(get_list_key(listname), email)
+    results = pipe.execute()
+
+    memberships = {}
+    for listname, is_ready, is_member in zip(
+        listnames,
+        results[0::2],
+        results[1::2]
+    ):
+        memberships[listname] = bool(is_member) if is_ready else None
+    return memberships
+
+
+def update_memberships(email, added_lists, removed_lists, pipe=None):
+    """Record that an email was subscribed to and unsubscribed from lists.
+
+    Updates both the list memberships and the membership index in one round
+    trip, atomically unless the MEMBERSHIP_CACHE_TRANSACTIONS config is False.
+
+    @param email: The user email.
+    @type email: str
+    @param added_lists: The lists the user was subscribed to.
+    @type added_lists: iterable over str
+    @param removed_lists: The lists the user was unsubscribed from.
+    @type removed_lists: iterable over str
+    @param pipe: A pipeline to queue the commands on instead, which the caller
+        executes.
+    @type pipe: redis.client.Pipeline
+    """
+    added_lists = list(added_lists)
+    removed_lists = list(removed_lists)
+    if not added_lists and not removed_lists:
+        return
+
+    execute = pipe is None
+    if execute:
+        pipe = util.get_redis_connection().pipeline(
+            transaction=use_transactions()
+        )
+
+    index_key = get_user_index_key(email)
+    for listname in added_lists:
+        pipe.sadd(get_list_key(listname), email)
+    for listname in removed_lists:
+        pipe.srem(get_list_key(listname), email)
+    if added_lists:
+        pipe.sadd(index_key, *added_lists)
+        pipe.expire(index_key, get_expiration())
+    if removed_lists:
+        pipe.srem(index_key, *removed_lists)
+    record_changes(email, added_lists + removed_lists, pipe)
+
+    if execute:
+        pipe.execute()
+
+
+def record_changes(email, listnames, pipe):
+    """Record the time an email's membership of lists changed in the cache.
+
+    @param email: The user email.
+    @type email: str
+    @param listnames: The lists whose membership changed.
+    @type listnames: iterable over str
+    @param pipe: The pipeline to queue the commands on.
+    @type pipe: redis.client.Pipeline
+    """
+    now = time.time()
+    expiration = get_expiration()
+    for listname in listnames:
+        key = get_changed_key(listname)
+        pipe.zadd(key, **{email: now})
+        pipe.expire(key, expiration)
+
+
+def build_index(members_by_list, since=None, get_pending=None):
+    """Rebuild the email to lists index from complete list membership data.
+
+    Every email found in members_by_list has its index entry replaced, and
+    the entries of emails no longer on any list are deleted. If since is
+    given, an email's membership of lists where its cached membership is
+    newer than the data (see find_newer_emails) is left as cached. The index
+    is only marked as ready once all entries have been written.
+
+    @param members_by_list: The emails subscribed to each list, of the form: {
+        'listname 0': ['email 0', 'email 1', ...],
+        ...
+    }
+    @type members_by_list: dict of iterables over str
+    @param since: The time the fetch of the membership data started.
+    @type since: float
+    @param get_pending: Function taking a list name and emails, returning the
+        set of those emails with changes to the list not yet sent to SendGrid.
+    @type get_pending: function
+    """
+    lists_by_email = {}
+    for listname, emails in members_by_list.iteritems():
+        for email in emails:
+            lists_by_email.setdefault(email, set()).add(listname)
+
+    kept_by_email = {}
+    if since is not None:
+        kept_by_email = find_kept_lists(members_by_list, since, get_pending)
+
+    expiration = get_expiration()
+    redis_conn = util.get_redis_connection()
+    all_lists = set(members_by_list)
+    pipe = redis_conn.pipeline(transaction=False)
+    pending = 0
+    keys = set()
+    for email in set(lists_by_email) | set(kept_by_email):
+        key = get_user_index_key(email)
+        keys.add(key)
+        listnames = lists_by_email.get(email, set())
+        kept = kept_by_email.get(email)
+        if kept:
+            # Merge rather than replace so the kept lists are not touched
+            added_lists = listnames - kept
+            removed_lists = all_lists - listnames - kept
+            if added_lists:
+                pipe.sadd(key, *sorted(added_lists))
+            if removed_lists:
+                pipe.srem(key, *sorted(removed_lists))
+        else:
+            pipe.delete(key)
+            pipe.sadd(key, *sorted(listnames))
+        pipe.expire(key, expiration)
+
+        pending += 1
+        if pending >= BUILD_BATCH_SIZE:
+            pipe.execute()
+            pending = 0
+
+    stale_keys = set(redis_conn.scan_iter(
+        match=get_user_index_pattern(),
+        count=SCAN_COUNT
+    )) - keys
+
+    if since is not None:
+        pipe.execute()
+        pending = 0
+        late_changes = find_late_changes(members_by_list, since, kept_by_email)
+        for email, listname, is_member in late_changes:
+            key = get_user_index_key(email)
+            stale_keys.discard(key)
+            if is_member:
+                pipe.sadd(key, listname)
+                pipe.expire(key, expiration)
+            else:
+                pipe.srem(key, listname)
+
+            pending += 1
+            if pending >= BUILD_BATCH_SIZE:
+                pipe.execute()
+                pending = 0
+
+    for key in sorted(stale_keys):
+        pipe.delete(key)
+
+        pending += 1
+        if pending >= BUILD_BATCH_SIZE:
+            pipe.execute()
+            pending = 0
+
+    pipe.set(get_index_ready_key(), 1, ex=expiration)
+    pipe.execute()
+
+
+def find_kept_lists(listnames, since, get_pending=None):
+    """Find the lists whose cached membership emails keep in an index rebuild.
+
+    Every email that changed a list in the cache is checked with
+    find_newer_emails.
+
+    @param listnames: The mailing list names.
+    @type listnames: iterable over str
+    @param since: The time the fetch of the membership data started.
+    @type since: float
+    @param get_pending: Function taking a list name and emails, returning the
+        set of those emails with changes to the list not yet sent to SendGrid.
+    @type get_pending: function
+    @return: Dict of email to the set of lists it keeps.
+    @rtype: dict
+    """
+    listnames = sorted(listnames)
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    for listname in listnames:
+        pipe.zrange(get_changed_key(listname), 0, -1)
+
+    kept_by_email = {}
+    for listname, candidates in zip(listnames, pipe.execute()):
+        changed, pending = find_newer_emails(
+            listname,
+            candidates,
+            since,
+            get_pending
+        )
+        for email in changed | pending:
+            kept_by_email.setdefault(email, set()).add(listname)
+    return kept_by_email
+
+
+def find_late_changes(listnames, since, kept_by_email):
+    """Find the changes made in the cache while the index was being rebuilt.
+
+    These are read from the list sets, which update_memberships changes along
+    with the index.
+
+    @param listnames: The mailing list names.
+    @type listnames: iterable over str
+    @param since: The time the fetch of the membership data started.
+    @type since: float
+    @param kept_by_email: The lists each email kept, as already handled.
+    @type kept_by_email: dict
+    @return: Tuples of (email, listname, whether the email is on the list).
+    @rtype: list of tuples
+    """
+    listnames = sorted(listnames)
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    for listname in listnames:
+        pipe.zrangebyscore(get_changed_key(listname), since, '+inf')
+
+    late = []
+    for listname, emails in zip(listnames, pipe.execute()):
+        for email in emails:
+            if listname not in kept_by_email.get(email, ()):
+                late.append((email, listname))
+    if not late:
+        return []
+
+    for email, listname in late:
+        pipe.sismember(get_list_key(listname), email)
+    return [
+        (email, listname, bool(is_member))
+        for (email, listname), is_member in zip(late, pipe.execute())
+    ]
+
+
+def get_user_lists(email):
+    """Get the lists an email is subscribed to from the index.
+
+    @param email: The user email for which to return list subscriptions.
+    @type email: str
+    @return: The list names, or None if the index has not been built.
+    @rtype: list of str
+    """
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    pipe.exists(get_index_ready_key())
+    pipe.smembers(get_user_index_key(email))
+    is_ready, listnames = pipe.execute()
+
+    if not is_ready:
+        return None
+    return sorted(listnames)
+
+
+def get_users_lists(emails):
+    """Get the lists each of many emails is subscribed to from the index.
+
+    All emails are looked up in a single pipelined round trip.
+
+    @param emails: The user emails for which to return list subscriptions.
+    @type emails: iterable over str
+    @return: Dict of email to sorted list names, or None if the index has not
+        been built.
+    @rtype: dict
+    """
+    emails = list(emails)
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    pipe.exists(get_index_ready_key())
+    for email in emails:
+        pipe.smembers(get_user_index_key(email))
+    results = pipe.execute()
+
+    if not results[0]:
+        return None
+    return dict(
+        (email, sorted(listnames))
+        for email, listnames in zip(emails, results[1:])
+    )
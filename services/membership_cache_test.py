@@ -0,0 +1,492 @@
+"""Tests for membership_cache
+
+@license: GNU GPLv3
+"""
+import mox
+
+import membership_cache
+import util
+
+TEST_EMAIL = 'test@example.com'
+TEST_OTHER_EMAIL = 'other@example.com'
+
+TEST_MEMBERS_BY_LIST = {
+    'name0': [TEST_EMAIL, TEST_OTHER_EMAIL],
+    'name1': [TEST_EMAIL]
+}
+
+TEST_EXPIRATION = 60
+
+
+class MembershipCacheTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.redis_conn = self.mox.CreateMockAnything()
+        self.pipe = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+        self.mox.StubOutWithMock(membership_cache, 'get_expiration')
+
+    def test_build_index(self):
+        email_key = membership_cache.get_user_index_key(TEST_EMAIL)
+        other_key = membership_cache.get_user_index_key(TEST_OTHER_EMAIL)
+        stale_key = membership_cache.get_user_index_key('gone@example.com')
+
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+
+        self.pipe.delete(email_key).InAnyOrder()
+        self.pipe.sadd(email_key, 'name0', 'name1').InAnyOrder()
+        self.pipe.expire(email_key, TEST_EXPIRATION).InAnyOrder()
+        self.pipe.delete(other_key).InAnyOrder()
+        self.pipe.sadd(other_key, 'name0').InAnyOrder()
+        self.pipe.expire(other_key, TEST_EXPIRATION).InAnyOrder()
+        self.redis_conn.scan_iter(
+            match=membership_cache.get_user_index_pattern(),
+            count=membership_cache.SCAN_COUNT
+        ).AndReturn(iter([email_key, stale_key, other_key]))
+        self.pipe.delete(stale_key)
+        self.pipe.set(
+            membership_cache.get_index_ready_key(),
+            1,
+            ex=TEST_EXPIRATION
+        )
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        membership_cache.build_index(TEST_MEMBERS_BY_LIST)
+
+    def test_build_index_keeps_newer_changes(self):
+        email_key = membership_cache.get_user_index_key(TEST_EMAIL)
+        other_key = membership_cache.get_user_index_key(TEST_OTHER_EMAIL)
+        new_key = membership_cache.get_user_index_key('new@example.com')
+        late_key = membership_cache.get_user_index_key('late@example.com')
+        self.mox.StubOutWithMock(membership_cache, 'find_kept_lists')
+        self.mox.StubOutWithMock(membership_cache, 'find_late_changes')
+
+        membership_cache.find_kept_lists(
+            TEST_MEMBERS_BY_LIST,
+            100,
+            None
+        ).AndReturn({
+            TEST_EMAIL: set(['name1']),
+            'new@example.com': set(['name0'])
+        })
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+
+        self.pipe.sadd(email_key, 'name0').InAnyOrder()
+        self.pipe.expire(email_key, TEST_EXPIRATION).InAnyOrder()
+        self.pipe.delete(other_key).InAnyOrder()
+        self.pipe.sadd(other_key, 'name0').InAnyOrder()
+        self.pipe.expire(other_key, TEST_EXPIRATION).InAnyOrder()
+        self.pipe.srem(new_key, 'name1').InAnyOrder()
+        self.pipe.expire(new_key, TEST_EXPIRATION).InAnyOrder()
+        self.redis_conn.scan_iter(
+            match=membership_cache.get_user_index_pattern(),
+            count=membership_cache.SCAN_COUNT
+        ).AndReturn(iter([email_key, new_key, late_key]))
+        self.pipe.execute()
+
+        membership_cache.find_late_changes(
+            TEST_MEMBERS_BY_LIST,
+            100,
+            {
+                TEST_EMAIL: set(['name1']),
+                'new@example.com': set(['name0'])
+            }
+        ).AndReturn([('late@example.com', 'name1', True)])
+        self.pipe.sadd(late_key, 'name1')
+        self.pipe.expire(late_key, TEST_EXPIRATION)
+        self.pipe.set(
+            membership_cache.get_index_ready_key(),
+            1,
+            ex=TEST_EXPIRATION
+        )
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        membership_cache.build_index(TEST_MEMBERS_BY_LIST, 100)
+
+    def test_find_kept_lists(self):
+        self.mox.StubOutWithMock(membership_cache, 'find_newer_emails')
+        get_pending = lambda listname, emails: set()
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.zrange(membership_cache.get_changed_key('name0'), 0, -1)
+        self.pipe.zrange(membership_cache.get_changed_key('name1'), 0, -1)
+        self.pipe.execute().AndReturn([[TEST_EMAIL, TEST_OTHER_EMAIL], []])
+        membership_cache.find_newer_emails(
+            'name0',
+            [TEST_EMAIL, TEST_OTHER_EMAIL],
+            100,
+            get_pending
+        ).AndReturn((set([TEST_EMAIL]), set([TEST_OTHER_EMAIL])))
+        membership_cache.find_newer_emails(
+            'name1',
+            [],
+            100,
+            get_pending
+        ).AndReturn((set(), set()))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            {
+                TEST_EMAIL: set(['name0']),
+                TEST_OTHER_EMAIL: set(['name0'])
+            },
+            membership_cache.find_kept_lists(
+                ['name1', 'name0'],
+                100,
+                get_pending
+            )
+        )
+
+    def test_find_late_changes(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.zrangebyscore(
+            membership_cache.get_changed_key('name0'),
+            100,
+            '+inf'
+        )
+        self.pipe.execute().AndReturn([[TEST_EMAIL, TEST_OTHER_EMAIL]])
+        self.pipe.sismember(
+            membership_cache.get_list_key('name0'),
+            TEST_OTHER_EMAIL
+        )
+        self.pipe.execute().AndReturn([False])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            [(TEST_OTHER_EMAIL, 'name0', False)],
+            membership_cache.find_late_changes(
+                ['name0'],
+                100,
+                {TEST_EMAIL: set(['name0'])}
+            )
+        )
+
+    def test_store_list_members_keeps_newer_changes(self):
+        self.mox.StubOutWithMock(membership_cache, 'diff_list_members')
+        self.mox.StubOutWithMock(membership_cache, 'find_newer_emails')
+        list_key = membership_cache.get_list_key('name0')
+        changed_key = membership_cache.get_changed_key('name0')
+
+        membership_cache.diff_list_members(
+            'name0',
+            [TEST_EMAIL, 'new@example.com']
+        ).AndReturn((
+            set(['new@example.com']),
+            set([TEST_OTHER_EMAIL, 'queued@example.com'])
+        ))
+        membership_cache.find_newer_emails(
+            'name0',
+            set([
+                'new@example.com',
+                TEST_OTHER_EMAIL,
+                'queued@example.com'
+            ]),
+            100,
+            None
+        ).AndReturn((
+            set(['new@example.com']),
+            set(['queued@example.com'])
+        ))
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.delete(list_key)
+        self.pipe.sadd(list_key, 'queued@example.com', TEST_EMAIL)
+        self.pipe.expire(list_key, TEST_EXPIRATION)
+        self.pipe.set(
+            membership_cache.get_list_ready_key('name0'),
+            1,
+            ex=TEST_EXPIRATION
+        )
+        self.pipe.zremrangebyscore(changed_key, 0, 100)
+        self.pipe.zadd(changed_key, **{'queued@example.com': 100})
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        membership_cache.store_list_members(
+            'name0',
+            [TEST_EMAIL, 'new@example.com'],
+            100
+        )
+
+    def test_diff_list_members(self):
+        list_key = membership_cache.get_list_key('name0')
+        scratch_key = membership_cache.get_reconcile_key('name0')
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.delete(scratch_key)
+        self.pipe.sadd(scratch_key, TEST_EMAIL, TEST_OTHER_EMAIL)
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        self.pipe.expire(scratch_key, TEST_EXPIRATION)
+        self.pipe.sdiff(scratch_key, list_key)
+        self.pipe.sdiff(list_key, scratch_key)
+        self.pipe.delete(scratch_key)
+        self.pipe.execute().AndReturn([
+            1,
+            2,
+            True,
+            set([TEST_OTHER_EMAIL]),
+            set(['gone@example.com']),
+            1
+        ])
+
+        self.mox.ReplayAll()
+
+        added, removed = membership_cache.diff_list_members(
+            'name0',
+            TEST_MEMBERS_BY_LIST['name0']
+        )
+        self.assertEqual(set([TEST_OTHER_EMAIL]), added)
+        self.assertEqual(set(['gone@example.com']), removed)
+
+    def test_find_newer_emails(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.zrangebyscore(
+            membership_cache.get_changed_key('name0'),
+            100,
+            '+inf'
+        ).AndReturn(['new@example.com', 'unrelated@example.com'])
+
+        self.mox.ReplayAll()
+
+        changed, pending = membership_cache.find_newer_emails(
+            'name0',
+            ['gone@example.com', 'new@example.com', 'queued@example.com'],
+            100,
+            lambda listname, emails: set(['queued@example.com']) & set(emails)
+        )
+        self.assertEqual(set(['new@example.com']), changed)
+        self.assertEqual(set(['queued@example.com']), pending)
+
+    def test_reconcile_list_members(self):
+        self.mox.StubOutWithMock(membership_cache, 'diff_list_members')
+        self.mox.StubOutWithMock(membership_cache, 'find_newer_emails')
+        self.mox.StubOutWithMock(membership_cache, 'update_memberships')
+        list_key = membership_cache.get_list_key('name0')
+        changed_key = membership_cache.get_changed_key('name0')
+
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        membership_cache.diff_list_members(
+            'name0',
+            TEST_MEMBERS_BY_LIST['name0']
+        ).AndReturn((
+            set([TEST_OTHER_EMAIL]),
+            set(['gone@example.com', 'new@example.com', 'queued@example.com'])
+        ))
+        membership_cache.find_newer_emails(
+            'name0',
+            set([
+                TEST_OTHER_EMAIL,
+                'gone@example.com',
+                'new@example.com',
+                'queued@example.com'
+            ]),
+            100,
+            None
+        ).AndReturn((
+            set(['new@example.com']),
+            set(['queued@example.com'])
+        ))
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        membership_cache.update_memberships(
+            TEST_OTHER_EMAIL,
+            ['name0'],
+            [],
+            self.pipe
+        )
+        membership_cache.update_memberships(
+            'gone@example.com',
+            [],
+            ['name0'],
+            self.pipe
+        )
+        self.pipe.expire(
+            membership_cache.get_user_index_key(TEST_EMAIL),
+            TEST_EXPIRATION
+        )
+        self.pipe.expire(
+            membership_cache.get_user_index_key(TEST_OTHER_EMAIL),
+            TEST_EXPIRATION
+        )
+        self.pipe.expire(list_key, TEST_EXPIRATION)
+        self.pipe.set(
+            membership_cache.get_list_ready_key('name0'),
+            1,
+            ex=TEST_EXPIRATION
+        )
+        self.pipe.zremrangebyscore(changed_key, 0, 100)
+        self.pipe.zadd(changed_key, **{'queued@example.com': 100})
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        added, removed, skipped = membership_cache.reconcile_list_members(
+            'name0',
+            TEST_MEMBERS_BY_LIST['name0'],
+            100
+        )
+        self.assertEqual([TEST_OTHER_EMAIL], added)
+        self.assertEqual(['gone@example.com'], removed)
+        self.assertEqual(['new@example.com', 'queued@example.com'], skipped)
+
+    def test_invalidate_list(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.delete(membership_cache.get_list_ready_key('name0'))
+
+        self.mox.ReplayAll()
+
+        membership_cache.invalidate_list('name0')
+
+    def test_get_user_lists(self):
+        key = membership_cache.get_user_index_key(TEST_EMAIL)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(membership_cache.get_index_ready_key())
+        self.pipe.smembers(key)
+        self.pipe.execute().AndReturn([True, set(['name1', 'name0'])])
+
+        self.mox.ReplayAll()
+
+        results = membership_cache.get_user_lists(TEST_EMAIL)
+        self.assertEqual(['name0', 'name1'], results)
+
+    def test_get_user_lists_not_ready(self):
+        key = membership_cache.get_user_index_key(TEST_EMAIL)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(membership_cache.get_index_ready_key())
+        self.pipe.smembers(key)
+        self.pipe.execute().AndReturn([False, set()])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(None, membership_cache.get_user_lists(TEST_EMAIL))
+
+    def test_get_list_members(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(membership_cache.get_list_ready_key('name0'))
+        self.pipe.smembers(membership_cache.get_list_key('name0'))
+        self.pipe.execute().AndReturn([True, set([TEST_EMAIL])])
+
+        self.mox.ReplayAll()
+
+        results = membership_cache.get_list_members('name0')
+        self.assertEqual([TEST_EMAIL], results)
+
+    def test_get_list_memberships(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        for listname in ['name0', 'name1', 'name2']:
+            self.pipe.exists(membership_cache.get_list_ready_key(listname))
+            self.pipe.sismember(
+                membership_cache.get_list_key(listname),
+                TEST_EMAIL
+            )
+        self.pipe.execute().AndReturn([True, True, True, False, False, False])
+
+        self.mox.ReplayAll()
+
+        results = membership_cache.get_list_memberships(
+            ['name0', 'name1', 'name2'],
+            TEST_EMAIL
+        )
+        self.assertEqual(
+            {'name0': True, 'name1': False, 'name2': None},
+            results
+        )
+
+    def test_update_memberships(self):
+        self.mox.StubOutWithMock(membership_cache, 'record_changes')
+        index_key = membership_cache.get_user_index_key(TEST_EMAIL)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.sadd(membership_cache.get_list_key('name0'), TEST_EMAIL)
+        self.pipe.sadd(membership_cache.get_list_key('name1'), TEST_EMAIL)
+        self.pipe.srem(membership_cache.get_list_key('name2'), TEST_EMAIL)
+        self.pipe.sadd(index_key, 'name0', 'name1')
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        self.pipe.expire(index_key, TEST_EXPIRATION)
+        self.pipe.srem(index_key, 'name2')
+        membership_cache.record_changes(
+            TEST_EMAIL,
+            ['name0', 'name1', 'name2'],
+            self.pipe
+        )
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        membership_cache.update_memberships(
+            TEST_EMAIL,
+            ['name0', 'name1'],
+            ['name2']
+        )
+
+    def test_update_memberships_on_pipe(self):
+        self.mox.StubOutWithMock(membership_cache, 'record_changes')
+        self.pipe.srem(membership_cache.get_list_key('name0'), TEST_EMAIL)
+        self.pipe.srem(
+            membership_cache.get_user_index_key(TEST_EMAIL),
+            'name0'
+        )
+        membership_cache.record_changes(TEST_EMAIL, ['name0'], self.pipe)
+
+        self.mox.ReplayAll()
+
+        membership_cache.update_memberships(
+            TEST_EMAIL,
+            [],
+            ['name0'],
+            self.pipe
+        )
+
+    def test_record_changes(self):
+        changed_key = membership_cache.get_changed_key('name0')
+        membership_cache.get_expiration().AndReturn(TEST_EXPIRATION)
+        self.pipe.zadd(changed_key, **{TEST_EMAIL: mox.IsA(float)})
+        self.pipe.expire(changed_key, TEST_EXPIRATION)
+
+        self.mox.ReplayAll()
+
+        membership_cache.record_changes(TEST_EMAIL, ['name0'], self.pipe)
+
+    def test_get_users_lists(self):
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(membership_cache.get_index_ready_key())
+        self.pipe.smembers(membership_cache.get_user_index_key(TEST_EMAIL))
+        self.pipe.smembers(
+            membership_cache.get_user_index_key('other@example.com')
+        )
+        self.pipe.execute().AndReturn([True, set(['name1', 'name0']), set()])
+
+        self.mox.ReplayAll()
+
+        results = membership_cache.get_users_lists(
+            [TEST_EMAIL, 'other@example.com']
+        )
+        self.assertEqual(
+            {TEST_EMAIL: ['name0', 'name1'], 'other@example.com': []},
+            results
+        )
@@ -0,0 +1,245 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are kept per process; each worker process reports its own values.
+Recording is a lock-protected dict update so that it can be done on the hot
+path.
+"""
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric created, in creation order, for rendering.
+REGISTRY = []
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = zip(label_names, label_values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, escape_label_value(value))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """Base for metrics with a fixed set of label names."""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        """Create and register a new metric.
+
+        @param name: The metric name.
+        @type name: str
+        @param documentation: The help text for the metric.
+        @type documentation: str
+        @param label_names: The names of the labels values are recorded by.
+        @type label_names: iterable over str
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def get_label_values(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def render_samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        """Render the metric in the Prometheus text exposition format.
+
+        @return: The exposition lines.
+        @rtype: list of str
+        """
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.metric_type)
+        ]
+        with self.lock:
+            lines.extend(self.render_samples())
+        return lines
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """Monotonically increasing count per label values."""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.get_label_values(labels), 0)
+
+    def render_samples(self):
+        return [
+            '%s%s %s' % (
+                self.name,
+                format_labels(self.label_names, key),
+                format_value(value)
+            )
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Value per label values that may go up and down."""
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.get_label_values(labels)] = value
+
+    def render_samples(self):
+        return [
+            '%s%s %s' % (
+                self.name,
+                format_labels(self.label_names, key),
+                format_value(value)
+            )
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Distribution of observed values per label values."""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+            buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.get_label_values(labels)
+        with self.lock:
+            entry = self.values.get(key, None)
+            if entry is None:
+                entry = {'buckets': [0] * len(self.buckets), 'sum': 0}
+                self.values[key] = entry
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing the seconds spent in its block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render_samples(self):
+        lines = []
+        for key, entry in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, entry['buckets']):
+                lines.append('%s_bucket%s %s' % (
+                    self.name,
+                    format_labels(
+                        self.label_names,
+                        key,
+                        ('le', format_value(bound))
+                    ),
+                    format_value(count)
+                ))
+            labels = format_labels(self.label_names, key)
+            lines.append('%s_sum%s %s' % (
+                self.name,
+                labels,
+                format_value(entry['sum'])
+            ))
+            lines.append('%s_count%s %s' % (
+                self.name,
+                labels,
+                format_value(entry['buckets'][-1])
+            ))
+        return lines
+
+
+def render_all():
+    """Render every registered metric in the Prometheus text format.
+
+    @return: The exposition text.
+    @rtype: str
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CACHE_REQUESTS = Counter(
+    'tinysubscriptions_cache_requests_total',
+    'Cache lookups by cached function or membership lookup and result '
+    '(local_hit, hit, stale, miss, error).',
+    ('function', 'result')
+)
+
+SENDGRID_REQUEST_SECONDS = Histogram(
+    'tinysubscriptions_sendgrid_request_seconds',
+    'SendGrid API call latency by action and status code.',
+    ('action', 'status')
+)
+
+SENDGRID_CIRCUIT_STATE = Gauge(
+    'tinysubscriptions_sendgrid_circuit_state',
+    'SendGrid circuit breaker state (0 closed, 1 half open, 2 open).'
+)
+
+SENDGRID_REJECTED_REQUESTS = Counter(
+    'tinysubscriptions_sendgrid_rejected_requests_total',
+    'SendGrid calls failed fast by reason (circuit_open, rate_limited).',
+    ('reason',)
+)
+
+MEMBERSHIP_DRIFT = Counter(
+    'tinysubscriptions_membership_drift_total',
+    'Cached memberships corrected by reconciliation with SendGrid, by '
+    'direction (added, removed).',
+    ('direction',)
+)
+
+MONGO_REQUEST_SECONDS = Histogram(
+    'tinysubscriptions_mongo_request_seconds',
+    'Mongo call latency by operation.',
+    ('operation',)
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'tinysubscriptions_http_request_seconds',
+    'Request latency by endpoint, method and status code.',
+    ('endpoint', 'method', 'status')
+)
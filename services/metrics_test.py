@@ -0,0 +1,55 @@
+"""Tests for metrics
+
+@license: GNU GPLv3
+"""
+import mox
+
+import metrics
+
+
+class MetricsTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.registry = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        metrics.REGISTRY[:] = self.registry
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test.', ('function',))
+        counter.inc(function='get_lists')
+        counter.inc(2, function='get_lists')
+
+        self.assertEqual(3, counter.get(function='get_lists'))
+        self.assertEqual([
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total{function="get_lists"} 3.0'
+        ], counter.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(
+            'test_seconds',
+            'Test.',
+            ('action',),
+            buckets=(0.1, 1)
+        )
+        histogram.observe(0.5, action='GET_LISTS')
+
+        self.assertEqual([
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{action="GET_LISTS",le="0.1"} 0.0',
+            'test_seconds_bucket{action="GET_LISTS",le="1.0"} 1.0',
+            'test_seconds_bucket{action="GET_LISTS",le="+Inf"} 1.0',
+            'test_seconds_sum{action="GET_LISTS"} 0.5',
+            'test_seconds_count{action="GET_LISTS"} 1.0'
+        ], histogram.render())
+
+    def test_label_escaping(self):
+        self.assertEqual(
+            '{name="a\\"b\\\\c\\nd"}',
+            metrics.format_labels(('name',), ('a"b\\c\nd',))
+        )
@@ -0,0 +1,120 @@
+"""Conditional GET and rendered page caching for the HTML pages.
+
+Pages are identified by an ETag fingerprinting everything they are rendered
+from: the page's data (such as a user's subscriptions and the descriptions
+version), the common template values, and the template sources. Requests
+whose If-None-Match matches are answered with 304 Not Modified, and rendered
+pages are kept in a per-process LRU cache keyed by their ETag so that repeat
+views are not rendered again.
+"""
+import hashlib
+import json
+
+import flask
+
+import config_layer
+import util
+
+DEFAULT_PAGE_CACHE_SIZE = 1000
+DEFAULT_PAGE_CACHE_EXPIRATION = 300
+
+# Name of the rendered page cache in util.LOCAL_CACHES.
+PAGE_CACHE_NAME = 'rendered_pages'
+
+# Process-local rendered page cache, created on first use.
+PAGE_CACHE = {'cache': None, 'created': False}
+
+# Fingerprints of template sources by template name, computed once per process.
+TEMPLATE_FINGERPRINTS = {}
+
+
+def get_page_cache():
+    """Get the cache of rendered pages for this process.
+
+    @return: The cache, or None if the PAGE_CACHE_SIZE config is 0.
+    @rtype: util.LocalLRUCache
+    """
+    if not PAGE_CACHE['created']:
+        config_settings = config_layer.get_config()
+        max_size = config_settings.get(
+            'PAGE_CACHE_SIZE',
+            DEFAULT_PAGE_CACHE_SIZE
+        )
+        if max_size:
+            PAGE_CACHE['cache'] = util.LocalLRUCache(
+                max_size,
+                config_settings.get(
+                    'PAGE_CACHE_EXPIRATION',
+                    DEFAULT_PAGE_CACHE_EXPIRATION
+                )
+            )
+            util.LOCAL_CACHES[PAGE_CACHE_NAME] = PAGE_CACHE['cache']
+        PAGE_CACHE['created'] = True
+    return PAGE_CACHE['cache']
+
+
+def get_template_fingerprint(template_name):
+    """Fingerprint a template's source so that ETags change with templates.
+
+    @param template_name: The name of the template.
+    @type template_name: str
+    @return: A hash of the template source, or '' if it cannot be loaded.
+    @rtype: str
+    """
+    fingerprint = TEMPLATE_FINGERPRINTS.get(template_name, None)
+    if fingerprint is None:
+        jinja_env = flask.current_app.jinja_env
+        try:
+            source = jinja_env.loader.get_source(jinja_env, template_name)[0]
+            fingerprint = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        except Exception as e:
+            print 'template fingerprint fail -', e
+            fingerprint = ''
+        TEMPLATE_FINGERPRINTS[template_name] = fingerprint
+    return fingerprint
+
+
+def compute_etag(template_names, *parts):
+    """Compute the ETag of a page.
+
+    @param template_names: The templates the page is rendered with.
+    @type template_names: iterable over str
+    @param parts: JSON-serializable values the page is rendered from.
+    @return: The ETag value, without quotes.
+    @rtype: str
+    """
+    fingerprint = json.dumps(
+        [[get_template_fingerprint(x) for x in template_names], parts],
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha1(fingerprint).hexdigest()
+
+
+def respond(etag, render):
+    """Respond with a page, honoring If-None-Match and the page cache.
+
+    @param etag: The page's ETag, from compute_etag.
+    @type etag: str
+    @param render: Function rendering the page's HTML on a cache miss.
+    @type render: function
+    @return: The response, 304 if the client's copy is current.
+    @rtype: flask.Response
+    """
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        page_cache = get_page_cache()
+        found, html = False, None
+        if page_cache:
+            found, html = page_cache.get(etag)
+        if not found:
+            html = render()
+            if page_cache:
+                page_cache.set(etag, html)
+        response = flask.make_response(html)
+
+    response.set_etag(etag)
+    # Browsers must revalidate since a page changes with its data
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,447 @@
+"""HTTP client for the SendGrid web API.
+
+Keeps a per-process pool of keep-alive connections to SendGrid and retries
+requests that fail with a server error or rate limiting response.
+
+Requests may also be limited to a rate shared by every process through Redis,
+and are failed fast by a circuit breaker while SendGrid is unhealthy instead of
+each waiting for the network timeout.
+"""
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import metrics
+import util
+
+SENDGRID_BASE_API_URL = 'https://api.sendgrid.com/api%s.json'
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_RETRY_DELAY = 30
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+RATE_LIMIT_KEY_PREFIX = 'sendgrid_rate_limit'
+DEFAULT_RATE_LIMIT_WAIT = 5
+
+DEFAULT_CIRCUIT_FAILURES = 5
+DEFAULT_CIRCUIT_RESET = 30
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_HALF_OPEN = 'half_open'
+CIRCUIT_OPEN = 'open'
+
+# Values of the circuit state gauge.
+CIRCUIT_STATE_VALUES = {
+    CIRCUIT_CLOSED: 0,
+    CIRCUIT_HALF_OPEN: 1,
+    CIRCUIT_OPEN: 2
+}
+
+# Takes a token from the bucket at KEYS[1] refilled at ARGV[1] tokens per
+# second up to ARGV[2] tokens, as of time ARGV[3]. Returns 0 if a token was
+# taken, else the seconds until one is available.
+RATE_LIMIT_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1])
+local updated = tonumber(state[2])
+if tokens == nil or updated == nil then
+    tokens = capacity
+    updated = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'updated',
+    tostring(math.max(now, updated)))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class SendGridUnavailableError(Exception):
+    """Raised instead of calling SendGrid while it is considered unhealthy."""
+    pass
+
+
+class SharedRateLimiter:
+    """Token bucket in Redis limiting the request rate across processes."""
+
+    def __init__(self, rate, burst=None, max_wait=DEFAULT_RATE_LIMIT_WAIT):
+        """Create a new rate limiter.
+
+        @param rate: The number of requests allowed per second.
+        @type rate: float
+        @param burst: The number of requests allowed at once after a quiet
+            period. Defaults to one second's worth.
+        @type burst: int
+        @param max_wait: The maximum number of seconds to wait for a request to
+            be allowed before giving up.
+        @type max_wait: float
+        """
+        self.rate = float(rate)
+        self.capacity = burst or max(1, int(rate))
+        self.max_wait = max_wait
+
+    def get_key(self):
+        return util.get_redis_key(RATE_LIMIT_KEY_PREFIX)
+
+    def try_acquire(self):
+        """Try to take a token without waiting.
+
+        @return: 0 if a request is allowed, else the seconds until one is.
+        @rtype: float
+        """
+        return float(util.get_redis_connection().eval(
+            RATE_LIMIT_SCRIPT,
+            1,
+            self.get_key(),
+            self.rate,
+            self.capacity,
+            time.time()
+        ))
+
+    def acquire(self):
+        """Block until a request is allowed.
+
+        The limit is not enforced if Redis cannot be reached.
+
+        @raise SendGridUnavailableError: If no request is allowed within
+            max_wait seconds.
+        """
+        deadline = time.time() + self.max_wait
+        while True:
+            try:
+                wait = self.try_acquire()
+            except Exception as e:
+                print 'rate limit fail -', e
+                return
+
+            if wait <= 0:
+                return
+            if time.time() + wait > deadline:
+                metrics.SENDGRID_REJECTED_REQUESTS.inc(reason='rate_limited')
+                raise SendGridUnavailableError('SendGrid rate limit reached')
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Per-process circuit breaker tracking consecutive SendGrid failures.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are rejected for reset_timeout seconds. A single trial call is then let
+    through (half open): the circuit closes if it succeeds and opens again if
+    it fails.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_CIRCUIT_FAILURES,
+            reset_timeout=DEFAULT_CIRCUIT_RESET):
+        """Create a new, closed circuit breaker.
+
+        @param failure_threshold: The number of consecutive failures opening
+            the circuit.
+        @type failure_threshold: int
+        @param reset_timeout: Seconds the circuit stays open before a trial
+            call.
+        @type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.__lock = threading.Lock()
+        self.set_state(CIRCUIT_CLOSED)
+
+    def set_state(self, state):
+        self.state = state
+        metrics.SENDGRID_CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[state])
+
+    def before_call(self):
+        """Check that a call may be made.
+
+        @raise SendGridUnavailableError: If the circuit is open.
+        """
+        with self.__lock:
+            if self.state == CIRCUIT_OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                self.set_state(CIRCUIT_HALF_OPEN)
+
+            if self.state == CIRCUIT_CLOSED:
+                return
+            if self.state == CIRCUIT_HALF_OPEN and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return
+
+        metrics.SENDGRID_REJECTED_REQUESTS.inc(reason='circuit_open')
+        raise SendGridUnavailableError('SendGrid circuit is open')
+
+    def cancel_call(self):
+        """Record that an allowed call was not made after all."""
+        with self.__lock:
+            self.trial_in_progress = False
+
+    def record_success(self):
+        with self.__lock:
+            self.failures = 0
+            self.trial_in_progress = False
+            if self.state != CIRCUIT_CLOSED:
+                self.set_state(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        with self.__lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.state == CIRCUIT_HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                if self.state != CIRCUIT_OPEN:
+                    print 'SendGrid circuit open after %d failures' % \
+                        self.failures
+                self.set_state(CIRCUIT_OPEN)
+
+
+class SendGridClient:
+    """Session-based SendGrid client with connection pooling and retries."""
+
+    def __init__(self, base_url=SENDGRID_BASE_API_URL,
+            pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+            max_retries=DEFAULT_MAX_RETRIES,
+            retry_backoff=DEFAULT_RETRY_BACKOFF,
+            max_retry_delay=DEFAULT_MAX_RETRY_DELAY, rate_limiter=None,
+            circuit_breaker=None):
+        """Create a new client.
+
+        @param base_url: Format string taking an action url to produce the full
+            SendGrid url.
+        @type base_url: str
+        @param pool_size: The maximum number of connections kept open.
+        @type pool_size: int
+        @param timeout: Seconds to wait for SendGrid to connect or respond.
+        @type timeout: float
+        @param max_retries: The number of times a failed request is retried.
+        @type max_retries: int
+        @param retry_backoff: Seconds to wait before the first retry, doubled
+            on each following retry.
+        @type retry_backoff: float
+        @param max_retry_delay: The most seconds to wait before a retry. A
+            request whose Retry-After asks for longer is not retried.
+        @type max_retry_delay: float
+        @param rate_limiter: Limits the rate of every attempt, if given.
+        @type rate_limiter: SharedRateLimiter
+        @param circuit_breaker: Fails requests fast while SendGrid is
+            unhealthy, if given.
+        @type circuit_breaker: CircuitBreaker
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_delay = max_retry_delay
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_retry_delay(self, attempt, response):
+        """Get the number of seconds to wait before retrying a request.
+
+        @param attempt: The number of attempts made so far, starting at 1.
+        @type attempt: int
+        @param response: The failed response, or None if the request raised.
+        @type response: requests.models.Response
+        @return: Seconds to wait, or None if SendGrid asked to wait longer
+            than max_retry_delay.
+        @rtype: float
+        """
+        delay = min(
+            self.retry_backoff * (2 ** (attempt - 1)),
+            self.max_retry_delay
+        )
+        if response is not None:
+            try:
+                retry_after = float(response.headers['Retry-After'])
+            except (KeyError, TypeError, ValueError):
+                return delay
+            if retry_after > self.max_retry_delay:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def post(self, url, data):
+        """Post to a SendGrid action url.
+
+        @param url: The SendGrid action url to post to.
+        @type url: str
+        @param data: The form data to send, including credentials.
+        @type data: dict
+        @return: The final response from SendGrid.
+        @rtype: requests.models.Response
+        @raise SendGridUnavailableError: If the circuit is open or the rate
+            limit was not freed in time.
+        """
+        if not self.circuit_breaker:
+            return self.post_with_retries(url, data)
+
+        self.circuit_breaker.before_call()
+        try:
+            response = self.post_with_retries(url, data)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self.circuit_breaker.record_failure()
+            raise
+        except SendGridUnavailableError:
+            # Rate limited locally, so SendGrid's health is unknown
+            self.circuit_breaker.cancel_call()
+            raise
+        except requests.exceptions.RequestException:
+            self.circuit_breaker.record_failure()
+            raise
+        except Exception:
+            # Failed before SendGrid answered, so its health is unknown
+            self.circuit_breaker.cancel_call()
+            raise
+
+        if response.status_code in RETRY_STATUS_CODES:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        return response
+
+    def post_with_retries(self, url, data):
+        sendgrid_url = self.base_url % url
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.post(
+                    sendgrid_url,
+                    data=data,
+                    timeout=self.timeout
+                )
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if attempt > self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                if attempt > self.max_retries:
+                    return response
+
+            delay = self.get_retry_delay(attempt, response)
+            if delay is None:
+                return response
+            time.sleep(delay)
+
+
+def create_client():
+    """Create a SendGrid client from the application configs.
+
+    @return: The new client.
+    @rtype: SendGridClient
+    """
+    config = util.get_app_config()
+
+    rate_limiter = None
+    if config.get('SENDGRID_SHARED_RATE_LIMIT', None):
+        rate_limiter = SharedRateLimiter(
+            config['SENDGRID_SHARED_RATE_LIMIT'],
+            burst=config.get('SENDGRID_SHARED_RATE_BURST', None),
+            max_wait=config.get(
+                'SENDGRID_RATE_LIMIT_WAIT',
+                DEFAULT_RATE_LIMIT_WAIT
+            )
+        )
+
+    circuit_breaker = None
+    circuit_failures = config.get(
+        'SENDGRID_CIRCUIT_FAILURES',
+        DEFAULT_CIRCUIT_FAILURES
+    )
+    if circuit_failures:
+        circuit_breaker = CircuitBreaker(
+            failure_threshold=circuit_failures,
+            reset_timeout=config.get(
+                'SENDGRID_CIRCUIT_RESET',
+                DEFAULT_CIRCUIT_RESET
+            )
+        )
+
+    return SendGridClient(
+        base_url=config.get('SENDGRID_BASE_API_URL', SENDGRID_BASE_API_URL),
+        pool_size=config.get('SENDGRID_POOL_SIZE', DEFAULT_POOL_SIZE),
+        timeout=config.get('SENDGRID_TIMEOUT', DEFAULT_TIMEOUT),
+        max_retries=config.get('SENDGRID_MAX_RETRIES', DEFAULT_MAX_RETRIES),
+        retry_backoff=config.get(
+            'SENDGRID_RETRY_BACKOFF',
+            DEFAULT_RETRY_BACKOFF
+        ),
+        max_retry_delay=config.get(
+            'SENDGRID_MAX_RETRY_DELAY',
+            DEFAULT_MAX_RETRY_DELAY
+        ),
+        rate_limiter=rate_limiter,
+        circuit_breaker=circuit_breaker
+    )
+
+
+class AppSendGridKeeper:
+    """Singleton for providing per-process access to the SendGrid client."""
+
+    __instance = None
+
+    __pid = None
+
+    @classmethod
+    def get_instance(cls):
+        # Connections must not be shared with processes forked after creation
+        if cls.__instance == None or cls.__pid != os.getpid():
+            cls.set_instance(create_client())
+        return cls.__instance
+
+    @classmethod
+    def set_instance(cls, client):
+        cls.__instance = client
+        cls.__pid = os.getpid()
+
+
+def get_client():
+    """Get the SendGrid client for this process.
+
+    @return: The client
+    @rtype: SendGridClient
+    """
+    return AppSendGridKeeper.get_instance()
+
+
+def set_client(client):
+    """Replace the SendGrid client for this process, as for a test stub.
+
+    @param client: Any object with a post(url, data) method like
+        SendGridClient.
+    @type client: SendGridClient
+    """
+    AppSendGridKeeper.set_instance(client)
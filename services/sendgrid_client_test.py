@@ -0,0 +1,249 @@
+"""Tests for sendgrid_client
+
+@license: GNU GPLv3
+"""
+import time
+
+import mox
+import requests
+
+import sendgrid_client
+
+TEST_URL = '/newsletter/lists/get'
+TEST_FULL_URL = sendgrid_client.SENDGRID_BASE_API_URL % TEST_URL
+TEST_DATA = {'api_user': 'user', 'api_key': 'key'}
+TEST_TIMEOUT = 5
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class SendGridClientTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.client = sendgrid_client.SendGridClient(
+            timeout=TEST_TIMEOUT,
+            max_retries=2,
+            retry_backoff=1
+        )
+        self.client.session = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(time, 'sleep')
+
+    def test_post(self):
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(200))
+
+        self.mox.ReplayAll()
+
+        response = self.client.post(TEST_URL, TEST_DATA)
+        self.assertEqual(200, response.status_code)
+
+    def test_post_retries_server_errors(self):
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(503))
+        time.sleep(1)
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(429, {'Retry-After': '3'}))
+        time.sleep(3)
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(200))
+
+        self.mox.ReplayAll()
+
+        response = self.client.post(TEST_URL, TEST_DATA)
+        self.assertEqual(200, response.status_code)
+
+    def test_post_retry_after_too_long(self):
+        self.client.max_retry_delay = 10
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(429, {'Retry-After': '3600'}))
+
+        self.mox.ReplayAll()
+
+        response = self.client.post(TEST_URL, TEST_DATA)
+        self.assertEqual(429, response.status_code)
+
+    def test_get_retry_delay_capped(self):
+        self.client.max_retry_delay = 10
+        self.mox.ReplayAll()
+
+        response = FakeResponse(429, {'Retry-After': '10'})
+        self.assertEqual(10, self.client.get_retry_delay(5, None))
+        self.assertEqual(10, self.client.get_retry_delay(1, response))
+
+    def test_post_retries_exhausted(self):
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndRaise(requests.exceptions.ConnectionError())
+        time.sleep(1)
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(500))
+        time.sleep(2)
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(500))
+
+        self.mox.ReplayAll()
+
+        response = self.client.post(TEST_URL, TEST_DATA)
+        self.assertEqual(500, response.status_code)
+
+    def test_post_client_errors_not_retried(self):
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndReturn(FakeResponse(400))
+
+        self.mox.ReplayAll()
+
+        response = self.client.post(TEST_URL, TEST_DATA)
+        self.assertEqual(400, response.status_code)
+
+    def test_post_other_error_ends_circuit_trial(self):
+        breaker = sendgrid_client.CircuitBreaker(failure_threshold=1)
+        breaker.set_state(sendgrid_client.CIRCUIT_HALF_OPEN)
+        self.client.circuit_breaker = breaker
+        self.client.session.post(
+            TEST_FULL_URL,
+            data=TEST_DATA,
+            timeout=TEST_TIMEOUT
+        ).AndRaise(requests.exceptions.TooManyRedirects())
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(
+            requests.exceptions.TooManyRedirects,
+            self.client.post,
+            TEST_URL,
+            TEST_DATA
+        )
+        self.assertFalse(breaker.trial_in_progress)
+        self.assertEqual(sendgrid_client.CIRCUIT_OPEN, breaker.state)
+
+
+class CircuitBreakerTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(time, 'time')
+        self.breaker = sendgrid_client.CircuitBreaker(
+            failure_threshold=2,
+            reset_timeout=30
+        )
+
+    def test_opens_after_consecutive_failures(self):
+        time.time().AndReturn(100)
+
+        self.mox.ReplayAll()
+
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(sendgrid_client.CIRCUIT_OPEN, self.breaker.state)
+
+    def test_rejects_while_open(self):
+        time.time().AndReturn(100)
+        time.time().AndReturn(110)
+
+        self.mox.ReplayAll()
+
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertRaises(
+            sendgrid_client.SendGridUnavailableError,
+            self.breaker.before_call
+        )
+
+    def test_half_open_trial(self):
+        time.time().AndReturn(100)
+        time.time().AndReturn(130)
+
+        self.mox.ReplayAll()
+
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.assertEqual(sendgrid_client.CIRCUIT_HALF_OPEN, self.breaker.state)
+        self.assertRaises(
+            sendgrid_client.SendGridUnavailableError,
+            self.breaker.before_call
+        )
+        self.breaker.record_success()
+        self.assertEqual(sendgrid_client.CIRCUIT_CLOSED, self.breaker.state)
+
+    def test_success_resets_failures(self):
+        self.mox.ReplayAll()
+
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(sendgrid_client.CIRCUIT_CLOSED, self.breaker.state)
+
+
+class SharedRateLimiterTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.limiter = sendgrid_client.SharedRateLimiter(10, max_wait=1)
+        self.mox.StubOutWithMock(self.limiter, 'try_acquire')
+        self.mox.StubOutWithMock(time, 'time')
+        self.mox.StubOutWithMock(time, 'sleep')
+
+    def test_acquire_waits(self):
+        time.time().AndReturn(100)
+        self.limiter.try_acquire().AndReturn(0.1)
+        time.time().AndReturn(100)
+        time.sleep(0.1)
+        self.limiter.try_acquire().AndReturn(0)
+
+        self.mox.ReplayAll()
+
+        self.limiter.acquire()
+
+    def test_acquire_gives_up(self):
+        time.time().AndReturn(100)
+        self.limiter.try_acquire().AndReturn(2)
+        time.time().AndReturn(100)
+
+        self.mox.ReplayAll()
+
+        self.assertRaises(
+            sendgrid_client.SendGridUnavailableError,
+            self.limiter.acquire
+        )
+
+    def test_acquire_ignores_redis_failures(self):
+        time.time().AndReturn(100)
+        self.limiter.try_acquire().AndRaise(Exception('redis down'))
+
+        self.mox.ReplayAll()
+
+        self.limiter.acquire()
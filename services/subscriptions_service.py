@@ -2,14 +2,20 @@
 
 @author: Rory Olsen (rolsen, Gleap LLC 2014)
 """
-import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-import requests
 import sendgrid
 
+import membership_cache
+import metrics
+import sendgrid_client
 import util
+import write_behind
 
-SENDGRID_BASE_API_URL = 'https://api.sendgrid.com/api%s.json'
+SENDGRID_BASE_API_URL = sendgrid_client.SENDGRID_BASE_API_URL
 
 SENDGRID_ACTION_URLS = {
     'GET_LISTS': '/newsletter/lists/get',
@@ -18,9 +24,25 @@ SENDGRID_ACTION_URLS = {
     'DELETE_USER_IN_LIST': '/newsletter/lists/email/delete'
 }
 
+SENDGRID_ACTION_NAMES = dict(
+    (url, name) for name, url in SENDGRID_ACTION_URLS.items()
+)
+
+SUBSCRIBE_ACTION = 'subscribe'
+UNSUBSCRIBE_ACTION = 'unsubscribe'
+
+DEFAULT_FANOUT_WORKERS = 8
+DEFAULT_INDEX_REBUILD_LOCK_TIMEOUT = 600
+
+# CACHE_REQUESTS function labels of the membership cache lookups
+LIST_LOOKUP = 'membership_list'
+INDEX_LOOKUP = 'membership_index'
+
 def post_sendgrid(url, data_params=None):
     """Make a sendgrid HTTPS post to a sendgrid url with some optional data.
 
+    Requests go through the pooled, retrying client from sendgrid_client.
+
     @param url: The sendgrid url to post to.
     @type url: str
     @param data_params: Any additional data parameters to send. User credentials
@@ -28,6 +50,8 @@ def post_sendgrid(url, data_params=None):
     @type data_params: dict
     @return: The response from sendgrid.
     @rtype: requests.models.Response
+    @raise sendgrid_client.SendGridUnavailableError: If SendGrid is failing
+        fast because it is unhealthy or over the rate limit.
     """
     data = {
         'api_user': util.get_app_config()['SENDGRID_API_USERNAME'],
@@ -36,16 +60,29 @@ def post_sendgrid(url, data_params=None):
     if data_params:
         data.update(data_params)
 
-    sendgrid_url = SENDGRID_BASE_API_URL % url
-    response = requests.post(
-        sendgrid_url,
-        data=data
+    action = SENDGRID_ACTION_NAMES.get(url, url)
+    start = time.time()
+    try:
+        response = sendgrid_client.get_client().post(url, data)
+    except sendgrid_client.SendGridUnavailableError:
+        raise
+    except Exception:
+        metrics.SENDGRID_REQUEST_SECONDS.observe(
+            time.time() - start,
+            action=action,
+            status='error'
+        )
+        raise
+    metrics.SENDGRID_REQUEST_SECONDS.observe(
+        time.time() - start,
+        action=action,
+        status=response.status_code
     )
 
     if response.status_code != 200:
         print "Sendgrid %d. url: %s, data_params: %s, reason: %s" % (
             response.status_code,
-            sendgrid_url,
+            url,
             str(data_params),
             response.text
         )
@@ -89,6 +126,15 @@ def get_lists():
     if util.get_app_config()['FAKE_SENDGRID']:
         return FakeSendGrid.get_lists()
 
+    return fetch_lists()
+
+
+def fetch_lists():
+    """Fetch all lists that are available for subscription from SendGrid.
+
+    @return: Array of mailing lists.
+    @rtype: iterable over str
+    """
     response = post_sendgrid(SENDGRID_ACTION_URLS['GET_LISTS'])
     if response.status_code == 200:
         data = response.json()
@@ -98,10 +144,109 @@ def get_lists():
         return []
 
 
-@util.redis_cached
 def list_emails_subscribed_to_list(listname):
     """List all emails subscribed to a SengGrid mailing list.
 
+    The membership is answered from the membership cache, which is filled from
+    SendGrid on a miss (see fetch_and_cache_list_emails).
+
+    @param listname: The mailing list name for which to list subscribed emails.
+    @type listname: str
+    @return: An array of email addresses.
+    @rtype: Iterable over str
+    """
+    try:
+        emails = membership_cache.get_list_members(listname)
+    except Exception as e:
+        print 'cache fail -', e
+        record_cache_request(LIST_LOOKUP, 'error')
+        return fetch_list_emails(listname)
+
+    if emails is None:
+        record_cache_request(LIST_LOOKUP, 'miss')
+        emails = fetch_and_cache_list_emails(listname)
+    else:
+        record_cache_request(LIST_LOOKUP, 'hit')
+
+    return emails
+
+
+def record_cache_request(lookup, result, amount=1):
+    """Count membership cache lookups in the CACHE_REQUESTS metric.
+
+    @param lookup: LIST_LOOKUP or INDEX_LOOKUP.
+    @type lookup: str
+    @param result: 'hit', 'miss' or 'error'.
+    @type result: str
+    @param amount: The number of lookups.
+    @type amount: int
+    """
+    metrics.CACHE_REQUESTS.inc(amount, function=lookup, result=result)
+
+
+def fetch_and_cache_list_emails(listname):
+    """Fetch a list's members from SendGrid and cache them, once at a time.
+
+    Only one caller at a time fetches a list whose membership is not cached;
+    other callers wait up to REDIS_LOCK_WAIT seconds for it to be cached
+    before fetching it themselves.
+
+    @param listname: The mailing list name for which to list subscribed emails.
+    @type listname: str
+    @return: An array of email addresses.
+    @rtype: Iterable over str
+    """
+    config = util.get_app_config()
+    ready_key = membership_cache.get_list_ready_key(listname)
+    try:
+        redis_conn = util.get_redis_connection()
+        token = util.acquire_cache_lock(
+            redis_conn,
+            ready_key,
+            config.get('REDIS_LOCK_TIMEOUT', util.DEFAULT_CACHE_LOCK_TIMEOUT)
+        )
+    except Exception as e:
+        print 'cache fail -', e
+        record_cache_request(LIST_LOOKUP, 'error')
+        return fetch_list_emails(listname)
+
+    if token:
+        try:
+            start = time.time()
+            emails = fetch_list_emails(listname)
+            try:
+                membership_cache.store_list_members(
+                    listname,
+                    emails,
+                    start,
+                    write_behind.get_pending_emails
+                )
+            except Exception as e:
+                print 'cache fail -', e
+                record_cache_request(LIST_LOOKUP, 'error')
+            return emails
+        finally:
+            util.release_cache_lock(redis_conn, ready_key, token)
+
+    try:
+        is_ready = util.wait_for_cached(
+            redis_conn,
+            ready_key,
+            config.get('REDIS_LOCK_WAIT', util.DEFAULT_CACHE_LOCK_WAIT)
+        )
+        if is_ready:
+            emails = membership_cache.get_list_members(listname)
+            if emails is not None:
+                return emails
+    except Exception as e:
+        print 'cache fail -', e
+        record_cache_request(LIST_LOOKUP, 'error')
+    return fetch_list_emails(listname)
+
+
+def fetch_list_emails(listname):
+    """Fetch all emails subscribed to a mailing list from SendGrid.
+
     @param listname: The mailing list name for which to list subscribed emails.
     @type listname: str
     @return: An array of email addresses.
@@ -124,13 +269,14 @@ def list_emails_subscribed_to_list(listname):
     return [x['email'] for x in response.json()]
 
 
-@util.redis_cached
 def get_user_subscriptions(email):
     """Get all lists the specified user email is subscribed to.
 
     Get all lists the specified user email is subscribed to from the real
     SendGrid service or the fake SendGrid service if the FAKE_SENDGRID config is
-    True.
+    True. Lookups are answered from the membership index. If the index is not
+    available, it is rebuilt in the background (see start_index_rebuild) and
+    the lookup checks every list's membership instead.
 
     @param email: The user email for which to return list subscriptions.
     @type email: str
@@ -140,76 +286,416 @@ def get_user_subscriptions(email):
     if util.get_app_config()['FAKE_SENDGRID']:
         return FakeSendGrid.get_subscriptions(email)
 
-    lists = get_lists()
+    subscriptions = read_membership_index(
+        membership_cache.get_user_lists,
+        email
+    )
+    if subscriptions is None:
+        subscriptions = find_user_subscriptions(email)
+
+    return subscriptions
+
+
+def get_users_subscriptions(emails):
+    """Get all lists each of many user emails is subscribed to.
+
+    Lookups are answered from the membership index in one round trip. If the
+    index is unavailable, it is rebuilt in the background and every list's
+    membership is read once and shared by all emails.
+
+    @param emails: The user emails for which to return list subscriptions.
+    @type emails: iterable over str
+    @return: Dict of email to array of mailing lists.
+    @rtype: dict
+    """
+    emails = list(emails)
+    if util.get_app_config()['FAKE_SENDGRID']:
+        return dict(
+            (email, FakeSendGrid.get_subscriptions(email))
+            for email in emails
+        )
+
+    subscriptions = read_membership_index(
+        membership_cache.get_users_lists,
+        emails
+    )
+    if subscriptions is None:
+        members_by_list = dict(
+            (item, set(list_emails_subscribed_to_list(item)))
+            for item in get_lists()
+        )
+        subscriptions = dict(
+            (email, sorted(
+                item for item, members in members_by_list.iteritems()
+                if email in members
+            ))
+            for email in emails
+        )
+
+    return subscriptions
+
+
+def read_membership_index(read_index, *args):
+    """Read the membership index, rebuilding it in the background if missing.
+
+    @param read_index: The membership_cache function reading the index.
+    @type read_index: function
+    @return: The result of read_index, or None if the index is unavailable.
+    """
+    try:
+        result = read_index(*args)
+    except Exception as e:
+        print 'membership index fail -', e
+        record_cache_request(INDEX_LOOKUP, 'error')
+        return None
+
+    if result is not None:
+        record_cache_request(INDEX_LOOKUP, 'hit')
+        return result
+
+    record_cache_request(INDEX_LOOKUP, 'miss')
+    try:
+        start_index_rebuild()
+    except Exception as e:
+        print 'membership index fail -', e
+    return None
+
+
+def find_user_subscriptions(email):
+    """Find the lists a user is subscribed to by checking every list.
+
+    Cached lists are checked in one round trip (see
+    membership_cache.get_list_memberships); only lists whose membership is not
+    cached are read in full.
+
+    @param email: The user email for which to return list subscriptions.
+    @type email: str
+    @return: Array of mailing lists
+    @rtype: iterable over str
+    """
+    listnames = get_lists()
+    try:
+        memberships = membership_cache.get_list_memberships(listnames, email)
+    except Exception as e:
+        print 'cache fail -', e
+        record_cache_request(LIST_LOOKUP, 'error')
+        memberships = {}
+
+    hits = len([x for x in memberships.values() if x is not None])
+    if hits:
+        record_cache_request(LIST_LOOKUP, 'hit', hits)
+
     subscriptions = []
-    for item in lists:
-        if email in list_emails_subscribed_to_list(item):
+    for item in listnames:
+        is_member = memberships.get(item, None)
+        if is_member is None:
+            is_member = email in list_emails_subscribed_to_list(item)
+        if is_member:
             subscriptions.append(item)
 
     return subscriptions
 
 
-def upsert_list(redis, set_operation, func, param, value):
-    key = util.get_redis_key(func, (param,))
-    prior = redis.get(key)
-    if prior:
-        prior = json.loads(prior)
-        value = getattr(set(prior), set_operation)(set([value]))
+def start_index_rebuild():
+    """Rebuild the membership index on a background thread.
 
-    else:
-        value = [value]
-
-    redis.set(key, json.dumps(list(value)))
+    Only one rebuild runs at a time across all processes; callers finding a
+    rebuild in progress return right away. The rebuild holds every list's
+    membership in memory, so sync_cache.py is preferred for large lists.
 
+    @return: True if this call started a rebuild.
+    @rtype: bool
+    """
+    redis_conn = util.get_redis_connection()
+    ready_key = membership_cache.get_index_ready_key()
+    token = util.acquire_cache_lock(
+        redis_conn,
+        ready_key,
+        util.get_app_config().get(
+            'INDEX_REBUILD_LOCK_TIMEOUT',
+            DEFAULT_INDEX_REBUILD_LOCK_TIMEOUT
+        )
+    )
+    if not token:
+        return False
+
+    def target():
+        try:
+            build_membership_index()
+        except Exception as e:
+            print 'membership index fail -', e
+        finally:
+            util.release_cache_lock(redis_conn, ready_key, token)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def build_membership_index():
+    """Rebuild the email to lists membership index from every list."""
+    start = time.time()
+    members_by_list = {}
+    for item in get_lists():
+        members_by_list[item] = list_emails_subscribed_to_list(item)
+
+    membership_cache.build_index(
+        members_by_list,
+        start,
+        write_behind.get_pending_emails
+    )
 
-def subscribe(email, new_subscriptions):
-    """Subscribe a user for a given set of lists.
 
-    Subscribe a user for a given set of lists using the real SendGrid service or
-    the fake SendGrid service if the FAKE_SENDGRID config is True.
+def get_user_data(email):
+    """Get the SendGrid recipient data for a user email.
 
     @param email: email address corresponding to a user
     @type email: str
-    @parm new_subscriptions: the subscriptions to subscribe the user
-        from.
-    @type new_subscriptions: iterable over str
-    @return: The first failing response from SendGrid, the last successful
-        response from SendGrid, or None if new_subscriptions is len() = 0
-    @rtype: requests.models.Response
+    @return: The JSON recipient data for a list add.
+    @rtype: str
     """
-    if util.get_app_config()['FAKE_SENDGRID']:
-        return FakeSendGrid.subscribe(email, new_subscriptions)
-
-    data_str = """{
+    return """{
         "email":"%s",
         "name":"%s"
     }""" % (
         email,
         email.split('@')[0] # Get up until the @ and send that as the name
     )
-    response = None
-    for subscription in new_subscriptions:
-        # Subscribe via SendGrid
-        response = post_sendgrid(
-            SENDGRID_ACTION_URLS['ADD_USER_IN_LIST'],
-            {
-                'list': subscription.replace('_dot_', '.'),
-                'data': data_str
-            }
-        )
-        if response.status_code != 200:
-            return response
 
-        # Update the main cache
-        redis = util.get_redis_connection()
-        upsert_list(redis, 'union', 'list_emails_subscribed_to_list',
-            subscription, value=subscription)
 
-        # Upsert a per user cache
-        upsert_list(redis, 'union', 'get_user_subscriptions', email,
-            value=subscription)
+def add_user_to_list(listname, email):
+    """Add a user to a SendGrid mailing list.
 
-    return response
+    @param listname: The mailing list name.
+    @type listname: str
+    @param email: email address corresponding to a user
+    @type email: str
+    @return: The response from SendGrid.
+    @rtype: requests.models.Response
+    """
+    return post_sendgrid(
+        SENDGRID_ACTION_URLS['ADD_USER_IN_LIST'],
+        {
+            'list': listname.replace('_dot_', '.'),
+            'data': get_user_data(email)
+        }
+    )
+
+
+def add_users_to_list(listname, emails):
+    """Add several users to a SendGrid mailing list in a single request.
+
+    SendGrid takes one recipient per data[] parameter. Its "inserted" count
+    leaves out recipients already on the list.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param emails: email addresses corresponding to users
+    @type emails: list of str
+    @return: The response from SendGrid.
+    @rtype: requests.models.Response
+    """
+    return post_sendgrid(
+        SENDGRID_ACTION_URLS['ADD_USER_IN_LIST'],
+        {
+            'list': listname.replace('_dot_', '.'),
+            'data[]': [get_user_data(email) for email in emails]
+        }
+    )
+
+
+def delete_user_from_list(listname, email):
+    """Remove a user from a SendGrid mailing list.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param email: email address corresponding to a user
+    @type email: str
+    @return: The response from SendGrid.
+    @rtype: requests.models.Response
+    """
+    return post_sendgrid(
+        SENDGRID_ACTION_URLS['DELETE_USER_IN_LIST'],
+        {
+            'list': listname.replace('_dot_', '.'),
+            'email': email
+        }
+    )
+
+
+class SubscriptionResult:
+    """Per-list outcome of a subscription change across several lists."""
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+
+    def add_success(self, listname):
+        self.succeeded.append(listname)
+
+    def add_failure(self, listname, status_code, reason):
+        self.failed[listname] = {
+            'status_code': status_code,
+            'reason': reason
+        }
+
+    def is_success(self):
+        return len(self.failed) == 0
+
+    def get_status_code(self):
+        """Get an HTTP status code summarizing the outcome.
+
+        @return: 200 if every list change succeeded, else the SendGrid status
+            code of the first failed list by name (502 if SendGrid could not
+            be reached).
+        @rtype: int
+        """
+        if self.is_success():
+            return 200
+        first_failure = self.failed[min(self.failed)]
+        return first_failure['status_code'] or 502
+
+    def to_dict(self):
+        return {
+            'succeeded': sorted(self.succeeded),
+            'failed': self.failed
+        }
+
+
+class AppFanoutPoolKeeper:
+    """Singleton for providing per-process access to the fan-out workers."""
+
+    __instance = None
+
+    __pid = None
+
+    @classmethod
+    def get_instance(cls):
+        # Worker threads do not survive into processes forked after creation
+        if cls.__instance == None or cls.__pid != os.getpid():
+            workers = util.get_app_config().get(
+                'SENDGRID_FANOUT_WORKERS',
+                DEFAULT_FANOUT_WORKERS
+            )
+            cls.__instance = ThreadPool(processes=workers)
+            cls.__pid = os.getpid()
+        return cls.__instance
+
+
+def get_fanout_pool():
+    """Get the bounded pool of threads used to make per-list SendGrid calls.
+
+    @return: The pool.
+    @rtype: multiprocessing.pool.ThreadPool
+    """
+    return AppFanoutPoolKeeper.get_instance()
+
+
+def post_list_change(change):
+    """Apply a single subscription change to one list via SendGrid.
+
+    @param change: Tuple of (SUBSCRIBE_ACTION or UNSUBSCRIBE_ACTION, email,
+        listname).
+    @type change: tuple
+    @return: Tuple of (listname, status code or None if SendGrid could not be
+        reached, response text or error)
+    @rtype: tuple
+    """
+    action, email, listname = change
+    try:
+        if action == SUBSCRIBE_ACTION:
+            response = add_user_to_list(listname, email)
+        else:
+            response = delete_user_from_list(listname, email)
+    except sendgrid_client.SendGridUnavailableError as e:
+        return listname, 503, str(e)
+    except Exception as e:
+        print 'Sendgrid fail -', e
+        return listname, None, str(e)
+
+    return listname, response.status_code, response.text
+
+
+def update_subscriptions(email, new_subscriptions, cancel_subscriptions):
+    """Subscribe and unsubscribe a user for given sets of lists.
+
+    The per-list SendGrid calls are made concurrently by a bounded pool of
+    worker threads (see SENDGRID_FANOUT_WORKERS). The changes SendGrid accepted
+    are then applied to the membership cache in a single Redis round trip. The
+    fake SendGrid service is used instead if the FAKE_SENDGRID config is True.
+
+    @param email: email address corresponding to a user
+    @type email: str
+    @param new_subscriptions: the subscriptions to subscribe the user to.
+    @type new_subscriptions: iterable over str
+    @param cancel_subscriptions: the subscriptions to unsubscribe the user
+        from.
+    @type cancel_subscriptions: iterable over str
+    @return: The outcome for every list.
+    @rtype: SubscriptionResult
+    """
+    result = SubscriptionResult()
+
+    if util.get_app_config()['FAKE_SENDGRID']:
+        if new_subscriptions:
+            FakeSendGrid.subscribe(email, new_subscriptions)
+        if cancel_subscriptions:
+            FakeSendGrid.unsubscribe(email, cancel_subscriptions)
+        for listname in list(new_subscriptions) + list(cancel_subscriptions):
+            result.add_success(listname)
+        return result
+
+    changes = [(SUBSCRIBE_ACTION, email, x) for x in new_subscriptions]
+    changes.extend(
+        [(UNSUBSCRIBE_ACTION, email, x) for x in cancel_subscriptions]
+    )
+    if not changes:
+        return result
+
+    if len(changes) == 1:
+        outcomes = [post_list_change(changes[0])]
+    else:
+        outcomes = get_fanout_pool().map(post_list_change, changes)
+
+    added_lists = []
+    removed_lists = []
+    for change, outcome in zip(changes, outcomes):
+        listname, status_code, reason = outcome
+        if status_code != 200:
+            result.add_failure(listname, status_code, reason)
+            continue
+
+        result.add_success(listname)
+        if change[0] == SUBSCRIBE_ACTION:
+            added_lists.append(listname)
+        else:
+            removed_lists.append(listname)
+
+    # Update the membership cache
+    try:
+        membership_cache.update_memberships(email, added_lists, removed_lists)
+    except Exception as e:
+        print 'cache fail -', e
+
+    return result
+
+
+def subscribe(email, new_subscriptions):
+    """Subscribe a user for a given set of lists.
+
+    Subscribe a user for a given set of lists using the real SendGrid service or
+    the fake SendGrid service if the FAKE_SENDGRID config is True.
+
+    @param email: email address corresponding to a user
+    @type email: str
+    @parm new_subscriptions: the subscriptions to subscribe the user
+        to.
+    @type new_subscriptions: iterable over str
+    @return: The outcome for every list.
+    @rtype: SubscriptionResult
+    """
+    return update_subscriptions(email, new_subscriptions, [])
 
 
 def unsubscribe(email, cancel_subscriptions):
@@ -223,33 +709,7 @@ def unsubscribe(email, cancel_subscriptions):
     @parm cancel_subscriptions: the subscriptions to unsubscribe the user
         from.
     @type cancel_subscriptions: iterable over str
-    @return: The first failing response from SendGrid, the last successful
-        response from SendGrid, or None if cancel_subscriptions is len() = 0
-    @rtype: requests.models.Response
+    @return: The outcome for every list.
+    @rtype: SubscriptionResult
     """
-    if util.get_app_config()['FAKE_SENDGRID']:
-        return FakeSendGrid.unsubscribe(email, cancel_subscriptions)
-
-    response = None
-    for subscription in cancel_subscriptions:
-        # Unsubscribe via SendGrid
-        response = post_sendgrid(
-            SENDGRID_ACTION_URLS['DELETE_USER_IN_LIST'],
-            {
-                'list': subscription.replace('_dot_', '.'),
-                'email': email
-            }
-        )
-        if response.status_code != 200:
-            return response
-
-        # Update the main cache
-        redis = util.get_redis_connection()
-        upsert_list(redis, 'difference', 'list_emails_subscribed_to_list',
-            subscription, value=subscription)
-
-        # Upsert the per user cache
-        upsert_list(redis, 'difference', 'get_user_subscriptions', email,
-            value=subscription)
-
-    return response
+    return update_subscriptions(email, [], cancel_subscriptions)
@@ -0,0 +1,272 @@
+"""Tests for subscriptions_service
+
+@license: GNU GPLv3
+"""
+from multiprocessing.pool import ThreadPool
+
+import mox
+
+import membership_cache
+import metrics
+import subscriptions_service
+import util
+import write_behind
+
+TEST_EMAIL = 'test@example.com'
+
+ADD_URL = subscriptions_service.SENDGRID_ACTION_URLS['ADD_USER_IN_LIST']
+DELETE_URL = subscriptions_service.SENDGRID_ACTION_URLS['DELETE_USER_IN_LIST']
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, text='test response'):
+        self.status_code = status_code
+        self.text = text
+
+
+class SubscriptionsServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(util, 'get_app_config')
+        self.mox.StubOutWithMock(subscriptions_service, 'get_fanout_pool')
+        self.mox.StubOutWithMock(subscriptions_service, 'post_sendgrid')
+        self.mox.StubOutWithMock(membership_cache, 'update_memberships')
+
+        util.get_app_config().AndReturn({'FAKE_SENDGRID': False})
+
+    def test_update_subscriptions(self):
+        subscriptions_service.get_fanout_pool().AndReturn(ThreadPool(1))
+        subscriptions_service.post_sendgrid(
+            ADD_URL,
+            {
+                'list': 'name0',
+                'data': subscriptions_service.get_user_data(TEST_EMAIL)
+            }
+        ).AndReturn(FakeResponse(200))
+        subscriptions_service.post_sendgrid(
+            DELETE_URL,
+            {'list': 'name1', 'email': TEST_EMAIL}
+        ).AndReturn(FakeResponse(200))
+        membership_cache.update_memberships(TEST_EMAIL, ['name0'], ['name1'])
+
+        self.mox.ReplayAll()
+
+        result = subscriptions_service.update_subscriptions(
+            TEST_EMAIL,
+            ['name0'],
+            ['name1']
+        )
+        self.assertTrue(result.is_success())
+        self.assertEqual(200, result.get_status_code())
+        self.assertEqual(['name0', 'name1'], result.to_dict()['succeeded'])
+
+    def test_update_subscriptions_partial_failure(self):
+        subscriptions_service.get_fanout_pool().AndReturn(ThreadPool(1))
+        subscriptions_service.post_sendgrid(
+            ADD_URL,
+            {
+                'list': 'name0',
+                'data': subscriptions_service.get_user_data(TEST_EMAIL)
+            }
+        ).AndReturn(FakeResponse(503, 'unavailable'))
+        subscriptions_service.post_sendgrid(
+            ADD_URL,
+            {
+                'list': 'name1',
+                'data': subscriptions_service.get_user_data(TEST_EMAIL)
+            }
+        ).AndReturn(FakeResponse(200))
+        membership_cache.update_memberships(TEST_EMAIL, ['name1'], [])
+
+        self.mox.ReplayAll()
+
+        result = subscriptions_service.update_subscriptions(
+            TEST_EMAIL,
+            ['name0', 'name1'],
+            []
+        )
+        self.assertFalse(result.is_success())
+        self.assertEqual(503, result.get_status_code())
+        self.assertEqual(['name1'], result.to_dict()['succeeded'])
+        self.assertEqual(
+            'unavailable',
+            result.to_dict()['failed']['name0']['reason']
+        )
+
+
+class ListMembershipTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.redis_conn = self.mox.CreateMockAnything()
+        self.ready_key = membership_cache.get_list_ready_key('name0')
+        self.mox.StubOutWithMock(util, 'get_app_config')
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+        self.mox.StubOutWithMock(util, 'acquire_cache_lock')
+        self.mox.StubOutWithMock(util, 'release_cache_lock')
+        self.mox.StubOutWithMock(util, 'wait_for_cached')
+        self.mox.StubOutWithMock(subscriptions_service, 'fetch_list_emails')
+        self.mox.StubOutWithMock(membership_cache, 'get_list_members')
+        self.mox.StubOutWithMock(membership_cache, 'store_list_members')
+
+        util.get_app_config().AndReturn({})
+        util.get_redis_connection().AndReturn(self.redis_conn)
+
+    def test_fetch_and_cache_list_emails(self):
+        util.acquire_cache_lock(
+            self.redis_conn,
+            self.ready_key,
+            util.DEFAULT_CACHE_LOCK_TIMEOUT
+        ).AndReturn('token')
+        subscriptions_service.fetch_list_emails('name0') \
+            .AndReturn([TEST_EMAIL])
+        membership_cache.store_list_members(
+            'name0',
+            [TEST_EMAIL],
+            mox.IsA(float),
+            write_behind.get_pending_emails
+        )
+        util.release_cache_lock(self.redis_conn, self.ready_key, 'token')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            [TEST_EMAIL],
+            subscriptions_service.fetch_and_cache_list_emails('name0')
+        )
+
+    def test_fetch_and_cache_list_emails_waits_for_other_caller(self):
+        util.acquire_cache_lock(
+            self.redis_conn,
+            self.ready_key,
+            util.DEFAULT_CACHE_LOCK_TIMEOUT
+        ).AndReturn(None)
+        util.wait_for_cached(
+            self.redis_conn,
+            self.ready_key,
+            util.DEFAULT_CACHE_LOCK_WAIT
+        ).AndReturn('1')
+        membership_cache.get_list_members('name0').AndReturn([TEST_EMAIL])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            [TEST_EMAIL],
+            subscriptions_service.fetch_and_cache_list_emails('name0')
+        )
+
+
+class MembershipIndexTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(util, 'get_app_config')
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+        self.mox.StubOutWithMock(util, 'acquire_cache_lock')
+        self.mox.StubOutWithMock(membership_cache, 'get_user_lists')
+
+    def test_get_user_subscriptions_index_not_ready(self):
+        self.mox.StubOutWithMock(subscriptions_service, 'start_index_rebuild')
+        self.mox.StubOutWithMock(
+            subscriptions_service,
+            'find_user_subscriptions'
+        )
+
+        util.get_app_config().AndReturn({'FAKE_SENDGRID': False})
+        membership_cache.get_user_lists(TEST_EMAIL).AndReturn(None)
+        subscriptions_service.start_index_rebuild().AndReturn(True)
+        subscriptions_service.find_user_subscriptions(TEST_EMAIL) \
+            .AndReturn(['name0'])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            ['name0'],
+            subscriptions_service.get_user_subscriptions(TEST_EMAIL)
+        )
+
+    def test_read_membership_index_error(self):
+        errors = metrics.CACHE_REQUESTS.get(
+            function=subscriptions_service.INDEX_LOOKUP,
+            result='error'
+        )
+        membership_cache.get_user_lists(TEST_EMAIL) \
+            .AndRaise(Exception('redis down'))
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            None,
+            subscriptions_service.read_membership_index(
+                membership_cache.get_user_lists,
+                TEST_EMAIL
+            )
+        )
+        self.assertEqual(errors + 1, metrics.CACHE_REQUESTS.get(
+            function=subscriptions_service.INDEX_LOOKUP,
+            result='error'
+        ))
+
+    def test_list_emails_subscribed_to_list_hit(self):
+        self.mox.StubOutWithMock(membership_cache, 'get_list_members')
+        hits = metrics.CACHE_REQUESTS.get(
+            function=subscriptions_service.LIST_LOOKUP,
+            result='hit'
+        )
+        membership_cache.get_list_members('name0').AndReturn([TEST_EMAIL])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            [TEST_EMAIL],
+            subscriptions_service.list_emails_subscribed_to_list('name0')
+        )
+        self.assertEqual(hits + 1, metrics.CACHE_REQUESTS.get(
+            function=subscriptions_service.LIST_LOOKUP,
+            result='hit'
+        ))
+
+    def test_find_user_subscriptions(self):
+        self.mox.StubOutWithMock(subscriptions_service, 'get_lists')
+        self.mox.StubOutWithMock(membership_cache, 'get_list_memberships')
+        self.mox.StubOutWithMock(
+            subscriptions_service,
+            'list_emails_subscribed_to_list'
+        )
+
+        subscriptions_service.get_lists() \
+            .AndReturn(['name0', 'name1', 'name2'])
+        membership_cache.get_list_memberships(
+            ['name0', 'name1', 'name2'],
+            TEST_EMAIL
+        ).AndReturn({'name0': True, 'name1': False, 'name2': None})
+        subscriptions_service.list_emails_subscribed_to_list('name2') \
+            .AndReturn([TEST_EMAIL])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            ['name0', 'name2'],
+            subscriptions_service.find_user_subscriptions(TEST_EMAIL)
+        )
+
+    def test_start_index_rebuild_in_progress(self):
+        redis_conn = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(
+            subscriptions_service,
+            'build_membership_index'
+        )
+
+        util.get_redis_connection().AndReturn(redis_conn)
+        util.get_app_config().AndReturn({})
+        util.acquire_cache_lock(
+            redis_conn,
+            membership_cache.get_index_ready_key(),
+            subscriptions_service.DEFAULT_INDEX_REBUILD_LOCK_TIMEOUT
+        ).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(subscriptions_service.start_index_rebuild())
@@ -0,0 +1,208 @@
+"""Bulk synchronization of the membership cache from SendGrid.
+
+Fetching every list up front lets the cache be warmed at deploy time or on a
+schedule instead of on the first user request after a cache flush.
+"""
+import time
+
+import concurrent_sendgrid
+import config_layer
+import membership_cache
+import metrics
+import subscriptions_service
+import util
+import write_behind
+
+DEFAULT_SYNC_WORKERS = 8
+
+
+def get_sync_workers():
+    return config_layer.get_config().get('SYNC_WORKERS', DEFAULT_SYNC_WORKERS)
+
+
+def fetch_members(lists, workers, config, report):
+    """Fetch the membership of lists from SendGrid concurrently.
+
+    Lists that fail are logged and recorded in report['failed'], and the
+    time taken by each list in report['list_seconds'].
+
+    @param lists: The lists to fetch.
+    @type lists: list of str
+    @param workers: The number of concurrent SendGrid requests.
+    @type workers: int
+    @param config: The app config.
+    @type config: dict
+    @param report: The report of the job fetching the lists.
+    @type report: dict
+    @return: Tuples of (listname, emails) as each list arrives.
+    @rtype: iterable over tuples
+    """
+    client = concurrent_sendgrid.ConcurrentSendGridClient(
+        concurrency=max(1, min(workers, len(lists) or 1)),
+        rate_limit=config.get('SENDGRID_RATE_LIMIT', None)
+    )
+    with client:
+        for listname, emails, error, seconds in client.map_unordered(
+            subscriptions_service.fetch_list_emails,
+            lists
+        ):
+            report['list_seconds'][listname] = seconds
+            if error:
+                print 'sync fail - %s: %s' % (listname, error)
+                report['failed'].append(listname)
+                continue
+
+            yield listname, emails
+
+
+def sync_membership(workers=None):
+    """Fetch the membership of every list from SendGrid and cache it.
+
+    Lists are fetched concurrently by a ConcurrentSendGridClient. Each
+    list's membership is written to the cache as it arrives, and the membership
+    index is rebuilt once every list has been fetched. The index is left alone
+    if any list fails so that it never reflects partial data. Memberships
+    changed in the cache since the fetch started, or with write-behind changes
+    not yet sent, keep their cached state.
+
+    @param workers: The number of concurrent SendGrid requests. Defaults to
+        the SYNC_WORKERS config.
+    @type workers: int
+    @return: A report of the form: {
+        'lists': number of lists,
+        'members': total number of memberships,
+        'failed': ['listname', ...],
+        'list_seconds': {'listname': seconds to fetch, ...},
+        'lists_seconds': seconds to fetch the lists,
+        'fetch_seconds': seconds to fetch and cache all members,
+        'index_seconds': seconds to rebuild the index,
+        'total_seconds': seconds for the whole sync
+    }
+    @rtype: dict
+    """
+    report = {
+        'lists': 0,
+        'members': 0,
+        'failed': [],
+        'list_seconds': {},
+        'lists_seconds': 0,
+        'fetch_seconds': 0,
+        'index_seconds': 0,
+        'total_seconds': 0
+    }
+    config = util.get_app_config()
+    if config['FAKE_SENDGRID']:
+        return report
+
+    if workers is None:
+        workers = get_sync_workers()
+
+    start = time.time()
+    lists = subscriptions_service.fetch_lists()
+    util.set_cached_value('get_lists', (), lists)
+    report['lists'] = len(lists)
+    report['lists_seconds'] = time.time() - start
+
+    fetch_start = time.time()
+    members_by_list = {}
+    for listname, emails in fetch_members(lists, workers, config, report):
+        membership_cache.store_list_members(
+            listname,
+            emails,
+            fetch_start,
+            write_behind.get_pending_emails
+        )
+        members_by_list[listname] = emails
+        report['members'] += len(emails)
+    report['fetch_seconds'] = time.time() - fetch_start
+
+    if not report['failed']:
+        index_start = time.time()
+        membership_cache.build_index(
+            members_by_list,
+            fetch_start,
+            write_behind.get_pending_emails
+        )
+        report['index_seconds'] = time.time() - index_start
+
+    report['total_seconds'] = time.time() - start
+    return report
+
+
+def reconcile_membership(workers=None):
+    """Correct drift between SendGrid and the membership cache.
+
+    Every list's membership is fetched from SendGrid and only the difference
+    from the cached set is applied to the cache and membership index (see
+    membership_cache.reconcile_list_members), so members that have not
+    changed stay cached. Intended to run on a schedule to catch changes made
+    in the SendGrid UI, failed writes and entries lost to expiration.
+    Memberships changed in the cache since the reconciliation started, or
+    with write-behind changes not yet sent, are skipped since the cache is
+    newer than SendGrid for them. The membership index's expiration is
+    extended if every list was reconciled.
+
+    @param workers: The number of concurrent SendGrid requests. Defaults to
+        the SYNC_WORKERS config.
+    @type workers: int
+    @return: A report of the form: {
+        'lists': number of lists,
+        'members': total number of memberships,
+        'added': number of memberships missing from the cache,
+        'removed': number of memberships the cache had but SendGrid did not,
+        'skipped': number of differences left alone as the cache is newer,
+        'drift': {'listname': {'added': n, 'removed': n}, ...} for each list
+            that drifted,
+        'failed': ['listname', ...],
+        'list_seconds': {'listname': seconds to fetch, ...},
+        'total_seconds': seconds for the whole reconciliation
+    }
+    @rtype: dict
+    """
+    report = {
+        'lists': 0,
+        'members': 0,
+        'added': 0,
+        'removed': 0,
+        'skipped': 0,
+        'drift': {},
+        'failed': [],
+        'list_seconds': {},
+        'total_seconds': 0
+    }
+    config = util.get_app_config()
+    if config['FAKE_SENDGRID']:
+        return report
+
+    if workers is None:
+        workers = get_sync_workers()
+
+    start = time.time()
+    lists = subscriptions_service.fetch_lists()
+    util.set_cached_value('get_lists', (), lists)
+    report['lists'] = len(lists)
+
+    for listname, emails in fetch_members(lists, workers, config, report):
+        added, removed, skipped = membership_cache.reconcile_list_members(
+            listname,
+            emails,
+            start,
+            write_behind.get_pending_emails
+        )
+        report['members'] += len(emails)
+        report['skipped'] += len(skipped)
+        if added or removed:
+            report['drift'][listname] = {
+                'added': len(added),
+                'removed': len(removed)
+            }
+            report['added'] += len(added)
+            report['removed'] += len(removed)
+            metrics.MEMBERSHIP_DRIFT.inc(len(added), direction='added')
+            metrics.MEMBERSHIP_DRIFT.inc(len(removed), direction='removed')
+
+    if not report['failed']:
+        membership_cache.extend_index()
+
+    report['total_seconds'] = time.time() - start
+    return report
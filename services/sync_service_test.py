@@ -0,0 +1,108 @@
+"""Tests for sync_service
+
+@license: GNU GPLv3
+"""
+import mox
+
+import membership_cache
+import subscriptions_service
+import sync_service
+import util
+import write_behind
+
+TEST_LISTS = ['name0', 'name1']
+
+TEST_MEMBERS = {
+    'name0': ['test@example.com', 'other@example.com'],
+    'name1': ['test@example.com']
+}
+
+
+class SyncServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.mox.StubOutWithMock(util, 'get_app_config')
+        self.mox.StubOutWithMock(util, 'set_cached_value')
+        self.mox.StubOutWithMock(subscriptions_service, 'fetch_lists')
+        self.mox.StubOutWithMock(subscriptions_service, 'fetch_list_emails')
+        self.mox.StubOutWithMock(membership_cache, 'store_list_members')
+        self.mox.StubOutWithMock(membership_cache, 'build_index')
+
+        util.get_app_config().AndReturn({'FAKE_SENDGRID': False})
+        subscriptions_service.fetch_lists().AndReturn(TEST_LISTS)
+        util.set_cached_value('get_lists', (), TEST_LISTS)
+
+    def test_sync_membership(self):
+        for listname in TEST_LISTS:
+            subscriptions_service.fetch_list_emails(listname) \
+                .AndReturn(TEST_MEMBERS[listname])
+            membership_cache.store_list_members(
+                listname,
+                TEST_MEMBERS[listname],
+                mox.IsA(float),
+                write_behind.get_pending_emails
+            )
+        membership_cache.build_index(
+            TEST_MEMBERS,
+            mox.IsA(float),
+            write_behind.get_pending_emails
+        )
+
+        self.mox.ReplayAll()
+
+        report = sync_service.sync_membership(workers=1)
+        self.assertEqual(2, report['lists'])
+        self.assertEqual(3, report['members'])
+        self.assertEqual([], report['failed'])
+
+    def test_sync_membership_failed_list(self):
+        subscriptions_service.fetch_list_emails('name0') \
+            .AndReturn(TEST_MEMBERS['name0'])
+        membership_cache.store_list_members(
+            'name0',
+            TEST_MEMBERS['name0'],
+            mox.IsA(float),
+            write_behind.get_pending_emails
+        )
+        subscriptions_service.fetch_list_emails('name1') \
+            .AndRaise(ValueError('bad response'))
+
+        self.mox.ReplayAll()
+
+        report = sync_service.sync_membership(workers=1)
+        self.assertEqual(['name1'], report['failed'])
+
+    def test_reconcile_membership(self):
+        self.mox.StubOutWithMock(membership_cache, 'reconcile_list_members')
+        self.mox.StubOutWithMock(membership_cache, 'extend_index')
+        subscriptions_service.fetch_list_emails('name0') \
+            .AndReturn(TEST_MEMBERS['name0'])
+        membership_cache.reconcile_list_members(
+            'name0',
+            TEST_MEMBERS['name0'],
+            mox.IsA(float),
+            write_behind.get_pending_emails
+        ).AndReturn((['other@example.com'], ['gone@example.com'], []))
+        subscriptions_service.fetch_list_emails('name1') \
+            .AndReturn(TEST_MEMBERS['name1'])
+        membership_cache.reconcile_list_members(
+            'name1',
+            TEST_MEMBERS['name1'],
+            mox.IsA(float),
+            write_behind.get_pending_emails
+        ).AndReturn(([], [], ['queued@example.com']))
+        membership_cache.extend_index()
+
+        self.mox.ReplayAll()
+
+        report = sync_service.reconcile_membership(workers=1)
+        self.assertEqual(3, report['members'])
+        self.assertEqual(1, report['added'])
+        self.assertEqual(1, report['removed'])
+        self.assertEqual(1, report['skipped'])
+        self.assertEqual(
+            {'name0': {'added': 1, 'removed': 1}},
+            report['drift']
+        )
+        self.assertEqual([], report['failed'])
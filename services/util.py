@@ -1,12 +1,48 @@
 """Utilities functions for the application."""
+import collections
 import redis
-import json
+import redis.sentinel
+import threading
+import time
+import uuid
 
+import cache_serializer
 import config_layer
+import metrics
 
 POS_DIFF_KEY = 'POS'
 NEG_DIFF_KEY = 'NEG'
 
+DEFAULT_REDIS_NAMESPACE = 'tinysubscriptions'
+
+GENERATION_KEY_PREFIX = 'generation'
+
+DEFAULT_LOCAL_CACHE_EXPIRATION = 10
+
+# In-process cache tiers of redis_cached functions by function name.
+LOCAL_CACHES = {}
+
+CACHE_LOCK_SUFFIX = ':lock'
+DEFAULT_CACHE_LOCK_TIMEOUT = 30
+DEFAULT_CACHE_LOCK_WAIT = 5
+CACHE_LOCK_POLL_INTERVAL = 0.05
+
+# Deletes a lock only if it is still held by the given token.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Resolves the generation of a cached entry (the function's generation in
+# KEYS[1] and its arguments' in KEYS[2]) and reads the entry in one round trip.
+CACHED_READ_SCRIPT = """
+local key = ARGV[1] .. ':' .. (redis.call('get', KEYS[1]) or '0') .. '.' ..
+    (redis.call('get', KEYS[2]) or '0')
+return {key, redis.call('get', key), redis.call('ttl', key)}
+"""
+
 
 def merge_subscriptions_and_descriptions(subscriptions, descriptions):
     """Merge a user subscriptions list and the application-wide descriptions.
@@ -138,8 +174,42 @@ def get_app_config():
     return AppConfigKeeper.get_instance().get_app_config()
 
 
+# Optional connection pool configs by redis.Redis keyword argument.
+REDIS_POOL_CONFIGS = {
+    'max_connections': 'REDIS_MAX_CONNECTIONS',
+    'socket_timeout': 'REDIS_SOCKET_TIMEOUT',
+    'socket_connect_timeout': 'REDIS_SOCKET_CONNECT_TIMEOUT',
+    'socket_keepalive': 'REDIS_SOCKET_KEEPALIVE',
+    'health_check_interval': 'REDIS_HEALTH_CHECK_INTERVAL'
+}
+
+
+def get_redis_pool_options(config_settings):
+    """Get the connection pool options set in the configs.
+
+    Options that are not configured are left to the redis library defaults
+    (and so are not passed to versions that do not support them).
+
+    @param config_settings: The application configs.
+    @type config_settings: dict
+    @return: redis.Redis keyword arguments.
+    @rtype: dict
+    """
+    options = {}
+    for argument, config_name in REDIS_POOL_CONFIGS.items():
+        value = config_settings.get(config_name, None)
+        if value is not None:
+            options[argument] = value
+    return options
+
+
 class AppRedisKeeper:
-    """Singleton for providing global access to the app's Redis connection."""
+    """Singleton for providing global access to the app's Redis connections.
+
+    Writes go to the primary. Reads of redis_cached entries go to a read
+    replica if one is configured (REDIS_REPLICA_HOST or, with sentinel, the
+    replicas of REDIS_SENTINEL_SERVICE), else to the primary.
+    """
 
     __instance = None
 
@@ -152,61 +222,466 @@ class AppRedisKeeper:
     def __init__(self):
         config_settings = config_layer.get_config()
 
-        host = config_settings['REDIS_HOST']
-        port = config_settings['REDIS_PORT']
         db = config_settings['REDIS_DB']
         password = config_settings['REDIS_PASSWORD']
-        expiration = config_settings['REDIS_EXPIRATION']
+        options = get_redis_pool_options(config_settings)
+        sentinels = config_settings.get('REDIS_SENTINELS', None)
+
+        if sentinels:
+            sentinel = redis.sentinel.Sentinel(
+                [tuple(address) for address in sentinels],
+                socket_timeout=options.get('socket_timeout', None)
+            )
+            service = config_settings['REDIS_SENTINEL_SERVICE']
+            self.redis_conn = sentinel.master_for(
+                service,
+                db=db,
+                password=password,
+                **options
+            )
+            self.redis_read_conn = self.redis_conn
+            if config_settings.get('REDIS_READ_FROM_REPLICAS', False):
+                self.redis_read_conn = sentinel.slave_for(
+                    service,
+                    db=db,
+                    password=password,
+                    **options
+                )
+            return
 
-        self.redis_conn = redis.Redis(
-            host=host,
-            port=port,
-            db=db,
-            password=password
-        )
+        unix_socket_path = config_settings.get('REDIS_UNIX_SOCKET_PATH', None)
+        if unix_socket_path:
+            self.redis_conn = redis.Redis(
+                unix_socket_path=unix_socket_path,
+                db=db,
+                password=password,
+                **options
+            )
+        else:
+            self.redis_conn = redis.Redis(
+                host=config_settings['REDIS_HOST'],
+                port=config_settings['REDIS_PORT'],
+                db=db,
+                password=password,
+                **options
+            )
+
+        self.redis_read_conn = self.redis_conn
+        replica_host = config_settings.get('REDIS_REPLICA_HOST', None)
+        if replica_host:
+            self.redis_read_conn = redis.Redis(
+                host=replica_host,
+                port=config_settings.get(
+                    'REDIS_REPLICA_PORT',
+                    config_settings['REDIS_PORT']
+                ),
+                db=db,
+                password=password,
+                **options
+            )
 
 
 def get_redis_connection():
     """Get the Redis cache connection.
 
-    @return: The Redis connection
+    @return: The Redis connection to the primary.
     @rtype: redis.Redis
     """
     return AppRedisKeeper.get_instance().redis_conn
 
 
+def get_redis_read_connection():
+    """Get the Redis connection for reads that may lag behind the primary.
+
+    @return: The Redis connection to a read replica if one is configured, else
+        to the primary.
+    @rtype: redis.Redis
+    """
+    return AppRedisKeeper.get_instance().redis_read_conn
+
+
 def args_to_str(*args):
     return ','.join(map(str, args))
 
 
-def get_redis_key(func, *args):
-    func_str = func
-    if not isinstance(func, basestring):
-        func_str = func.__name__
+def get_redis_namespace():
+    """Get the prefix shared by all of this application's Redis keys.
+
+    @return: The REDIS_NAMESPACE config or DEFAULT_REDIS_NAMESPACE.
+    @rtype: str
+    """
+    return config_layer.get_config().get(
+        'REDIS_NAMESPACE',
+        DEFAULT_REDIS_NAMESPACE
+    )
 
-    return func_str + args_to_str(args).replace('.', '_dot_')
 
+def get_func_str(func):
+    if isinstance(func, basestring):
+        return func
+    return func.__name__
 
-def redis_cached(cache_miss_func):
-    """Decorator that caches a function + parameters to a Redis instance.
+
+def encode_key_args(args):
+    """Encode unicode arguments so that keys do not depend on the str type."""
+    return tuple(
+        arg.encode('utf-8') if isinstance(arg, unicode) else arg
+        for arg in args
+    )
+
+
+def get_redis_key(func, args=()):
+    """Get the namespaced Redis key for a function and its arguments.
+
+    @param func: The function or the name of the cached entry type.
+    @type func: function or str
+    @param args: The arguments the entry is for.
+    @type args: tuple
+    @return: A key of the form 'namespace:func:args'
+    @rtype: str
+    """
+    return '%s:%s:%s' % (
+        get_redis_namespace(),
+        get_func_str(func),
+        str(encode_key_args(args)).replace('.', '_dot_')
+    )
+
+
+def get_generation_key(func, args=None):
+    """Get the Redis key of the generation counter of cached entries.
+
+    @param func: The function or the name of the cached entry type.
+    @type func: function or str
+    @param args: The arguments the entries are for, or None for the counter
+        shared by every entry of the function.
+    @type args: tuple
+    @return: The Redis key.
+    @rtype: str
+    """
+    if args is None:
+        return get_redis_key(GENERATION_KEY_PREFIX, (get_func_str(func),))
+    return get_redis_key(
+        GENERATION_KEY_PREFIX,
+        (get_func_str(func), encode_key_args(args))
+    )
+
+
+def get_versioned_key(key, func_generation, args_generation):
+    """Get the key of a cached entry at a generation.
+
+    @param key: The key of the entry, from get_redis_key.
+    @type key: str
+    @param func_generation: The function's generation, None if never bumped.
+    @param args_generation: The arguments' generation, None if never bumped.
+    @return: The key, of the form CACHED_READ_SCRIPT computes.
+    @rtype: str
+    """
+    return '%s:%s.%s' % (key, func_generation or 0, args_generation or 0)
+
+
+def invalidate_cached(func, args=None):
+    """Invalidate the cached entries of a function in O(1).
+
+    Entries are keyed by generation counters of the function and of its
+    arguments (see redis_cached), so bumping a counter makes every entry of
+    the function, or only the entry for args, unreachable. Unreachable entries
+    are not deleted but expire with REDIS_EXPIRATION. The counters are kept
+    without expiration. This process's local tier for the function is
+    cleared; other processes' expire on their own.
+
+    @param func: The function or the name of the cached entry type.
+    @type func: function or str
+    @param args: The arguments of the entry to invalidate, or None for every
+        entry of the function.
+    @type args: tuple
+    @return: The new generation.
+    @rtype: int
+    """
+    local_cache = LOCAL_CACHES.get(get_func_str(func), None)
+    if local_cache:
+        local_cache.clear()
+
+    return get_redis_connection().incr(get_generation_key(func, args))
+
+
+def set_cached_value(func, args, value):
+    """Store a value as the cached result of a redis_cached function call.
+
+    @param func: The name of the redis_cached function.
+    @type func: str
+    @param args: The positional arguments of the call.
+    @type args: tuple
+    @param value: The JSON-serializable result of the call.
+    """
+    expiration = config_layer.get_config()['REDIS_EXPIRATION']
+    redis_conn = get_redis_connection()
+    func_generation, args_generation = redis_conn.mget(
+        get_generation_key(func),
+        get_generation_key(func, args)
+    )
+    key = get_versioned_key(
+        get_redis_key(func, args),
+        func_generation,
+        args_generation
+    )
+    redis_conn.setex(key, cache_serializer.dumps(value), expiration)
+
+
+class LocalLRUCache:
+    """Size-bounded, thread-safe in-process cache with expiring entries.
+
+    Values are stored as returned and shared between callers, so they must not
+    be modified.
+    """
+
+    def __init__(self, max_size, expiration):
+        """Create a new cache.
+
+        @param max_size: The maximum number of entries kept.
+        @type max_size: int
+        @param expiration: Seconds after which an entry is discarded.
+        @type expiration: float
+        """
+        self.max_size = max_size
+        self.expiration = expiration
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """Get an entry, marking it as most recently used.
+
+        @param key: The entry key.
+        @type key: str
+        @return: Tuple of (True, value) or (False, None) if there is no
+            unexpired entry.
+        @rtype: tuple
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return False, None
+
+            self.__entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.time() + self.expiration, value)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def get_stats(self):
+        """Get the counters of this cache.
+
+        @return: Dict with hits, misses, evictions, and size.
+        @rtype: dict
+        """
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.__entries)
+            }
+
+
+def create_local_cache(func):
+    """Create the in-process cache tier for a redis_cached function.
+
+    Sizes are configured per function name by the LOCAL_CACHE_SIZES config,
+    and entries expire after LOCAL_CACHE_EXPIRATION seconds.
+
+    @param func: The cached function.
+    @type func: function
+    @return: The registered cache, or None if the function has no local tier.
+    @rtype: LocalLRUCache
     """
     config_settings = config_layer.get_config()
-    expiration = config_settings['REDIS_EXPIRATION']
+    func_str = get_func_str(func)
+    max_size = config_settings.get('LOCAL_CACHE_SIZES', {}).get(func_str, 0)
+    if not max_size:
+        return None
+
+    local_cache = LocalLRUCache(
+        max_size,
+        config_settings.get(
+            'LOCAL_CACHE_EXPIRATION',
+            DEFAULT_LOCAL_CACHE_EXPIRATION
+        )
+    )
+    LOCAL_CACHES[func_str] = local_cache
+    return local_cache
 
-    def inner(*args, **kwargs):
-        key = get_redis_key(cache_miss_func, args)
 
-        redis_conn = get_redis_connection()
+def get_local_cache_stats():
+    """Get the counters of every in-process cache tier.
+
+    @return: Dict of the form {'function name': LocalLRUCache.get_stats()}
+    @rtype: dict
+    """
+    return dict(
+        (name, local_cache.get_stats())
+        for name, local_cache in LOCAL_CACHES.items()
+    )
+
+
+def get_cache_lock_key(key):
+    return key + CACHE_LOCK_SUFFIX
+
+
+def acquire_cache_lock(redis_conn, key, timeout):
+    """Try to take the lock for recomputing a cached entry.
+
+    @param redis_conn: The Redis connection.
+    @type redis_conn: redis.Redis
+    @param key: The key of the cached entry.
+    @type key: str
+    @param timeout: Seconds after which the lock is released regardless.
+    @type timeout: int
+    @return: A token identifying the lock holder, or None if the lock is held
+        by another caller.
+    @rtype: str
+    """
+    token = uuid.uuid4().hex
+    if redis_conn.set(get_cache_lock_key(key), token, nx=True, ex=timeout):
+        return token
+    return None
+
+
+def release_cache_lock(redis_conn, key, token):
+    """Release a lock taken by acquire_cache_lock if it is still held."""
+    redis_conn.eval(RELEASE_LOCK_SCRIPT, 1, get_cache_lock_key(key), token)
+
+
+def wait_for_cached(redis_conn, key, wait):
+    """Wait for another caller to finish recomputing a cached entry.
+
+    @param redis_conn: The Redis connection.
+    @type redis_conn: redis.Redis
+    @param key: The key of the cached entry.
+    @type key: str
+    @param wait: The maximum number of seconds to wait.
+    @type wait: float
+    @return: The cached value, or None if it did not appear in time or the
+        other caller gave up.
+    @rtype: str
+    """
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(CACHE_LOCK_POLL_INTERVAL)
         prior = redis_conn.get(key)
+        if prior:
+            return prior
+        if not redis_conn.exists(get_cache_lock_key(key)):
+            return None
+    return None
+
+
+def redis_cached(cache_miss_func=None, soft_expiration=None):
+    """Decorator that caches a function + parameters to a Redis instance.
+
+    Entries expire after REDIS_EXPIRATION seconds. Only one caller at a time
+    recomputes a missing entry; other callers wait up to REDIS_LOCK_WAIT
+    seconds for its result before computing it themselves.
+
+    If a soft expiration is given (as a decorator argument or the
+    REDIS_SOFT_EXPIRATION config), entries older than it are served stale
+    while a single caller refreshes them in the background.
+
+    Functions named in the LOCAL_CACHE_SIZES config additionally keep an
+    in-process LRU tier in front of Redis (see create_local_cache).
 
-        if not prior:
+    Results are encoded with cache_serializer (see CACHE_SERIALIZER).
+
+    Entry keys include the generation counters of the function and of its
+    arguments, which are resolved with the read in a single script call, so
+    that invalidate_cached is O(1).
+
+    Cached entries are read from the read replica if one is configured, while
+    locks and recomputed entries go to the primary.
+
+    @param soft_expiration: Seconds after which an entry is refreshed.
+    @type soft_expiration: int
+    """
+    if cache_miss_func is None:
+        return lambda func: redis_cached(func, soft_expiration)
+
+    func_str = get_func_str(cache_miss_func)
+    config_settings = config_layer.get_config()
+    expiration = config_settings['REDIS_EXPIRATION']
+    if soft_expiration is None:
+        soft_expiration = config_settings.get('REDIS_SOFT_EXPIRATION', None)
+    lock_timeout = config_settings.get(
+        'REDIS_LOCK_TIMEOUT',
+        DEFAULT_CACHE_LOCK_TIMEOUT
+    )
+    lock_wait = config_settings.get('REDIS_LOCK_WAIT', DEFAULT_CACHE_LOCK_WAIT)
+
+    def is_stale(ttl):
+        if not soft_expiration or ttl is None or ttl < 0:
+            return False
+        return expiration - ttl >= soft_expiration
+
+    def refresh(redis_conn, key, token, args, kwargs):
+        try:
             ret_val = cache_miss_func(*args, **kwargs)
-            redis_conn.setex(key, json.dumps(ret_val), expiration)
+            redis_conn.setex(key, cache_serializer.dumps(ret_val), expiration)
             print 'set ' + key
-        else:
-            ret_val = json.loads(prior)
+            return ret_val
+        finally:
+            release_cache_lock(redis_conn, key, token)
 
-        return ret_val
+    def refresh_in_background(redis_conn, key, token, args, kwargs):
+        def target():
+            try:
+                refresh(redis_conn, key, token, args, kwargs)
+            except Exception as e:
+                print 'cache refresh fail -', e
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def inner(*args, **kwargs):
+        redis_conn = get_redis_connection()
+        key, prior, ttl = get_redis_read_connection().eval(
+            CACHED_READ_SCRIPT,
+            2,
+            get_generation_key(cache_miss_func),
+            get_generation_key(cache_miss_func, args),
+            get_redis_key(cache_miss_func, args)
+        )
+
+        if prior:
+            if is_stale(ttl):
+                metrics.CACHE_REQUESTS.inc(function=func_str, result='stale')
+                token = acquire_cache_lock(redis_conn, key, lock_timeout)
+                if token:
+                    refresh_in_background(redis_conn, key, token, args, kwargs)
+            else:
+                metrics.CACHE_REQUESTS.inc(function=func_str, result='hit')
+            return cache_serializer.loads(prior)
+
+        metrics.CACHE_REQUESTS.inc(function=func_str, result='miss')
+        token = acquire_cache_lock(redis_conn, key, lock_timeout)
+        if token:
+            return refresh(redis_conn, key, token, args, kwargs)
+
+        prior = wait_for_cached(redis_conn, key, lock_wait)
+        if prior:
+            return cache_serializer.loads(prior)
+        return cache_miss_func(*args, **kwargs)
 
 
     def inner_guarded(*args, **kwargs):
@@ -216,9 +691,24 @@ def redis_cached(cache_miss_func):
         except Exception as e:
             # If failed to connect to redis cache
             print 'cache fail -', e
+            metrics.CACHE_REQUESTS.inc(function=func_str, result='error')
             return cache_miss_func(*args, **kwargs)
 
-    return inner_guarded
+    local_cache = create_local_cache(cache_miss_func)
+    if not local_cache:
+        return inner_guarded
+
+    def inner_local(*args, **kwargs):
+        local_key = args_to_str(args, kwargs)
+        found, ret_val = local_cache.get(local_key)
+        if found:
+            metrics.CACHE_REQUESTS.inc(function=func_str, result='local_hit')
+        else:
+            ret_val = inner_guarded(*args, **kwargs)
+            local_cache.set(local_key, ret_val)
+        return ret_val
+
+    return inner_local
 
 
 def get_template_folders(is_module):
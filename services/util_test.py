@@ -110,3 +110,177 @@ class UtilTests(mox.MoxTestBase):
             util.coerce_to_subscription_name_list,
             test_invalid_type
         )
+
+    def test_get_redis_key(self):
+        self.mox.StubOutWithMock(util, 'get_redis_namespace')
+        util.get_redis_namespace().AndReturn('test')
+
+        self.mox.ReplayAll()
+
+        result = util.get_redis_key('get_lists', ('list.name',))
+        self.assertEqual("test:get_lists:('list_dot_name',)", result)
+
+    def test_get_redis_key_unicode(self):
+        self.mox.StubOutWithMock(util, 'get_redis_namespace')
+        util.get_redis_namespace().AndReturn('test')
+        util.get_redis_namespace().AndReturn('test')
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            util.get_redis_key('get_lists', ('list.name',)),
+            util.get_redis_key('get_lists', (u'list.name',))
+        )
+
+    def test_invalidate_cached(self):
+        redis_conn = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+
+        util.get_redis_connection().AndReturn(redis_conn)
+        redis_conn.incr(util.get_generation_key('get_lists')).AndReturn(2)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(2, util.invalidate_cached('get_lists'))
+
+    def test_invalidate_cached_args(self):
+        redis_conn = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+
+        util.get_redis_connection().AndReturn(redis_conn)
+        redis_conn.incr(
+            util.get_generation_key('get_lists', ('name0',))
+        ).AndReturn(1)
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(1, util.invalidate_cached('get_lists', ('name0',)))
+        self.assertNotEqual(
+            util.get_generation_key('get_lists', ('name0',)),
+            util.get_generation_key('get_lists', ('name1',))
+        )
+        self.assertNotEqual(
+            util.get_generation_key('get_lists'),
+            util.get_generation_key('get_lists', ())
+        )
+
+    def test_set_cached_value(self):
+        redis_conn = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+
+        util.get_redis_connection().AndReturn(redis_conn)
+        redis_conn.mget(
+            util.get_generation_key('get_lists'),
+            util.get_generation_key('get_lists', ())
+        ).AndReturn(['3', None])
+        redis_conn.setex(
+            util.get_redis_key('get_lists') + ':3.0',
+            '["name0"]',
+            mox.IgnoreArg()
+        )
+
+        self.mox.ReplayAll()
+
+        util.set_cached_value('get_lists', (), ['name0'])
+
+    def test_get_redis_pool_options(self):
+        options = util.get_redis_pool_options({
+            'REDIS_MAX_CONNECTIONS': 50,
+            'REDIS_SOCKET_TIMEOUT': 0.5,
+            'REDIS_HEALTH_CHECK_INTERVAL': None
+        })
+        self.assertEqual(
+            {'max_connections': 50, 'socket_timeout': 0.5},
+            options
+        )
+
+    def stub_cache_connection(self, prior, ttl):
+        redis_conn = self.mox.CreateMockAnything()
+        redis_read_conn = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+        self.mox.StubOutWithMock(util, 'get_redis_read_connection')
+
+        util.get_redis_connection().AndReturn(redis_conn)
+        util.get_redis_read_connection().AndReturn(redis_read_conn)
+        redis_read_conn.eval(
+            util.CACHED_READ_SCRIPT,
+            2,
+            mox.IgnoreArg(),
+            mox.IgnoreArg(),
+            mox.IgnoreArg()
+        ).AndReturn(['test:func:():0.0', prior, ttl])
+        return redis_conn
+
+    def test_redis_cached_hit(self):
+        self.stub_cache_connection('["name0"]', 100)
+
+        self.mox.ReplayAll()
+
+        cached_func = util.redis_cached(lambda: self.fail('not cached'))
+        self.assertEqual(['name0'], cached_func())
+
+    def test_redis_cached_miss_single_flight(self):
+        redis_conn = self.stub_cache_connection(None, None)
+        redis_conn.set(
+            mox.StrContains(util.CACHE_LOCK_SUFFIX),
+            mox.IgnoreArg(),
+            nx=True,
+            ex=util.DEFAULT_CACHE_LOCK_TIMEOUT
+        ).AndReturn(True)
+        redis_conn.setex('test:func:():0.0', '["name0"]', mox.IgnoreArg())
+        redis_conn.eval(
+            util.RELEASE_LOCK_SCRIPT,
+            1,
+            mox.StrContains(util.CACHE_LOCK_SUFFIX),
+            mox.IgnoreArg()
+        )
+
+        self.mox.ReplayAll()
+
+        cached_func = util.redis_cached(lambda: ['name0'])
+        self.assertEqual(['name0'], cached_func())
+
+    def test_redis_cached_miss_waits_for_other_caller(self):
+        redis_conn = self.stub_cache_connection(None, None)
+        redis_conn.set(
+            mox.StrContains(util.CACHE_LOCK_SUFFIX),
+            mox.IgnoreArg(),
+            nx=True,
+            ex=util.DEFAULT_CACHE_LOCK_TIMEOUT
+        ).AndReturn(None)
+        redis_conn.get(mox.IgnoreArg()).AndReturn('["name0"]')
+
+        self.mox.ReplayAll()
+
+        cached_func = util.redis_cached(lambda: self.fail('not coalesced'))
+        self.assertEqual(['name0'], cached_func())
+
+    def test_local_lru_cache_eviction(self):
+        local_cache = util.LocalLRUCache(2, 60)
+        local_cache.set('key0', 'value0')
+        local_cache.set('key1', 'value1')
+        self.assertEqual((True, 'value0'), local_cache.get('key0'))
+
+        local_cache.set('key2', 'value2')
+        self.assertEqual((False, None), local_cache.get('key1'))
+        self.assertEqual((True, 'value0'), local_cache.get('key0'))
+        self.assertEqual((True, 'value2'), local_cache.get('key2'))
+
+        stats = local_cache.get_stats()
+        self.assertEqual(3, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['size'])
+
+    def test_local_lru_cache_expiration(self):
+        self.mox.StubOutWithMock(util.time, 'time')
+        util.time.time().AndReturn(100)
+        util.time.time().AndReturn(109)
+        util.time.time().AndReturn(111)
+
+        self.mox.ReplayAll()
+
+        local_cache = util.LocalLRUCache(2, 10)
+        local_cache.set('key0', 'value0')
+        self.assertEqual((True, 'value0'), local_cache.get('key0'))
+        self.assertEqual((False, None), local_cache.get('key0'))
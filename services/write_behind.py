@@ -0,0 +1,572 @@
+"""Durable Redis-backed queue of SendGrid subscription changes.
+
+In write-behind mode, subscription changes are applied to the membership cache
+immediately and queued for a separate worker (write_behind_worker.py) to send
+to SendGrid, so users do not wait on SendGrid and SendGrid outages are retried
+in the background.
+
+Jobs move from the queue to a per-worker processing list while being worked on
+so that jobs held by a worker that dies are recovered when it restarts. Each
+job carries an idempotency key that is recorded once SendGrid accepts it, so a
+job delivered twice is only sent once. The id of the latest job for each email
+and list is recorded as well, so that a job superseded by a later change
+(for instance while waiting to be retried) is neither sent nor undone.
+
+Workers collect jobs for up to WRITE_BEHIND_BATCH_WINDOW milliseconds or
+WRITE_BEHIND_BATCH_SIZE jobs, whichever comes first, and send every add to the
+same list in the batch as a single SendGrid request. Only the last change to
+each email's membership of a list in a batch is sent, and the requests for a
+list are sent one after another so that they cannot be reordered.
+"""
+import json
+import redis
+import time
+import uuid
+
+import concurrent_sendgrid
+import membership_cache
+import sendgrid_client
+import subscriptions_service
+import util
+
+QUEUE_KEY_PREFIX = 'write_behind_queue'
+DELAYED_KEY_PREFIX = 'write_behind_delayed'
+PROCESSING_KEY_PREFIX = 'write_behind_processing'
+DEAD_KEY_PREFIX = 'write_behind_dead'
+DONE_KEY_PREFIX = 'write_behind_done'
+LATEST_KEY_PREFIX = 'write_behind_latest'
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_WINDOW = 200
+BATCH_POLL_INTERVAL = 0.01
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 5
+DEFAULT_DONE_EXPIRATION = 86400
+DEFAULT_WORKER_NAME = 'default'
+
+SENT = 'sent'
+DUPLICATE = 'duplicate'
+RETRY = 'retry'
+DEAD = 'dead'
+SUPERSEDED = 'superseded'
+
+
+def is_enabled():
+    """Check if subscription changes should be written behind.
+
+    @return: True if the WRITE_BEHIND_ENABLED config is True and SendGrid is
+        not being emulated.
+    @rtype: bool
+    """
+    config = util.get_app_config()
+    return bool(config.get('WRITE_BEHIND_ENABLED', False)) and \
+        not config['FAKE_SENDGRID']
+
+
+def get_config_value(name, default):
+    return util.get_app_config().get(name, default)
+
+
+def get_queue_key():
+    return util.get_redis_key(QUEUE_KEY_PREFIX)
+
+
+def get_delayed_key():
+    return util.get_redis_key(DELAYED_KEY_PREFIX)
+
+
+def get_processing_key(worker_name):
+    return util.get_redis_key(PROCESSING_KEY_PREFIX, (worker_name,))
+
+
+def get_dead_key():
+    return util.get_redis_key(DEAD_KEY_PREFIX)
+
+
+def get_done_key(job_id):
+    return util.get_redis_key(DONE_KEY_PREFIX, (job_id,))
+
+
+def get_latest_key(email, listname):
+    """Get the Redis key of the id of the latest job for a membership.
+
+    @param email: email address corresponding to a user
+    @type email: str
+    @param listname: The mailing list name.
+    @type listname: str
+    @return: The Redis key.
+    @rtype: str
+    """
+    return util.get_redis_key(LATEST_KEY_PREFIX, (email, listname))
+
+
+def create_job(action, email, listname):
+    """Create a queued subscription change.
+
+    @param action: subscriptions_service.SUBSCRIBE_ACTION or
+        subscriptions_service.UNSUBSCRIBE_ACTION
+    @type action: str
+    @param email: email address corresponding to a user
+    @type email: str
+    @param listname: The mailing list name.
+    @type listname: str
+    @return: The JSON-encoded job.
+    @rtype: str
+    """
+    return json.dumps({
+        'id': uuid.uuid4().hex,
+        'action': action,
+        'email': email,
+        'list': listname,
+        'attempts': 0,
+        'enqueued_at': time.time()
+    })
+
+
+def enqueue_changes(email, new_subscriptions, cancel_subscriptions):
+    """Apply subscription changes to the cache and queue them for SendGrid.
+
+    @param email: email address corresponding to a user
+    @type email: str
+    @param new_subscriptions: the subscriptions to subscribe the user to.
+    @type new_subscriptions: iterable over str
+    @param cancel_subscriptions: the subscriptions to unsubscribe the user
+        from.
+    @type cancel_subscriptions: iterable over str
+    """
+    new_subscriptions = list(new_subscriptions)
+    cancel_subscriptions = list(cancel_subscriptions)
+    jobs = [
+        create_job(subscriptions_service.SUBSCRIBE_ACTION, email, listname)
+        for listname in new_subscriptions
+    ]
+    jobs.extend([
+        create_job(subscriptions_service.UNSUBSCRIBE_ACTION, email, listname)
+        for listname in cancel_subscriptions
+    ])
+    if not jobs:
+        return
+
+    # Kept for as long as a job can be retried
+    expiration = get_config_value(
+        'WRITE_BEHIND_DONE_EXPIRATION',
+        DEFAULT_DONE_EXPIRATION
+    )
+
+    # The cache changes and their jobs are written in one atomic round trip
+    pipe = util.get_redis_connection().pipeline(transaction=True)
+    membership_cache.update_memberships(
+        email,
+        new_subscriptions,
+        cancel_subscriptions,
+        pipe
+    )
+    for raw_job in jobs:
+        job = json.loads(raw_job)
+        pipe.set(
+            get_latest_key(email, job['list']),
+            job['id'],
+            ex=expiration
+        )
+    pipe.lpush(get_queue_key(), *jobs)
+    pipe.execute()
+
+
+def get_pending_emails(listname, emails):
+    """Find the emails with a queued change to a list not yet finished.
+
+    A change is finished once it was sent, dead-lettered, or superseded by a
+    later change that itself finished.
+
+    @param listname: The mailing list name.
+    @type listname: str
+    @param emails: email addresses corresponding to users
+    @type emails: list of str
+    @return: The emails with a pending change.
+    @rtype: set of str
+    """
+    redis_conn = util.get_redis_connection()
+    pipe = redis_conn.pipeline(transaction=False)
+    for email in emails:
+        pipe.get(get_latest_key(email, listname))
+    latest = [
+        (email, job_id)
+        for email, job_id in zip(emails, pipe.execute())
+        if job_id is not None
+    ]
+    if not latest:
+        return set()
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for email, job_id in latest:
+        pipe.exists(get_done_key(job_id))
+    return set(
+        email
+        for (email, job_id), is_done in zip(latest, pipe.execute())
+        if not is_done
+    )
+
+
+def recover_processing(worker_name):
+    """Return jobs left in a worker's processing list to the queue.
+
+    @param worker_name: The name of the worker that may have died.
+    @type worker_name: str
+    @return: The number of jobs recovered.
+    @rtype: int
+    """
+    redis_conn = util.get_redis_connection()
+    processing_key = get_processing_key(worker_name)
+    recovered = 0
+    while redis_conn.rpoplpush(processing_key, get_queue_key()):
+        recovered += 1
+    return recovered
+
+
+def promote_delayed(now=None):
+    """Move jobs whose retry delay has passed from the delayed set to the queue.
+
+    @return: The number of jobs moved.
+    @rtype: int
+    """
+    if now is None:
+        now = time.time()
+
+    redis_conn = util.get_redis_connection()
+    due = redis_conn.zrangebyscore(get_delayed_key(), 0, now)
+    moved = 0
+    for raw_job in due:
+        # Only the worker that removes the job from the delayed set requeues it
+        if redis_conn.zrem(get_delayed_key(), raw_job):
+            redis_conn.lpush(get_queue_key(), raw_job)
+            moved += 1
+    return moved
+
+
+def take_batch(worker_name, batch_size, timeout, window=0):
+    """Move up to batch_size jobs from the queue to a worker's processing list.
+
+    Blocks for up to timeout seconds for the first job, then keeps collecting
+    jobs for up to window seconds after it arrived so that changes made close
+    together are sent together.
+
+    @return: The JSON-encoded jobs.
+    @rtype: list of str
+    """
+    redis_conn = util.get_redis_connection()
+    processing_key = get_processing_key(worker_name)
+
+    raw_job = redis_conn.brpoplpush(get_queue_key(), processing_key, timeout)
+    if not raw_job:
+        return []
+
+    batch = [raw_job]
+    deadline = time.time() + window
+    while len(batch) < batch_size:
+        raw_job = redis_conn.rpoplpush(get_queue_key(), processing_key)
+        if raw_job:
+            batch.append(raw_job)
+            continue
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, BATCH_POLL_INTERVAL))
+    return batch
+
+
+def group_jobs(batch):
+    """Group jobs that can be sent to SendGrid in one request.
+
+    Only the last job for each email and list in the batch is kept; earlier
+    ones are superseded. The remaining adds to a list are grouped together,
+    which is safe since each email then has a single change per list.
+    Removals are sent one per request since SendGrid's delete takes a single
+    email.
+
+    @param batch: The JSON-encoded jobs, oldest first.
+    @type batch: list of str
+    @return: Tuple of (groups by list, superseded jobs). Groups by list holds,
+        for each list in order of first appearance, the groups of
+        JSON-encoded jobs to send for it one after another.
+    @rtype: tuple
+    """
+    jobs = [json.loads(raw_job) for raw_job in batch]
+    last_index = {}
+    for index, job in enumerate(jobs):
+        last_index[(job['email'], job['list'])] = index
+
+    list_groups = []
+    groups_by_list = {}
+    adds_by_list = {}
+    superseded = []
+    for index, (raw_job, job) in enumerate(zip(batch, jobs)):
+        if last_index[(job['email'], job['list'])] != index:
+            superseded.append(raw_job)
+            continue
+
+        groups = groups_by_list.get(job['list'], None)
+        if groups is None:
+            groups = []
+            groups_by_list[job['list']] = groups
+            list_groups.append(groups)
+
+        if job['action'] != subscriptions_service.SUBSCRIBE_ACTION:
+            groups.append([raw_job])
+            continue
+
+        group = adds_by_list.get(job['list'], None)
+        if group is None:
+            group = []
+            adds_by_list[job['list']] = group
+            groups.append(group)
+        group.append(raw_job)
+    return list_groups, superseded
+
+
+def send_jobs(group):
+    """Send a group of queued subscription changes to SendGrid.
+
+    Jobs already sent, or superseded by a later job for the same email and
+    list, are not sent.
+
+    @param group: JSON-encoded jobs from group_jobs.
+    @type group: list of str
+    @return: For each job, DUPLICATE if the job was already sent, SUPERSEDED
+        if a later job replaced it, else the SendGrid status code.
+    @rtype: list of str or int
+    """
+    jobs = [json.loads(raw_job) for raw_job in group]
+    pipe = util.get_redis_connection().pipeline(transaction=False)
+    for job in jobs:
+        pipe.exists(get_done_key(job['id']))
+        pipe.get(get_latest_key(job['email'], job['list']))
+    results = pipe.execute()
+
+    skipped = []
+    for job, is_done, latest in zip(jobs, results[::2], results[1::2]):
+        if is_done:
+            skipped.append(DUPLICATE)
+        elif latest is not None and latest != job['id']:
+            skipped.append(SUPERSEDED)
+        else:
+            skipped.append(None)
+
+    pending = [job for job, skip in zip(jobs, skipped) if not skip]
+    if not pending:
+        return skipped
+
+    if pending[0]['action'] == subscriptions_service.SUBSCRIBE_ACTION:
+        # SendGrid's "inserted" count excludes recipients already on the list,
+        # so the status of the request is the only outcome per recipient
+        response = subscriptions_service.add_users_to_list(
+            pending[0]['list'],
+            [job['email'] for job in pending]
+        )
+        pending_statuses = [response.status_code] * len(pending)
+    else:
+        pending_statuses = [subscriptions_service.delete_user_from_list(
+            pending[0]['list'],
+            pending[0]['email']
+        ).status_code]
+
+    pending_statuses = iter(pending_statuses)
+    return [skip or next(pending_statuses) for skip in skipped]
+
+
+def revert_cache(job):
+    """Undo the cache change of a job SendGrid will not accept.
+
+    Nothing is undone if a later change to the same membership was queued,
+    since the cache already reflects that change.
+
+    @param job: The decoded job.
+    @type job: dict
+    @return: True if the change was undone.
+    @rtype: bool
+    """
+    latest_key = get_latest_key(job['email'], job['list'])
+    pipe = util.get_redis_connection().pipeline(transaction=True)
+    try:
+        pipe.watch(latest_key)
+        latest = pipe.get(latest_key)
+        if latest is not None and latest != job['id']:
+            return False
+
+        pipe.multi()
+        if job['action'] == subscriptions_service.SUBSCRIBE_ACTION:
+            membership_cache.update_memberships(
+                job['email'],
+                [],
+                [job['list']],
+                pipe
+            )
+        else:
+            membership_cache.update_memberships(
+                job['email'],
+                [job['list']],
+                [],
+                pipe
+            )
+        pipe.execute()
+    except redis.WatchError:
+        # A later change was queued while undoing this one
+        return False
+    finally:
+        pipe.reset()
+    return True
+
+
+def finish_job(worker_name, raw_job, status, error):
+    """Acknowledge, retry, or dead-letter a job after it was sent.
+
+    @param worker_name: The name of the worker holding the job.
+    @type worker_name: str
+    @param raw_job: The JSON-encoded job.
+    @type raw_job: str
+    @param status: The result of send_jobs, SUPERSEDED if a later job
+        replaced it, or None if sending raised.
+    @type status: str or int
+    @param error: The exception raised by send_job, if any.
+    @type error: Exception
+    @return: SENT, DUPLICATE, SUPERSEDED, RETRY, or DEAD
+    @rtype: str
+    """
+    job = json.loads(raw_job)
+    redis_conn = util.get_redis_connection()
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.lrem(get_processing_key(worker_name), raw_job, 1)
+
+    if status == SUPERSEDED:
+        pipe.execute()
+        return SUPERSEDED
+
+    done_expiration = get_config_value(
+        'WRITE_BEHIND_DONE_EXPIRATION',
+        DEFAULT_DONE_EXPIRATION
+    )
+    if status == DUPLICATE or status == 200:
+        pipe.set(get_done_key(job['id']), 1, ex=done_expiration)
+        pipe.execute()
+        if status == DUPLICATE:
+            return DUPLICATE
+        return SENT
+
+    job['attempts'] += 1
+    max_attempts = get_config_value(
+        'WRITE_BEHIND_MAX_ATTEMPTS',
+        DEFAULT_MAX_ATTEMPTS
+    )
+    is_transient = error or status in sendgrid_client.RETRY_STATUS_CODES
+    if is_transient and job['attempts'] < max_attempts:
+        delay = get_config_value(
+            'WRITE_BEHIND_RETRY_DELAY',
+            DEFAULT_RETRY_DELAY
+        ) * (2 ** (job['attempts'] - 1))
+        pipe.zadd(get_delayed_key(), **{json.dumps(job): time.time() + delay})
+        pipe.execute()
+        return RETRY
+
+    print 'write behind dead - %s: %s' % (raw_job, error or status)
+    job['error'] = str(error or status)
+    pipe.lpush(get_dead_key(), json.dumps(job))
+    # Finished, so that the change no longer counts as pending
+    pipe.set(get_done_key(job['id']), 1, ex=done_expiration)
+    pipe.execute()
+    revert_cache(job)
+    return DEAD
+
+
+def process_batch(client, worker_name, batch):
+    """Send a batch of jobs to SendGrid, one request per group.
+
+    Lists are sent concurrently, and the groups of each list in order.
+
+    @param client: The client to send the jobs with.
+    @type client: concurrent_sendgrid.ConcurrentSendGridClient
+    @param worker_name: The name of the worker holding the jobs.
+    @type worker_name: str
+    @param batch: The JSON-encoded jobs.
+    @type batch: list of str
+    @return: The number of jobs by outcome, of the form {SENT: 1, RETRY: 0, ...}
+    @rtype: dict
+    """
+    report = {SENT: 0, DUPLICATE: 0, SUPERSEDED: 0, RETRY: 0, DEAD: 0}
+    list_groups, superseded = group_jobs(batch)
+    for raw_job in superseded:
+        report[finish_job(worker_name, raw_job, SUPERSEDED, None)] += 1
+
+    def send_list(groups):
+        results = []
+        for index, group in enumerate(groups):
+            try:
+                if index:
+                    statuses = client.call(send_jobs, group)
+                else:
+                    # The first request is rate limited by map_unordered
+                    statuses = send_jobs(group)
+                results.append((group, statuses, None))
+            except Exception as e:
+                results.append((group, None, e))
+        return results
+
+    for groups, results, error, seconds in client.map_unordered(
+        send_list,
+        list_groups
+    ):
+        if results is None:
+            results = [(group, None, error) for group in groups]
+        for group, statuses, group_error in results:
+            if statuses is None:
+                statuses = [None] * len(group)
+            for raw_job, status in zip(group, statuses):
+                report[finish_job(
+                    worker_name,
+                    raw_job,
+                    status,
+                    group_error
+                )] += 1
+    return report
+
+
+def run_worker(worker_name=DEFAULT_WORKER_NAME, batch_size=None,
+        poll_timeout=1, once=False):
+    """Process queued subscription changes until stopped.
+
+    @param worker_name: A name unique to this worker, reused across restarts
+        so that its unfinished jobs are recovered.
+    @type worker_name: str
+    @param batch_size: The maximum number of jobs collected into one batch.
+        Defaults to the WRITE_BEHIND_BATCH_SIZE config.
+    @type batch_size: int
+    @param poll_timeout: Seconds to wait for a job before checking for delayed
+        jobs again.
+    @type poll_timeout: int
+    @param once: If True, stop after the queue is first found empty.
+    @type once: bool
+    """
+    if batch_size is None:
+        batch_size = get_config_value(
+            'WRITE_BEHIND_BATCH_SIZE',
+            DEFAULT_BATCH_SIZE
+        )
+    window = get_config_value(
+        'WRITE_BEHIND_BATCH_WINDOW',
+        DEFAULT_BATCH_WINDOW
+    ) / 1000.0
+
+    recovered = recover_processing(worker_name)
+    if recovered:
+        print 'write behind recovered %d jobs' % recovered
+
+    with concurrent_sendgrid.create_client() as client:
+        while True:
+            promote_delayed()
+            batch = take_batch(worker_name, batch_size, poll_timeout, window)
+            if not batch:
+                if once:
+                    return
+                continue
+
+            report = process_batch(client, worker_name, batch)
+            print 'write behind batch - %s' % json.dumps(report)
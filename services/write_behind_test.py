@@ -0,0 +1,353 @@
+"""Tests for write_behind
+
+@license: GNU GPLv3
+"""
+import json
+
+import mox
+
+import membership_cache
+import subscriptions_service
+import util
+import write_behind
+
+TEST_EMAIL = 'test@example.com'
+TEST_WORKER = 'worker-1'
+
+
+def create_raw_job(action, attempts=0, job_id='job-id', email=TEST_EMAIL,
+        listname='name0'):
+    return json.dumps({
+        'id': job_id,
+        'action': action,
+        'email': email,
+        'list': listname,
+        'attempts': attempts,
+        'enqueued_at': 100
+    })
+
+
+class WriteBehindTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.redis_conn = self.mox.CreateMockAnything()
+        self.pipe = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(util, 'get_redis_connection')
+        self.mox.StubOutWithMock(write_behind, 'get_config_value')
+        self.mox.StubOutWithMock(membership_cache, 'update_memberships')
+
+    def test_enqueue_changes(self):
+        write_behind.get_config_value(
+            'WRITE_BEHIND_DONE_EXPIRATION',
+            write_behind.DEFAULT_DONE_EXPIRATION
+        ).AndReturn(60)
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        membership_cache.update_memberships(
+            TEST_EMAIL,
+            ['name0'],
+            ['name1'],
+            self.pipe
+        )
+        self.pipe.set(
+            write_behind.get_latest_key(TEST_EMAIL, 'name0'),
+            mox.IsA(basestring),
+            ex=60
+        )
+        self.pipe.set(
+            write_behind.get_latest_key(TEST_EMAIL, 'name1'),
+            mox.IsA(basestring),
+            ex=60
+        )
+        self.pipe.lpush(
+            write_behind.get_queue_key(),
+            mox.Func(lambda job: json.loads(job)['list'] == 'name0'),
+            mox.Func(lambda job: json.loads(job)['list'] == 'name1')
+        )
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        write_behind.enqueue_changes(TEST_EMAIL, ['name0'], ['name1'])
+
+    def test_group_jobs(self):
+        add_0 = create_raw_job(
+            subscriptions_service.SUBSCRIBE_ACTION,
+            job_id='0'
+        )
+        add_1 = create_raw_job(
+            subscriptions_service.SUBSCRIBE_ACTION,
+            job_id='1',
+            listname='name1'
+        )
+        remove_2 = create_raw_job(
+            subscriptions_service.UNSUBSCRIBE_ACTION,
+            job_id='2'
+        )
+        add_3 = create_raw_job(
+            subscriptions_service.SUBSCRIBE_ACTION,
+            job_id='3',
+            email='other@example.com'
+        )
+
+        self.mox.ReplayAll()
+
+        list_groups, superseded = write_behind.group_jobs(
+            [add_0, add_1, remove_2, add_3]
+        )
+        self.assertEqual([[[add_1]], [[remove_2], [add_3]]], list_groups)
+        self.assertEqual([add_0], superseded)
+
+    def test_group_jobs_keeps_last_change(self):
+        add_0 = create_raw_job(
+            subscriptions_service.SUBSCRIBE_ACTION,
+            job_id='0',
+            email='a@example.com'
+        )
+        remove_1 = create_raw_job(
+            subscriptions_service.UNSUBSCRIBE_ACTION,
+            job_id='1'
+        )
+        add_2 = create_raw_job(
+            subscriptions_service.SUBSCRIBE_ACTION,
+            job_id='2'
+        )
+        remove_3 = create_raw_job(
+            subscriptions_service.UNSUBSCRIBE_ACTION,
+            job_id='3',
+            email='b@example.com'
+        )
+
+        self.mox.ReplayAll()
+
+        list_groups, superseded = write_behind.group_jobs(
+            [add_0, remove_1, add_2, remove_3]
+        )
+        self.assertEqual([[[add_0, add_2], [remove_3]]], list_groups)
+        self.assertEqual([remove_1], superseded)
+
+    def test_send_jobs(self):
+        group = [
+            create_raw_job(subscriptions_service.SUBSCRIBE_ACTION, job_id='0'),
+            create_raw_job(
+                subscriptions_service.SUBSCRIBE_ACTION,
+                job_id='1',
+                email='done@example.com'
+            ),
+            create_raw_job(
+                subscriptions_service.SUBSCRIBE_ACTION,
+                job_id='2',
+                email='other@example.com'
+            )
+        ]
+        response = self.mox.CreateMockAnything()
+        response.status_code = 200
+        self.mox.StubOutWithMock(subscriptions_service, 'add_users_to_list')
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(write_behind.get_done_key('0'))
+        self.pipe.get(write_behind.get_latest_key(TEST_EMAIL, 'name0'))
+        self.pipe.exists(write_behind.get_done_key('1'))
+        self.pipe.get(write_behind.get_latest_key('done@example.com', 'name0'))
+        self.pipe.exists(write_behind.get_done_key('2'))
+        self.pipe.get(write_behind.get_latest_key('other@example.com', 'name0'))
+        self.pipe.execute().AndReturn([False, '0', True, '1', False, None])
+        subscriptions_service.add_users_to_list(
+            'name0',
+            [TEST_EMAIL, 'other@example.com']
+        ).AndReturn(response)
+
+        self.mox.ReplayAll()
+
+        statuses = write_behind.send_jobs(group)
+        self.assertEqual([200, write_behind.DUPLICATE, 200], statuses)
+
+    def test_send_jobs_superseded(self):
+        group = [
+            create_raw_job(subscriptions_service.SUBSCRIBE_ACTION, job_id='0')
+        ]
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(write_behind.get_done_key('0'))
+        self.pipe.get(write_behind.get_latest_key(TEST_EMAIL, 'name0'))
+        self.pipe.execute().AndReturn([False, 'later-job'])
+
+        self.mox.ReplayAll()
+
+        statuses = write_behind.send_jobs(group)
+        self.assertEqual([write_behind.SUPERSEDED], statuses)
+
+    def test_revert_cache_superseded(self):
+        job = json.loads(
+            create_raw_job(subscriptions_service.SUBSCRIBE_ACTION)
+        )
+        latest_key = write_behind.get_latest_key(TEST_EMAIL, 'name0')
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.watch(latest_key)
+        self.pipe.get(latest_key).AndReturn('later-job')
+        self.pipe.reset()
+
+        self.mox.ReplayAll()
+
+        self.assertFalse(write_behind.revert_cache(job))
+
+    def test_send_jobs_failed_add(self):
+        group = [
+            create_raw_job(subscriptions_service.SUBSCRIBE_ACTION, job_id='0'),
+            create_raw_job(
+                subscriptions_service.SUBSCRIBE_ACTION,
+                job_id='1',
+                email='other@example.com'
+            )
+        ]
+        response = self.mox.CreateMockAnything()
+        response.status_code = 400
+        self.mox.StubOutWithMock(subscriptions_service, 'add_users_to_list')
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.exists(write_behind.get_done_key('0'))
+        self.pipe.get(write_behind.get_latest_key(TEST_EMAIL, 'name0'))
+        self.pipe.exists(write_behind.get_done_key('1'))
+        self.pipe.get(write_behind.get_latest_key('other@example.com', 'name0'))
+        self.pipe.execute().AndReturn([False, '0', False, '1'])
+        subscriptions_service.add_users_to_list(
+            'name0',
+            [TEST_EMAIL, 'other@example.com']
+        ).AndReturn(response)
+
+        self.mox.ReplayAll()
+
+        statuses = write_behind.send_jobs(group)
+        self.assertEqual([400, 400], statuses)
+
+    def test_get_pending_emails(self):
+        check_pipe = self.mox.CreateMockAnything()
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=False).AndReturn(self.pipe)
+        self.pipe.get(write_behind.get_latest_key(TEST_EMAIL, 'name0'))
+        self.pipe.get(write_behind.get_latest_key('sent@example.com', 'name0'))
+        self.pipe.get(write_behind.get_latest_key('idle@example.com', 'name0'))
+        self.pipe.execute().AndReturn(['0', '1', None])
+        self.redis_conn.pipeline(transaction=False).AndReturn(check_pipe)
+        check_pipe.exists(write_behind.get_done_key('0'))
+        check_pipe.exists(write_behind.get_done_key('1'))
+        check_pipe.execute().AndReturn([False, True])
+
+        self.mox.ReplayAll()
+
+        pending = write_behind.get_pending_emails(
+            'name0',
+            [TEST_EMAIL, 'sent@example.com', 'idle@example.com']
+        )
+        self.assertEqual(set([TEST_EMAIL]), pending)
+
+    def test_finish_job_superseded(self):
+        raw_job = create_raw_job(subscriptions_service.UNSUBSCRIBE_ACTION)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.lrem(write_behind.get_processing_key(TEST_WORKER), raw_job, 1)
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        result = write_behind.finish_job(
+            TEST_WORKER,
+            raw_job,
+            write_behind.SUPERSEDED,
+            None
+        )
+        self.assertEqual(write_behind.SUPERSEDED, result)
+
+    def test_finish_job_sent(self):
+        raw_job = create_raw_job(subscriptions_service.SUBSCRIBE_ACTION)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.lrem(write_behind.get_processing_key(TEST_WORKER), raw_job, 1)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_DONE_EXPIRATION',
+            write_behind.DEFAULT_DONE_EXPIRATION
+        ).AndReturn(60)
+        self.pipe.set(write_behind.get_done_key('job-id'), 1, ex=60)
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        result = write_behind.finish_job(TEST_WORKER, raw_job, 200, None)
+        self.assertEqual(write_behind.SENT, result)
+
+    def test_finish_job_retry(self):
+        raw_job = create_raw_job(subscriptions_service.SUBSCRIBE_ACTION)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.lrem(write_behind.get_processing_key(TEST_WORKER), raw_job, 1)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_DONE_EXPIRATION',
+            write_behind.DEFAULT_DONE_EXPIRATION
+        ).AndReturn(60)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_MAX_ATTEMPTS',
+            write_behind.DEFAULT_MAX_ATTEMPTS
+        ).AndReturn(3)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_RETRY_DELAY',
+            write_behind.DEFAULT_RETRY_DELAY
+        ).AndReturn(5)
+        self.pipe.zadd(write_behind.get_delayed_key(), **{
+            create_raw_job(subscriptions_service.SUBSCRIBE_ACTION, 1):
+                mox.IsA(float)
+        })
+        self.pipe.execute()
+
+        self.mox.ReplayAll()
+
+        result = write_behind.finish_job(TEST_WORKER, raw_job, 503, None)
+        self.assertEqual(write_behind.RETRY, result)
+
+    def test_finish_job_dead(self):
+        raw_job = create_raw_job(subscriptions_service.UNSUBSCRIBE_ACTION)
+
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(self.pipe)
+        self.pipe.lrem(write_behind.get_processing_key(TEST_WORKER), raw_job, 1)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_DONE_EXPIRATION',
+            write_behind.DEFAULT_DONE_EXPIRATION
+        ).AndReturn(60)
+        write_behind.get_config_value(
+            'WRITE_BEHIND_MAX_ATTEMPTS',
+            write_behind.DEFAULT_MAX_ATTEMPTS
+        ).AndReturn(3)
+        self.pipe.lpush(write_behind.get_dead_key(), mox.IgnoreArg())
+        self.pipe.set(write_behind.get_done_key('job-id'), 1, ex=60)
+        self.pipe.execute()
+
+        latest_key = write_behind.get_latest_key(TEST_EMAIL, 'name0')
+        revert_pipe = self.mox.CreateMockAnything()
+        util.get_redis_connection().AndReturn(self.redis_conn)
+        self.redis_conn.pipeline(transaction=True).AndReturn(revert_pipe)
+        revert_pipe.watch(latest_key)
+        revert_pipe.get(latest_key).AndReturn('job-id')
+        revert_pipe.multi()
+        membership_cache.update_memberships(
+            TEST_EMAIL,
+            ['name0'],
+            [],
+            revert_pipe
+        )
+        revert_pipe.execute()
+        revert_pipe.reset()
+
+        self.mox.ReplayAll()
+
+        result = write_behind.finish_job(TEST_WORKER, raw_job, 400, None)
+        self.assertEqual(write_behind.DEAD, result)
@@ -24,34 +24,70 @@ var subscription_controller = {
     next_select_all_state: true,
 
     /**
-     * Create a closure function that will save the DOM subscriptions.
+     * Subscription state of each list as last saved, by list name.
+     */
+    saved_state: {},
+
+    /**
+     * Read the subscription state of each list from the DOM.
+     * @return {obj} Whether each list is checked, by list name.
+     */
+    read_state: function (self) {
+        var subscriptions = $(self.view_target).find(self.subscription_el);
+        var state = {};
+
+        $.each(subscriptions, function (index, subscription) {
+            var name = $(subscription).find(self.name_el).val();
+            state[name] = $(subscription).find(self.is_subscribed_el).is(':checked');
+        });
+
+        return state;
+    },
+
+    /**
+     * Create a closure function that will save the toggled DOM subscriptions.
      */
     create_update_subscriptions: function () {
         var self = this;
         return function () {
-            var subscriptions = $(self.view_target).find(self.subscription_el);
-            var update_data = {};
+            var state = self.read_state(self);
+            var changes = {'add': [], 'remove': []};
+
+            $.each(state, function (name, is_subscribed) {
+                if (is_subscribed !== self.saved_state[name]) {
+                    changes[is_subscribed ? 'add' : 'remove'].push(name);
+                }
+            });
 
             $(self.save_button).hide();
             $('#ajax-loader').show();
 
-            $.each(subscriptions, function (index, subscription) {
-                var name = $(subscription).find(self.name_el).val();
-                var is_subscribed = $(subscription).find(self.is_subscribed_el).is(':checked');
-                update_data[name] = {'subscribed': is_subscribed};
-            });
+            if (changes.add.length === 0 && changes.remove.length === 0) {
+                self.create_notify('Subscription update successful')();
+                return;
+            }
 
-            self.post_data(self, update_data);
+            self.patch_data(self, changes, state);
         }
     },
 
     /**
-     * Post data to the server and notify the user of success/failure.
-     * @param {obj} subscription_data The data to be posted to the server.
+     * Send toggled lists to the server and notify the user of success/failure.
+     * @param {obj} changes The lists to add and remove: {'add': [], 'remove': []}.
+     * @param {obj} state The subscription state being saved.
      */
-    post_data: function (self, subscription_data) {
-        var data = {'subscriptions': JSON.stringify(subscription_data)};
-        $.post('', data=data, success=self.create_notify('Subscription update successful'))
+    patch_data: function (self, changes, state) {
+        var notify_success = self.create_notify('Subscription update successful');
+        $.ajax({
+            url: window.location.href,
+            type: 'PATCH',
+            contentType: 'application/json',
+            data: JSON.stringify(changes)
+        })
+            .done(function () {
+                self.saved_state = state;
+                notify_success();
+            })
             .fail(self.create_notify('Subscription update failed.'))
             .fail(function(xhr, textStatus, errorThrown) {
                 console.log('xhr.responseText');
@@ -103,6 +139,7 @@ var subscription_controller = {
     },
 
     listen: function () {
+        this.saved_state = this.read_state(this);
         $(this.save_button).on('click', this.create_update_subscriptions());
         $(this.select_all_toggle_el).on('change', this.create_toggle_all_is_subscribed());
         $('#ajax-loader').hide();
@@ -0,0 +1,52 @@
+"""Command line job that prewarms the subscription membership cache.
+
+Fetches the membership of every SendGrid list and writes it, along with the
+email to lists membership index, to the Redis cache. Intended to be run at
+deploy time and on a schedule so that user requests do not pay for cache
+misses.
+
+With --reconcile, only the difference between SendGrid and the cache is
+applied, leaving unchanged members cached, and the drift found is reported.
+
+@license: GNU GPLv3
+"""
+import argparse
+import json
+import sys
+
+import tiny_subscriptions
+import services
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prewarm the subscription membership cache.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of concurrent SendGrid requests (default: SYNC_WORKERS).'
+    )
+    parser.add_argument(
+        '--reconcile',
+        action='store_true',
+        help='Apply only the changes since the cache was filled and report '
+             'drift instead of replacing every list.'
+    )
+    args = parser.parse_args()
+
+    tiny_subscriptions.initialize_standalone()
+    if args.reconcile:
+        report = services.sync_service.reconcile_membership(args.workers)
+    else:
+        report = services.sync_service.sync_membership(args.workers)
+
+    print json.dumps(report, indent=4, sort_keys=True)
+    if report['failed']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,13 @@ import controllers
 import services
 
 def attach_blueprints(target_app):
+    controllers.metrics_controller.track_blueprint(
+        controllers.descriptions_controller.blueprint
+    )
+    controllers.metrics_controller.track_blueprint(
+        controllers.subscriptions_controller.blueprint
+    )
+
     target_app.register_blueprint(
         controllers.descriptions_controller.blueprint,
         url_prefix='/mailing'
@@ -25,6 +32,10 @@ def attach_blueprints(target_app):
         controllers.subscriptions_controller.blueprint,
         url_prefix='/mailing'
     )
+    target_app.register_blueprint(
+        controllers.metrics_controller.blueprint,
+        url_prefix='/mailing'
+    )
 
 
 def get_app():
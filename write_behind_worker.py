@@ -0,0 +1,46 @@
+"""Worker sending queued subscription changes to SendGrid.
+
+Processes the write-behind queue filled by the subscriptions controller when
+the WRITE_BEHIND_ENABLED config is True. Run one or more workers, each with a
+name unique to it that is kept across restarts.
+
+@license: GNU GPLv3
+"""
+import argparse
+
+import tiny_subscriptions
+import services
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Send queued subscription changes to SendGrid.'
+    )
+    parser.add_argument(
+        '--name',
+        default=services.write_behind.DEFAULT_WORKER_NAME,
+        help='Name unique to this worker (default: %(default)s).'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=None,
+        help='Jobs collected per batch (default: WRITE_BEHIND_BATCH_SIZE).'
+    )
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help='Exit once the queue is empty.'
+    )
+    args = parser.parse_args()
+
+    tiny_subscriptions.initialize_standalone()
+    services.write_behind.run_worker(
+        worker_name=args.name,
+        batch_size=args.batch_size,
+        once=args.once
+    )
+
+
+if __name__ == '__main__':
+    main()